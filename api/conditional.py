@@ -0,0 +1,67 @@
+"""
+Conditional GET support (ETag / Last-Modified) for read endpoints.
+
+Validators are computed from cheap aggregates (updated_at, max ids, counts,
+Post.cache_version) before any serializer runs, so a client that already has
+the current representation gets a bodyless 304 for the price of those queries.
+Every ETag also covers the viewer and the full request path, because the
+representations include viewer-specific fields and depend on query params.
+"""
+import hashlib
+
+from django.db.models import Count, Max, Q
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+
+def make_etag(request, *parts):
+    viewer = request.user.pk if request.user.is_authenticated else None
+    raw = repr((viewer, request.get_full_path()) + parts).encode()
+    return '"%s"' % hashlib.md5(raw, usedforsecurity=False).hexdigest()
+
+
+def not_modified(request, etag=None, last_modified=None):
+    """Return a 304 response if the client's validators are still current, else None"""
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag and 'ETag' not in response:
+        response['ETag'] = etag
+    if last_modified and 'Last-Modified' not in response:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+def post_etag(request, posts, *extra):
+    """ETag for posts rendered by PostSerializer; any rendering change bumps cache_version"""
+    rows = [
+        (post.pk, post.cache_version, post.user.updated_at, getattr(post, 'viewer_has_liked', None))
+        for post in posts
+    ]
+    return make_etag(request, rows, *extra)
+
+
+def friends_validators(request, user):
+    """(etag, last_modified) for a user together with their friend list"""
+    friends = user.friends.aggregate(count=Count('id'), last=Max('updated_at'))
+    last_modified = max(filter(None, [user.updated_at, friends['last']]))
+    etag = make_etag(request, user.pk, user.updated_at, friends['count'], friends['last'])
+    return etag, last_modified
+
+
+def notifications_etag(request, notifications):
+    """Notifications only get created, marked read or deleted, so these aggregates cover every change"""
+    state = notifications.aggregate(
+        count=Count('id'),
+        last_id=Max('id'),
+        unread=Count('id', filter=Q(is_read=False)),
+        senders=Max('from_user__updated_at'),
+        requests=Max('friend_request__updated_at'),
+    )
+    return make_etag(request, *sorted(state.items()))
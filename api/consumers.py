@@ -1,3 +1,4 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
@@ -6,6 +7,7 @@ from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from .models import Notification
+from .moderation import chat as chat_moderation
 from .serializers import NotificationSerializer
 from urllib.parse import parse_qs
 
@@ -105,6 +107,15 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'message': event['message']
         }))
 
+    async def image_ready(self, event):
+        """Send processed image location to WebSocket"""
+        await self.send(text_data=json.dumps({
+            'type': 'image_ready',
+            'kind': event['kind'],
+            'id': event['id'],
+            'url': event['url']
+        }))
+
     @database_sync_to_async
     def get_user(self, user_id):
         try:
@@ -266,6 +277,9 @@ class MessageConsumer(AsyncWebsocketConsumer):
                                 }
                             )
                             print(f"[WebSocket] Message broadcasted for conversation {self.conversation_id}")
+                            # Broadcast first, moderate after: flagged messages are retracted
+                            if chat_moderation.is_enabled():
+                                self.schedule_moderation(message.id, content)
                         else:
                             print(f"[WebSocket] Failed to serialize message")
                     else:
@@ -308,11 +322,38 @@ class MessageConsumer(AsyncWebsocketConsumer):
 
     async def message_deleted(self, event):
         # Send deleted message notification to WebSocket
-        await self.send(text_data=json.dumps({
+        payload = {
             'type': 'message_deleted',
             'message_id': event['message_id']
+        }
+        if event.get('reason'):
+            payload['reason'] = event['reason']
+        await self.send(text_data=json.dumps(payload))
+
+    async def image_ready(self, event):
+        """Send processed image location to WebSocket"""
+        await self.send(text_data=json.dumps({
+            'type': 'image_ready',
+            'kind': event['kind'],
+            'id': event['id'],
+            'url': event['url']
         }))
 
+    def schedule_moderation(self, message_id, content):
+        # Keep a reference so the task is not garbage collected mid-flight
+        if not hasattr(self, 'moderation_tasks'):
+            self.moderation_tasks = set()
+        task = asyncio.ensure_future(self.moderate_message(message_id, content))
+        self.moderation_tasks.add(task)
+        task.add_done_callback(self.moderation_tasks.discard)
+
+    async def moderate_message(self, message_id, content):
+        verdict = await chat_moderation.moderate(content)
+        if verdict is None or not verdict[0]:
+            return
+        if await database_sync_to_async(chat_moderation.retract)(message_id, verdict[1]):
+            print(f"[WebSocket] Message {message_id} retracted by moderation: {verdict[1]}")
+
     @database_sync_to_async
     def get_user(self, user_id):
         try:
@@ -0,0 +1,77 @@
+"""
+Cache of serialized posts.
+
+PostSerializer output is the same for every viewer apart from the
+`viewer_has_liked` flags, so each post's rendering is stored under
+post id + Post.cache_version + the author's updated_at + a variant
+describing the request options. Any change that alters the rendering (edit,
+picture upload, like, comment, comment like) bumps cache_version, and any
+change to the author (name, picture, picture variants) their updated_at, so
+stale entries are simply never read again and age out of the backend.
+Commenter name/picture changes are picked up when entries expire
+(POST_FRAGMENT_CACHE_TIMEOUT).
+
+The backend is the POST_FRAGMENT_CACHE_ALIAS entry in CACHES: LocMemCache
+(LRU, bounded by MAX_ENTRIES) locally, RedisCache when REDIS_URL is set.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'POST_FRAGMENT_CACHE_ENABLED', True)
+
+
+def get_cache():
+    return caches[getattr(settings, 'POST_FRAGMENT_CACHE_ALIAS', 'post_fragments')]
+
+
+def fragment_key(post, variant):
+    # The author's updated_at, as in the post ETags (api.conditional.post_etag)
+    return f'post:{post.pk}:v{post.cache_version}:u{post.user.updated_at.timestamp()}:{variant}'
+
+
+def get_many(posts, variant):
+    """Return {post.pk: rendered data} for the posts that are cached"""
+    if not is_enabled() or not posts:
+        return {}
+    keys = {fragment_key(post, variant): post.pk for post in posts}
+    found = get_cache().get_many(list(keys))
+    with _stats_lock:
+        _stats['hits'] += len(found)
+        _stats['misses'] += len(keys) - len(found)
+    return {keys[key]: data for key, data in found.items()}
+
+
+def set_many(posts, variant, rendered):
+    """Store freshly rendered posts; `rendered` maps post.pk to data"""
+    if not is_enabled() or not posts:
+        return
+    timeout = getattr(settings, 'POST_FRAGMENT_CACHE_TIMEOUT', 300)
+    get_cache().set_many(
+        {fragment_key(post, variant): rendered[post.pk] for post in posts},
+        timeout=timeout
+    )
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
+
+
+def clear():
+    get_cache().clear()
@@ -0,0 +1,303 @@
+"""
+Uploaded image processing: size variants, and background compression (IMAGE_ASYNC).
+
+Every stored upload gets downscaled copies bounded by IMAGE_VARIANT_SIZES,
+recorded on the row as {size: storage name} (picture_variants /
+image_variants) so clients can fetch the smallest one that fits. Each
+stored file also gets AVIF/WebP siblings (`<name>.avif`, `<name>.webp`,
+kept only when smaller) that serve_image picks by the Accept header.
+
+Saving a User/Post/Message with a new upload queues an ImageJob, so the
+request does not build variants or encodings. Inline, the image itself is
+compressed before the row is saved and the job builds the rest; with
+IMAGE_ASYNC the raw file is stored under staging/ and the request returns
+without decoding the image at all. Once the row is committed the job runs on this
+process's pool of IMAGE_WORKERS threads (Pillow releases the GIL while
+resizing and encoding); `manage.py image_worker` drains whatever is left,
+e.g. jobs from a process that stopped, or all of them with IMAGE_WORKERS=0.
+
+A job compresses the staged file exactly as the inline path does, swaps the
+result in for the staged name (unless the row has a newer upload by then),
+records its variants, deletes the staged file and sends an `image_ready` WebSocket event: to the
+owner's notification group for profile and post pictures, to the
+conversation for message images. Workers claim a job with a conditional
+UPDATE and do the image work outside any transaction; only the swap runs in
+one. Files written for a job that fails or loses the swap are deleted.
+
+Events sent from `image_worker` (a separate process) only reach WebSocket
+clients over a shared channel layer, i.e. with REDIS_URL set.
+"""
+import datetime
+import logging
+import mimetypes
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from PIL import Image
+
+try:
+    import pillow_avif  # noqa: F401  (registers the AVIF encoder on Pillow < 11.3)
+except ImportError:
+    pillow_avif = None
+
+from .models import IMAGE_SPECS, ImageJob, Message, Post, User, compress_image, touch_post
+from .websocket_utils import send_image_ready
+
+TARGETS = {
+    'user': (User, 'picture'),
+    'post': (Post, 'picture'),
+    'message': (Message, 'image'),
+}
+
+# Pillow format name and MIME type of each alternative encoding
+MODERN_FORMATS = {
+    'avif': ('AVIF', 'image/avif'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+_executor = {'pool': None}
+_lock = threading.Lock()
+
+
+def variant_name(name, size):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}_{size}w{ext}'
+
+
+def preferred_formats():
+    return [fmt for fmt in getattr(settings, 'IMAGE_MODERN_FORMATS', ['avif', 'webp']) if fmt in MODERN_FORMATS]
+
+
+def encodable_formats():
+    """preferred_formats() that this Pillow build can write"""
+    Image.init()
+    return [fmt for fmt in preferred_formats() if MODERN_FORMATS[fmt][0] in Image.SAVE]
+
+
+def encoded_name(name, fmt):
+    return f'{name}.{fmt}'
+
+
+def encode_image(img, fmt):
+    output = BytesIO()
+    quality = getattr(settings, 'IMAGE_MODERN_QUALITY', {}).get(fmt, 75)
+    img.save(output, format=MODERN_FORMATS[fmt][0], quality=quality)
+    return output.getvalue()
+
+
+def encode_modern(name, write=True):
+    """
+    Encode stored image `name` in each encodable format; returns {format: bytes}.
+
+    Only encodings smaller than the original are written next to it (a
+    small PNG can grow as WebP), replacing any earlier ones.
+    """
+    original_size = default_storage.size(name)
+    with default_storage.open(name) as f:
+        img = Image.open(f)
+        img.load()
+    sizes = {}
+    for fmt in encodable_formats():
+        data = encode_image(img, fmt)
+        sizes[fmt] = len(data)
+        if write and len(data) < original_size:
+            target = encoded_name(name, fmt)
+            if default_storage.exists(target):
+                default_storage.delete(target)
+            default_storage.save(target, ContentFile(data))
+    return sizes
+
+
+def parse_accept(accept):
+    """{media type: q} from an Accept header"""
+    accepted = {}
+    for part in accept.split(','):
+        media_type, _, params = part.strip().partition(';')
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        try:
+            accepted[media_type.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    return accepted
+
+
+def negotiate(path, accept):
+    """
+    (path, content type) of the best stored encoding of image file `path` for an Accept header.
+
+    Modern formats need to be named explicitly: `image/*` and `*/*` are
+    sent by browsers that cannot decode them.
+    """
+    accepted = parse_accept(accept)
+    for fmt in preferred_formats():
+        mime_type = MODERN_FORMATS[fmt][1]
+        if accepted.get(mime_type, 0) > 0 and os.path.exists(encoded_name(path, fmt)):
+            return encoded_name(path, fmt), mime_type
+    return path, mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def build_variants(name, quality=80):
+    """
+    Store a copy of image `name` scaled to fit each IMAGE_VARIANT_SIZES bound.
+
+    Returns {str(size): storage name}. Bounds the image already fits map to
+    the image itself. Each copy is scaled from the next larger one, and JPEGs
+    are decoded at reduced scale, so the work shrinks with every size. The
+    image and its copies then get their modern-format siblings.
+    """
+    sizes = sorted(getattr(settings, 'IMAGE_VARIANT_SIZES', (64, 160, 480, 1200)), reverse=True)
+    with default_storage.open(name) as f:
+        img = Image.open(f)
+        image_format = img.format or 'JPEG'
+        smaller = [size for size in sizes if size < max(img.size)]
+        if smaller:
+            img.draft(img.mode, (smaller[0], smaller[0]))  # No-op for anything but JPEG
+        img.load()
+
+    variants = {}
+    try:
+        for size in sizes:
+            if size not in smaller:
+                variants[str(size)] = name
+                continue
+            img = img.copy()
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+            output = BytesIO()
+            if image_format == 'PNG':
+                img.save(output, format='PNG', optimize=True)
+            else:
+                img.convert('RGB').save(output, format='JPEG', quality=quality, optimize=True)
+            variants[str(size)] = default_storage.save(variant_name(name, size), ContentFile(output.getvalue()))
+        for stored in {name, *variants.values()}:
+            encode_modern(stored)
+    except Exception:
+        # No half-built set is left behind; the image itself is the caller's
+        delete_outputs(set(variants.values()) - {name})
+        raise
+    return dict(sorted(variants.items(), key=lambda item: int(item[0])))
+
+
+def get_executor():
+    workers = getattr(settings, 'IMAGE_WORKERS', 2)
+    if workers <= 0:
+        return None
+    with _lock:
+        if _executor['pool'] is None:
+            _executor['pool'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        return _executor['pool']
+
+
+def submit(job_id):
+    """Run a job in the background if this process has image workers"""
+    executor = get_executor()
+    if executor is not None:
+        executor.submit(run_job, job_id)
+
+
+def run_job(job_id):
+    """process() with failures counted against the job instead of raised"""
+    try:
+        return process(job_id)
+    except Exception:
+        logging.exception(f"Image job {job_id} failed")
+        ImageJob.objects.filter(id=job_id).update(attempts=F('attempts') + 1, claimed_at=None)
+        return False
+    finally:
+        close_old_connections()
+
+
+def event_target(kind, instance):
+    if kind == 'message':
+        return f'conversation_{instance.conversation_id}'
+    return f'notifications_{instance.pk if kind == "user" else instance.user_id}'
+
+
+def unclaimed():
+    """Q for jobs no worker holds: never claimed, or claimed longer than IMAGE_JOB_TIMEOUT ago"""
+    stale = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'IMAGE_JOB_TIMEOUT', 300))
+    return Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)
+
+
+def claim(job_id):
+    """Take a job for this worker; False if it is gone or another worker holds it"""
+    # A single conditional UPDATE, so no lock is held while the image is processed
+    return bool(ImageJob.objects.filter(unclaimed(), id=job_id).update(claimed_at=timezone.now()))
+
+
+def delete_outputs(names):
+    """Delete stored files and their modern-format siblings"""
+    for name in names:
+        for candidate in [name] + [encoded_name(name, fmt) for fmt in MODERN_FORMATS]:
+            if default_storage.exists(candidate):
+                default_storage.delete(candidate)
+
+
+def process(job_id):
+    """Compress one staged upload and swap it in; False if there was nothing to do"""
+    if not claim(job_id):
+        return False
+    job = ImageJob.objects.get(id=job_id)
+    model, field_name = TARGETS[job.kind]
+    instance = model.objects.filter(pk=job.object_id).first()
+    if instance is None or getattr(instance, field_name).name != job.staged_name:
+        # Deleted, or replaced by a newer upload, since it was queued
+        job.delete()
+        if not job.compressed:
+            default_storage.delete(job.staged_name)
+        return False
+
+    # Decoding and encoding happen outside any transaction; files written are removed if the swap does not happen
+    written = []
+    try:
+        if job.compressed:
+            final_name = job.staged_name
+        else:
+            with default_storage.open(job.staged_name) as raw:
+                compressed = compress_image(File(raw, name=job.original_name), **IMAGE_SPECS[job.kind])
+                final_name = default_storage.save(
+                    getattr(instance, field_name).field.generate_filename(instance, compressed.name), compressed
+                )
+            written.append(final_name)
+        variants = build_variants(final_name, IMAGE_SPECS[job.kind]['quality'])
+        written += [name for name in variants.values() if name != job.staged_name]
+
+        updates = {field_name: final_name, f'{field_name}_variants': variants, 'updated_at': timezone.now()}
+        if job.kind != 'message':
+            updates['picture_path'] = default_storage.url(final_name)
+        with transaction.atomic():
+            # Conditional on the staged name, so an upload that arrived meanwhile is not overwritten
+            swapped = model.objects.filter(pk=instance.pk, **{field_name: job.staged_name}).update(**updates)
+            if swapped and job.kind == 'post':
+                touch_post(instance.pk)
+            job.delete()
+    except Exception:
+        delete_outputs(set(written))
+        raise
+
+    if not job.compressed:
+        default_storage.delete(job.staged_name)
+    if not swapped:
+        delete_outputs(set(written))
+        return False
+    if not job.compressed:
+        # Inline uploads were shown at once; only staged ones change what clients display
+        send_image_ready(event_target(job.kind, instance), job.kind, instance.pk, default_storage.url(final_name))
+    return True
+
+
+def pending_jobs(limit):
+    """Ids of jobs that have not used up their IMAGE_MAX_ATTEMPTS, oldest first"""
+    return list(
+        ImageJob.objects.filter(unclaimed(), attempts__lt=getattr(settings, 'IMAGE_MAX_ATTEMPTS', 3))
+        .order_by('id').values_list('id', flat=True)[:limit]
+    )
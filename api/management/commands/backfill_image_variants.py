@@ -0,0 +1,56 @@
+import collections
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api import images
+from api.models import IMAGE_SPECS, STAGING_DIR, touch_post
+
+
+class Command(BaseCommand):
+    help = 'Build size variants for stored images that have none, and report their share of full-size bytes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Rebuild variants for every image')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Rows fetched per database round trip')
+
+    def handle(self, *args, **options):
+        built = missing = failed = 0
+        full_bytes = 0
+        variant_bytes = collections.Counter()
+        for kind, (model, field_name) in images.TARGETS.items():
+            rows = (
+                model.objects.exclude(**{f'{field_name}__isnull': True}).exclude(**{field_name: ''})
+                # Staged uploads get their variants from the image worker
+                .exclude(**{f'{field_name}__startswith': f'{STAGING_DIR}/'})
+            )
+            if not options['force']:
+                rows = rows.filter(**{f'{field_name}_variants': {}})
+            rows = rows.order_by('pk').values_list('pk', field_name, f'{field_name}_variants')
+            for pk, name, old_variants in rows.iterator(chunk_size=options['chunk_size']):
+                try:
+                    variants = images.build_variants(name, IMAGE_SPECS[kind]['quality'])
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                except Exception as e:
+                    self.stderr.write(f'{kind} {pk} ({name}): {e}')
+                    failed += 1
+                    continue
+                # updated_at as in images.process: author fragments and ETags key on it
+                model.objects.filter(pk=pk).update(**{f'{field_name}_variants': variants, 'updated_at': timezone.now()})
+                if kind == 'post':
+                    touch_post(pk)
+                # --force builds under new names; the previous set is no longer referenced
+                images.delete_outputs(set(old_variants.values()) - set(variants.values()) - {name})
+                built += 1
+                full_bytes += default_storage.size(name)
+                for size, variant in variants.items():
+                    variant_bytes[size] += default_storage.size(variant)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Built variants for {built} images ({missing} files missing, {failed} failed)'
+        ))
+        for size in sorted(variant_bytes, key=int):
+            self.stdout.write(f'  {size:>5}px: {variant_bytes[size] / full_bytes:6.1%} of full-size bytes')
@@ -0,0 +1,122 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.text import compress_string
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from api import fragment_cache
+from api.middleware import brotli
+from api.models import User, Post, Comment
+from api.renderers import FastJSONRenderer, orjson
+from rest_framework.renderers import JSONRenderer
+from api.views import PostViewSet
+
+BENCHMARK_ALIAS = 'benchmark_post_fragments'
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark PostViewSet.list rendering with a cold and a warm post fragment cache, '
+        'then JSON encoding time and compressed wire size of the page'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=50, help='Posts to seed')
+        parser.add_argument('--comments', type=int, default=5, help='Comments per seeded post')
+        parser.add_argument('--likers', type=int, default=20, help='Likers per seeded post')
+        parser.add_argument('--limit', type=int, default=10, help='Feed page size')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--query', default='', help='Extra query string, e.g. "likes=summary"')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data')
+
+    def seed(self, options):
+        users = [
+            User.objects.create_user(username=f'bench_feed_{i}', password='bench-feed')
+            for i in range(max(options['likers'], 1))
+        ]
+        for i in range(options['posts']):
+            post = Post.objects.create(user=users[i % len(users)], description=f'Benchmark post {i}')
+            post.likes.set(users[:options['likers']])
+            Comment.objects.bulk_create([
+                Comment(user=users[j % len(users)], post=post, comment=f'Benchmark comment {j}')
+                for j in range(options['comments'])
+            ])
+        Post.objects.filter(user__in=users).update(like_count=options['likers'], comment_count=options['comments'])
+        return users
+
+    def render_page(self, view, factory, path):
+        request = factory.get(path)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = view(request)
+            response.render()
+            elapsed = time.perf_counter() - started
+        return elapsed, len(queries), response
+
+    def measure(self, label, view, factory, path, iterations, clear):
+        timings, query_counts = [], []
+        fragment_cache.reset_stats()
+        for _ in range(iterations):
+            if clear:
+                fragment_cache.clear()
+            elapsed, queries, response = self.render_page(view, factory, path)
+            timings.append(elapsed)
+            query_counts.append(queries)
+        timings.sort()
+        stats = fragment_cache.get_stats()
+        self.stdout.write(
+            f'{label:>5}: median {timings[len(timings) // 2] * 1000:.1f}ms, '
+            f'p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.1f}ms, '
+            f'{sum(query_counts) / len(query_counts):.1f} queries/page, '
+            f'cache hits {stats["hits"]} misses {stats["misses"]} '
+            f'({stats["hit_rate"]:.0%}), {len(response.content)} bytes'
+        )
+        return timings[len(timings) // 2]
+
+    def measure_encoding(self, data, iterations):
+        renderers = [('json', JSONRenderer())]
+        if orjson:
+            renderers.append(('orjson', FastJSONRenderer()))
+        else:
+            self.stdout.write('orjson is not installed; FastJSONRenderer falls back to json')
+
+        body = None
+        for label, renderer in renderers:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                body = renderer.render(data, 'application/json')
+            elapsed = (time.perf_counter() - started) / iterations
+            self.stdout.write(f'{label:>7}: {elapsed * 1000:.2f}ms/page to encode')
+
+        sizes = [('identity', len(body)), ('gzip', len(compress_string(body)))]
+        if brotli:
+            sizes.append(('br', len(brotli.compress(body, quality=5))))
+        self.stdout.write('wire bytes: ' + ', '.join(f'{name} {size}' for name, size in sizes))
+
+    def handle(self, *args, **options):
+        users = self.seed(options) if options['posts'] else []
+        factory = APIRequestFactory()
+        view = PostViewSet.as_view({'get': 'list'})
+        path = f'/api/posts/?limit={options["limit"]}&{options["query"]}'
+
+        # The cold runs clear the fragment cache, so they get a private in-process one:
+        # clearing the configured alias would flush a shared Redis database
+        private_cache = override_settings(
+            CACHES={**settings.CACHES, BENCHMARK_ALIAS: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            POST_FRAGMENT_CACHE_ALIAS=BENCHMARK_ALIAS,
+        )
+        try:
+            with private_cache:
+                cold = self.measure('cold', view, factory, path, options['iterations'], clear=True)
+                self.render_page(view, factory, path)
+                warm = self.measure('warm', view, factory, path, options['iterations'], clear=False)
+                self.stdout.write(self.style.SUCCESS(f'Warm rendering is {cold / warm:.1f}x faster'))
+                _, _, response = self.render_page(view, factory, path)
+                self.measure_encoding(response.data, options['iterations'])
+        finally:
+            if users and not options['keep']:
+                User.objects.filter(id__in=[user.id for user in users]).delete()
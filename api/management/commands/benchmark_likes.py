@@ -0,0 +1,77 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+
+from api.models import User, Post, set_like, toggle_like
+
+
+class Command(BaseCommand):
+    help = 'Hammer a single post with concurrent like/unlike/toggle calls and check the counter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--iterations', type=int, default=50, help='Calls per thread')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark users and post')
+
+    def handle(self, *args, **options):
+        threads, iterations = options['threads'], options['iterations']
+        author = User.objects.create_user(username='bench_likes_author', password='bench-likes')
+        users = [
+            User.objects.create_user(username=f'bench_likes_{i}', password='bench-likes')
+            for i in range(threads)
+        ]
+        post = Post.objects.create(user=author, description='Like benchmark')
+        errors = []
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(user):
+            local = []
+            try:
+                for i in range(iterations):
+                    started = time.perf_counter()
+                    try:
+                        # Mix explicit verbs and toggles from every thread at once
+                        if i % 3 == 0:
+                            set_like(post, user, True)
+                        elif i % 3 == 1:
+                            set_like(post, user, False)
+                        else:
+                            toggle_like(post, user)
+                    except OperationalError as e:  # e.g. SQLite "database is locked"
+                        with lock:
+                            errors.append(str(e))
+                    local.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+                with lock:
+                    latencies.extend(local)
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(user,)) for user in users]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        post.refresh_from_db()
+        actual = post.likes.count()
+        latencies.sort()
+        p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+        self.stdout.write(f'{len(latencies)} calls from {threads} threads in {elapsed:.2f}s '
+                          f'({len(latencies) / elapsed:.0f} calls/s)')
+        self.stdout.write(f'latency p50={p(0.50):.1f}ms p95={p(0.95):.1f}ms p99={p(0.99):.1f}ms')
+        self.stdout.write(f'errors: {len(errors)}')
+        self.stdout.write(f'like_count={post.like_count} likes rows={actual}')
+        if post.like_count == actual:
+            self.stdout.write(self.style.SUCCESS('Counter matches the through table'))
+        else:
+            self.stdout.write(self.style.ERROR('Counter drifted from the through table'))
+
+        if not options['keep']:
+            post.delete()
+            User.objects.filter(id__in=[author.id] + [u.id for u in users]).delete()
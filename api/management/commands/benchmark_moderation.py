@@ -0,0 +1,89 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.moderation import local
+from api.moderation.batching import BatchingEngine
+from api.moderation.engine import TransformersEngine
+
+WORDS = (
+    'great day friends coffee weekend photo trip love happy new city music game '
+    'terrible awful hate stupid boring rain traffic work tired late meeting'
+).split()
+
+
+def synthetic_texts(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 60))) for _ in range(count)]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Measure moderation throughput and latency, with and without micro-batching, at several concurrency levels'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['infer', 'transformers'], default='transformers')
+        parser.add_argument('--concurrency', default='1,4,16,32', help='Comma-separated caller thread counts')
+        parser.add_argument('--requests', type=int, default=200, help='Texts per run')
+        parser.add_argument('--max-batch-size', type=int, default=16)
+        parser.add_argument('--max-wait-ms', type=float, default=5)
+
+    def run(self, engine, texts, concurrency, lock=None):
+        """Score texts from `concurrency` threads; returns (seconds, per-call latencies)"""
+        latencies = []
+        pending = list(texts)
+        pending_lock = threading.Lock()
+
+        def caller():
+            while True:
+                with pending_lock:
+                    if not pending:
+                        return
+                    text = pending.pop()
+                started = time.perf_counter()
+                if lock:
+                    with lock:
+                        engine.should_block_content(text)
+                else:
+                    engine.should_block_content(text)
+                latencies.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=caller) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started, sorted(latencies)
+
+    def report(self, label, concurrency, elapsed, latencies, batch_sizes=None):
+        line = (
+            f'{label:>9} c={concurrency:<3} {len(latencies) / elapsed:8.1f} items/s  '
+            f'p50 {percentile(latencies, 0.5) * 1000:7.1f}ms  p99 {percentile(latencies, 0.99) * 1000:7.1f}ms'
+        )
+        if batch_sizes:
+            line += f'  mean batch {sum(batch_sizes) / len(batch_sizes):.1f}'
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        engine = TransformersEngine() if options['engine'] == 'transformers' else local.load_infer()
+        self.stdout.write(f"Loaded {options['engine']} engine in {time.perf_counter() - started:.1f}s")
+        engine.should_block_content('warm up')
+
+        texts = synthetic_texts(options['requests'])
+        for concurrency in [int(value) for value in options['concurrency'].split(',')]:
+            # Baseline: one forward pass per call, serialized like the unbatched server
+            elapsed, latencies = self.run(engine, texts, concurrency, lock=threading.Lock())
+            self.report('unbatched', concurrency, elapsed, latencies)
+
+            batching = BatchingEngine(
+                engine, max_batch_size=options['max_batch_size'], max_wait=options['max_wait_ms'] / 1000
+            )
+            elapsed, latencies = self.run(batching, texts, concurrency)
+            self.report('batched', concurrency, elapsed, latencies, list(batching.batcher.batch_sizes))
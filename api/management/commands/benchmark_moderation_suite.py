@@ -0,0 +1,163 @@
+import datetime
+import json
+import platform
+import random
+import resource
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from api.models import Comment, Post
+from api.moderation import cache, local
+from api.moderation.engine import TransformersEngine
+
+from .benchmark_moderation import WORDS, percentile, synthetic_texts
+from .moderation_parity import DEFAULT_CORPUS
+
+MODES = ('fp32', 'int8', 'cached')
+
+
+def csv(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+
+def fixed_length_texts(count, words, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(words)) for _ in range(count)]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark moderation over synthetic and recorded text, by text length, batch size, torch threads '
+        'and model mode (fp32, int8, cached), with optional JSON output'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['infer', 'transformers'], default='transformers')
+        parser.add_argument('--modes', type=csv(str), default=list(MODES), help='Comma-separated: fp32,int8,cached')
+        parser.add_argument('--lengths', type=csv(int), default=[8, 32, 128], help='Synthetic text lengths in words')
+        parser.add_argument('--batch-sizes', type=csv(int), default=[1, 8, 32])
+        parser.add_argument('--threads', type=csv(int), default=[1, 4], help='torch intra-op thread counts')
+        parser.add_argument('--texts', type=int, default=64, help='Texts per synthetic corpus')
+        parser.add_argument('--recorded', default=DEFAULT_CORPUS, help='JSON lines with "text"; "" to skip')
+        parser.add_argument('--from-db', type=int, default=0, metavar='N', help='Also record the newest N posts and comments')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed passes per configuration')
+        parser.add_argument('--json', metavar='PATH', help='Write results as JSON ("-" for stdout)')
+
+    def corpora(self, options):
+        corpora = {f'synthetic-{words}w': fixed_length_texts(options['texts'], words) for words in options['lengths']}
+        recorded = []
+        if options['recorded']:
+            with open(options['recorded']) as f:
+                recorded += [json.loads(line)['text'] for line in f if line.strip()]
+        if options['from_db']:
+            recorded += [t for t in Post.objects.order_by('-id').values_list('description', flat=True)[:options['from_db']] if t.strip()]
+            recorded += list(Comment.objects.order_by('-id').values_list('comment', flat=True)[:options['from_db']])
+        if recorded:
+            corpora['recorded'] = recorded
+        if not corpora:
+            corpora['synthetic-mixed'] = synthetic_texts(options['texts'])
+        return corpora
+
+    def load(self, engine_name, mode):
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        if engine_name == 'infer':
+            engine = local.load_infer()
+        else:
+            engine = TransformersEngine(mode='int8' if mode == 'int8' else 'fp32')
+        return engine, time.perf_counter() - started, peak_rss_mb() - rss_before
+
+    def scorer(self, engine, mode):
+        batched = getattr(engine, 'should_block_content_batch', None)
+        if mode == 'cached':
+            return lambda batch: [cache.cached(engine.should_block_content, text) for text in batch]
+        if batched:
+            return batched
+        return lambda batch: [engine.should_block_content(text) for text in batch]
+
+    def measure(self, score, texts, batch_size, repeat):
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        score(batches[0])  # Warm up
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for batch in batches:
+                batch_started = time.perf_counter()
+                score(batch)
+                latencies.append(time.perf_counter() - batch_started)
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'items_per_s': len(texts) * repeat / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+    # Benchmark verdicts (any engine, any mode) must not reach the shared cache the web workers read
+    @override_settings(MODERATION_CACHE_ALIAS=None)
+    def handle(self, *args, **options):
+        import torch
+
+        unknown = set(options['modes']) - set(MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes {sorted(unknown)}; expected some of {MODES}")
+        corpora = self.corpora(options)
+        original_threads = torch.get_num_threads()
+        results, loads = [], {}
+
+        for mode in options['modes']:
+            if options['engine'] == 'infer' and mode == 'int8':
+                self.stdout.write(self.style.WARNING('Skipping int8: infer.py only runs fp32'))
+                continue
+            # int8 and cached share nothing with fp32, so each mode gets a fresh engine
+            engine, load_s, load_rss = self.load(options['engine'], mode)
+            loads[mode] = {'load_s': load_s, 'load_rss_mb': load_rss}
+            self.stdout.write(f'{mode}: loaded in {load_s:.2f}s, RSS +{load_rss:.0f}MB')
+            score = self.scorer(engine, mode)
+
+            for threads in options['threads']:
+                torch.set_num_threads(threads)
+                for corpus, texts in corpora.items():
+                    for batch_size in options['batch_sizes']:
+                        if mode == 'cached':
+                            cache.clear()
+                            score(texts)  # Every timed lookup is then a hit
+                        row = {
+                            'mode': mode, 'threads': threads, 'corpus': corpus, 'batch_size': batch_size,
+                            'mean_words': sum(len(t.split()) for t in texts) / len(texts),
+                            **self.measure(score, texts, batch_size, options['repeat']),
+                            'peak_rss_mb': peak_rss_mb(),
+                        }
+                        results.append(row)
+                        self.stdout.write(
+                            f"  t={threads:<2} {corpus:>16} b={batch_size:<3} {row['items_per_s']:9.1f} items/s  "
+                            f"p50 {row['p50_ms']:8.2f}ms  p95 {row['p95_ms']:8.2f}ms  p99 {row['p99_ms']:8.2f}ms  "
+                            f"peak RSS {row['peak_rss_mb']:.0f}MB"
+                        )
+            del engine
+        torch.set_num_threads(original_threads)
+
+        if options['json']:
+            report = {
+                'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'engine': options['engine'],
+                'model_version': cache.compute_model_version(),
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'machine': platform.machine(),
+                'loads': loads,
+                'results': results,
+            }
+            if options['json'] == '-':
+                self.stdout.write(json.dumps(report, indent=2))
+            else:
+                with open(options['json'], 'w') as f:
+                    json.dump(report, f, indent=2)
+                self.stdout.write(f"Wrote {len(results)} results to {options['json']}")
@@ -0,0 +1,67 @@
+import collections
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from api import images
+from api.models import STAGING_DIR
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def stored_images(directory=''):
+    """Names of the JPEG/PNG files in storage, skipping staged uploads"""
+    dirs, files = default_storage.listdir(directory)
+    for name in sorted(files):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            yield os.path.join(directory, name) if directory else name
+    for sub in sorted(dirs):
+        if not (directory == '' and sub == STAGING_DIR):
+            yield from stored_images(os.path.join(directory, sub) if directory else sub)
+
+
+class Command(BaseCommand):
+    help = 'Write AVIF/WebP siblings for stored images and report per-format size savings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report-only', action='store_true', help='Measure the savings without writing files')
+        parser.add_argument('--force', action='store_true', help='Re-encode images that already have siblings')
+
+    def handle(self, *args, **options):
+        formats = images.encodable_formats()
+        if not formats:
+            self.stderr.write('This Pillow build cannot write any of IMAGE_MODERN_FORMATS')
+            return
+        originals = 0
+        count = collections.Counter()
+        original_bytes = collections.Counter()
+        encoded_bytes = collections.Counter()
+        kept = collections.Counter()
+        for name in stored_images():
+            done = all(default_storage.exists(images.encoded_name(name, fmt)) for fmt in formats)
+            if done and not options['force'] and not options['report_only']:
+                continue
+            try:
+                sizes = images.encode_modern(name, write=not options['report_only'])
+            except Exception as e:
+                self.stderr.write(f'{name}: {e}')
+                continue
+            originals += 1
+            size = default_storage.size(name)
+            for fmt, encoded in sizes.items():
+                count[fmt] += 1
+                original_bytes[fmt] += size
+                # What serving costs: the sibling if it is kept, else the original
+                encoded_bytes[fmt] += min(encoded, size)
+                kept[fmt] += encoded < size
+
+        self.stdout.write(f"{'Measured' if options['report_only'] else 'Encoded'} {originals} images")
+        for fmt in formats:
+            if not count[fmt]:
+                continue
+            saving = 1 - encoded_bytes[fmt] / original_bytes[fmt]
+            self.stdout.write(
+                f'  {fmt:>4}: {original_bytes[fmt] / 2 ** 20:8.2f}MB -> {encoded_bytes[fmt] / 2 ** 20:8.2f}MB '
+                f'({saving:.1%} smaller; sibling kept for {kept[fmt]}/{count[fmt]} images)'
+            )
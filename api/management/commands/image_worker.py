@@ -0,0 +1,36 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from api import images
+from api.websocket_utils import channel_layer_is_shared
+
+
+class Command(BaseCommand):
+    help = 'Process queued image uploads: compress staged ones (IMAGE_ASYNC) and build variants for all'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--threads', type=int, default=2, help='Images processed concurrently (1 runs them in this thread)')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+
+    def handle(self, *args, **options):
+        if not channel_layer_is_shared():
+            self.stderr.write(self.style.ERROR(
+                'CHANNEL_LAYERS is the in-memory layer: image_ready events from this process '
+                'will not reach WebSocket clients. Set REDIS_URL.'
+            ))
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            run = pool.map if options['threads'] > 1 else map
+            while True:
+                job_ids = images.pending_jobs(options['batch_size'])
+                done = sum(run(images.run_job, job_ids))
+                if done:
+                    self.stdout.write(f'Processed {done} images')
+                elif options['once'] and not job_ids:
+                    return
+                else:
+                    # Empty queue, or only jobs another worker holds or that keep failing
+                    time.sleep(options['interval'])
@@ -0,0 +1,79 @@
+import io
+import json
+import os
+import resource
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.moderation.engine import TransformersEngine
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'moderation', 'parity_corpus.jsonl')
+
+
+def model_bytes(engine):
+    import torch
+    total = 0
+    for _, model in engine.models.values():
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        total += buffer.tell()
+    return total
+
+
+class Command(BaseCommand):
+    help = 'Compare int8 against fp32 moderation: block/allow agreement, score drift, accuracy, latency and memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='JSON lines with "text" and optional "block" label')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed passes over the corpus')
+
+    def evaluate(self, mode, texts, repeat):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        engine = TransformersEngine(mode=mode)
+        load_time = time.perf_counter() - started
+
+        verdicts = [engine.should_block_content(text) for text in texts]  # also warms up
+        latencies = []
+        for _ in range(repeat):
+            for text in texts:
+                started = time.perf_counter()
+                engine.should_block_content(text)
+                latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return verdicts, {
+            'load_s': load_time,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+            'model_mb': model_bytes(engine) / 2 ** 20,
+            'peak_rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        }
+
+    def handle(self, *args, **options):
+        with open(options['corpus']) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        texts = [row['text'] for row in rows]
+
+        # int8 first: peak RSS only grows, so measuring it after fp32 would hide its footprint
+        int8, int8_stats = self.evaluate('int8', texts, options['repeat'])
+        fp32, fp32_stats = self.evaluate('fp32', texts, options['repeat'])
+
+        for mode, verdicts, stats in (('fp32', fp32, fp32_stats), ('int8', int8, int8_stats)):
+            labelled = [(v[0], row['block']) for v, row in zip(verdicts, rows) if 'block' in row]
+            accuracy = sum(p == y for p, y in labelled) / len(labelled) if labelled else float('nan')
+            self.stdout.write(
+                f"{mode}: accuracy {accuracy:.1%}, p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, "
+                f"load {stats['load_s']:.1f}s, weights {stats['model_mb']:.1f}MB, "
+                f"peak RSS +{stats['peak_rss_growth_mb']:.0f}MB"
+            )
+
+        agreement = sum(a[0] == b[0] for a, b in zip(fp32, int8)) / len(texts)
+        drift = [abs(a[2]['confidence'] - b[2]['confidence']) for a, b in zip(fp32, int8)]
+        self.stdout.write(
+            f'Decision agreement {agreement:.1%} over {len(texts)} texts; '
+            f'confidence drift mean {sum(drift) / len(drift):.4f}, max {max(drift):.4f}'
+        )
+        for row, a, b in zip(rows, fp32, int8):
+            if a[0] != b[0]:
+                self.stdout.write(self.style.WARNING(f"  disagree (fp32={a[0]}, int8={b[0]}): {row['text'][:80]}"))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.moderation import publishing
+from api.websocket_utils import channel_layer_is_shared
+
+
+class Command(BaseCommand):
+    help = 'Score pending posts and comments (MODERATION_ASYNC) and publish or reject them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--threads', type=int, default=4, help='Concurrent moderation calls per batch')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+
+    def handle(self, *args, **options):
+        if not channel_layer_is_shared():
+            self.stderr.write(self.style.ERROR(
+                'CHANNEL_LAYERS is the in-memory layer: published/rejected notifications from this process '
+                'will not reach WebSocket clients. Set REDIS_URL.'
+            ))
+        while True:
+            published, rejected = publishing.process_pending(options['batch_size'], options['threads'])
+            if published or rejected:
+                self.stdout.write(f'Published {published}, rejected {rejected}')
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.moderation import quantization
+
+
+class Command(BaseCommand):
+    help = 'Build the int8 dynamic-quantized moderation models used by MODERATION_MODEL_MODE=int8'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--out-dir', help='Defaults to MODERATION_QUANTIZED_DIR')
+
+    def handle(self, *args, **options):
+        for name in ('sentiment', 'toxic'):
+            path = quantization.save_quantized(name, out_dir=options['out_dir'])
+            self.stdout.write(self.style.SUCCESS(f'Wrote {path}'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Post, TimelineEntry
+from api import timeline
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized home timelines from existing posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--clear', action='store_true', help='Delete all timeline entries first')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted, _ = TimelineEntry.objects.all().delete()
+            self.stdout.write(f'Deleted {deleted} timeline entries')
+
+        # Only published posts belong in timelines; fan_out_post keeps high_fanout authors pulled
+        posts = Post.objects.filter(moderation_status=Post.PUBLISHED).select_related('user').order_by('id')
+        count = 0
+        for post in posts.iterator(chunk_size=options['chunk_size']):
+            timeline.fan_out_post(post)
+            count += 1
+            if count % options['chunk_size'] == 0:
+                self.stdout.write(f'Fanned out {count} posts...')
+
+        self.stdout.write(self.style.SUCCESS(f'Fanned out {count} posts'))
@@ -0,0 +1,157 @@
+import collections
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Comment, Post
+from api.moderation import cache, publishing
+from api.moderation.engine import load_engine
+
+TARGETS = (('post', Post, 'description'), ('comment', Comment, 'comment'))
+
+_engine = None
+
+
+def init_worker(threads):
+    """Load the models once per worker process"""
+    global _engine
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    _engine = load_engine(batched=False)
+
+
+def score_batch(texts):
+    batched = getattr(_engine, 'should_block_content_batch', None)
+    if batched:
+        return [tuple(verdict) for verdict in batched(texts)]
+    return [tuple(_engine.should_block_content(text)) for text in texts]
+
+
+class InProcessPool:
+    """ProcessPoolExecutor stand-in for --workers 0"""
+
+    def __init__(self, threads):
+        init_worker(threads)
+
+    def submit(self, fn, *args):
+        return ImmediateResult(fn(*args))
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class ImmediateResult:
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class Command(BaseCommand):
+    help = 'Re-check existing posts and comments against the current moderation models, resumably'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Scoring processes (0 scores in this process)')
+        parser.add_argument('--threads-per-worker', type=int, default=1, help='torch intra-op threads per worker')
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per database round trip')
+        parser.add_argument('--max-rate', type=float, default=0, help='Rows per second cap (0 for no cap)')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'remoderation.checkpoint.json'))
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and rescan from the start')
+        parser.add_argument('--reject', action='store_true', help='Take down published rows the models now block')
+
+    def load_checkpoint(self, path, version, restart):
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('version') == version:
+                return checkpoint
+        return {'version': version, 'post': 0, 'comment': 0}
+
+    def save_checkpoint(self, path, checkpoint):
+        # Write-then-rename so an interrupted run never leaves a torn file
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(path + '.tmp', path)
+
+    def batches(self, model, field, after, version, options):
+        rows = (
+            model.objects.filter(id__gt=after).exclude(moderation_version=version)
+            .order_by('id').values_list('id', field).iterator(chunk_size=options['chunk_size'])
+        )
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= options['batch_size']:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def store(self, model, rows, verdicts, version, reject):
+        by_id = {pk: verdict for (pk, _), verdict in zip(rows, verdicts)}
+        updated = [model(id=pk, **model.verdict_fields(verdict, version)) for pk, verdict in by_id.items()]
+        model.objects.bulk_update(updated, ['moderation_verdict', 'moderation_version'])
+        if not reject:
+            return 0
+        blocked = [pk for pk, verdict in by_id.items() if verdict[0]]
+        taken_down = 0
+        for instance in model.objects.filter(id__in=blocked, moderation_status=model.PUBLISHED).select_related('user'):
+            with transaction.atomic():
+                publishing.retract(instance, by_id[instance.id][1])
+            taken_down += 1
+        return taken_down
+
+    def handle(self, *args, **options):
+        version = cache.get_model_version()
+        checkpoint = self.load_checkpoint(options['checkpoint'], version, options['restart'])
+        if options['workers'] > 0:
+            pool = ProcessPoolExecutor(
+                max_workers=options['workers'], initializer=init_worker, initargs=(options['threads_per_worker'],)
+            )
+        else:
+            pool = InProcessPool(options['threads_per_worker'])
+
+        # Keep every worker busy plus one batch queued; in-process scoring happens at submit, so one at a time
+        depth = options['workers'] + 1 if options['workers'] > 0 else 1
+        started = time.monotonic()
+        done = taken_down = 0
+        try:
+            for kind, model, field in TARGETS:
+                in_flight = collections.deque()
+                batches = self.batches(model, field, checkpoint[kind], version, options)
+                while True:
+                    # Results are stored in id order, so the checkpoint always marks a fully stored prefix
+                    while len(in_flight) < depth:
+                        batch = next(batches, None)
+                        if batch is None:
+                            break
+                        in_flight.append((batch, pool.submit(score_batch, [text or '' for _, text in batch])))
+                    if not in_flight:
+                        break
+                    rows, future = in_flight.popleft()
+                    taken_down += self.store(model, rows, future.result(), version, options['reject'])
+                    done += len(rows)
+                    checkpoint[kind] = rows[-1][0]
+                    self.save_checkpoint(options['checkpoint'], checkpoint)
+
+                    if options['max_rate'] > 0:
+                        ahead = done / options['max_rate'] - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                self.stdout.write(f'{kind}s: checked through id {checkpoint[kind]}')
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Re-moderated {done} rows in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.1f}/s) '
+            f'with model version {version}; {taken_down} taken down'
+        ))
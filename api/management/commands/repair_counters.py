@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from api.models import Post, Comment
+
+
+def count_of(queryset, field):
+    """Correlated COUNT(*) of `queryset` rows pointing at the outer row"""
+    counts = queryset.filter(**{field: OuterRef('pk')}).values(field).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts), Value(0))
+
+
+class Command(BaseCommand):
+    help = 'Recompute denormalized like/comment counters on posts and comments in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def repair(self, model, chunk_size, **counters):
+        last_id = model.objects.aggregate(last=Max('id'))['last'] or 0
+        updated = 0
+        for start in range(0, last_id + 1, chunk_size):
+            # Each chunk is its own short UPDATE so live traffic isn't blocked
+            updated += model.objects.filter(id__gte=start, id__lt=start + chunk_size).update(**counters)
+        self.stdout.write(f'{model.__name__}: recomputed counters on {updated} rows')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        self.repair(
+            Post, chunk_size,
+            like_count=count_of(Post.likes.through.objects.all(), 'post'),
+            comment_count=count_of(Comment.objects.filter(moderation_status=Comment.PUBLISHED), 'post'),
+        )
+        self.repair(
+            Comment, chunk_size,
+            like_count=count_of(Comment.likes.through.objects.all(), 'comment'),
+        )
+        self.stdout.write(self.style.SUCCESS('Counters repaired'))
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.moderation.engine import load_engine
+from api.moderation.server import make_server
+
+
+class Command(BaseCommand):
+    help = 'Load the moderation models once and serve should_block_content to the web workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--address',
+            default=getattr(settings, 'MODERATION_ADDRESS', '127.0.0.1:8765'),
+            help="'unix:/path/to.sock' or 'host:port' (default: MODERATION_ADDRESS)"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Loading moderation models...')
+        engine = load_engine()
+        # Warm up so the first real request does not pay for lazy initialisation;
+        # this goes to the model directly, as it may take longer than MODERATION_TIMEOUT
+        getattr(engine, 'engine', engine).should_block_content('hello')
+
+        server = make_server(options['address'], engine)
+        self.stdout.write(self.style.SUCCESS(f"Moderation server listening on {options['address']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,73 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import moderation
+from api.models import Comment, Post
+from api.moderation import prefilter
+
+from .moderation_parity import DEFAULT_CORPUS
+
+
+class Command(BaseCommand):
+    help = 'Train the hashed n-gram pre-filter and report per-tier hit rates and agreement with the full models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', action='append', help=f'JSON lines with "text" and "block" (default {DEFAULT_CORPUS})')
+        parser.add_argument('--from-db', type=int, default=0, metavar='N', help='Also use the newest N posts and N comments')
+        parser.add_argument('--label-with-model', action='store_true', help='Label every text with the full models')
+        parser.add_argument('--holdout', type=float, default=0.2, help='Share of texts kept out of training for the report')
+        parser.add_argument('--epochs', type=int, default=20)
+        parser.add_argument('--out', default=settings.MODERATION_PREFILTER_MODEL)
+
+    def load_texts(self, options):
+        rows = []
+        for path in options['corpus'] or ([] if options['from_db'] else [DEFAULT_CORPUS]):
+            with open(path) as f:
+                rows += [json.loads(line) for line in f if line.strip()]
+        if options['from_db']:
+            rows += [{'text': text} for text in Post.objects.order_by('-id').values_list('description', flat=True)[:options['from_db']] if text.strip()]
+            rows += [{'text': text} for text in Comment.objects.order_by('-id').values_list('comment', flat=True)[:options['from_db']]]
+
+        if options['label_with_model']:
+            for row in rows:
+                # The models themselves, not the cascade the new model is about to join
+                row['block'] = bool(moderation._check_models(row['text'])[0])
+        missing = sum('block' not in row for row in rows)
+        if missing:
+            raise CommandError(f'{missing} texts have no "block" label; pass --label-with-model')
+        return rows
+
+    def handle(self, *args, **options):
+        rows = self.load_texts(options)
+        random.Random(0).shuffle(rows)
+        split = len(rows) - int(len(rows) * options['holdout'])
+        train, test = rows[:split], rows[split:] or rows
+
+        model = prefilter.LinearModel().fit(
+            [(prefilter.tokens(row['text']), row['block']) for row in train], epochs=options['epochs']
+        )
+        model.save(options['out'])
+        self.stdout.write(f"Trained on {len(train)} texts ({sum(r['block'] for r in train)} blocked), saved to {options['out']}")
+
+        blocklist, allowlist, _ = prefilter.load_tiers()
+        hits = {tier: 0 for tier in prefilter.TIERS}
+        agreed = {tier: 0 for tier in prefilter.TIERS}
+        for row in test:
+            tier, verdict = prefilter.classify(row['text'], (blocklist, allowlist, model))
+            tier = tier or 'model'
+            hits[tier] += 1
+            agreed[tier] += tier == 'model' or verdict[0] == row['block']
+
+        self.stdout.write(f'Held-out report over {len(test)} texts:')
+        for tier in prefilter.TIERS:
+            agreement = f'{agreed[tier] / hits[tier]:.1%} agreement' if hits[tier] and tier != 'model' else ''
+            self.stdout.write(f'  {tier:>8}: {hits[tier] / len(test):6.1%} of texts  {agreement}')
+        skipped = (hits['lexical'] + hits['linear']) / len(test)
+        cap = settings.MODERATION_PREFILTER_MAX_SKIP
+        if skipped > cap:
+            self.stdout.write(self.style.WARNING(
+                f'{skipped:.1%} would skip the models; MODERATION_PREFILTER_MAX_SKIP caps that at {cap:.0%}'
+            ))
@@ -0,0 +1,139 @@
+"""
+Streaming file responses with validators, caching headers and byte ranges.
+
+Files are never read into memory. A full response is a FileResponse, which
+WSGI servers with wsgi.file_wrapper send with sendfile(); a range streams in
+CHUNK_SIZE pieces. With IMAGE_SENDFILE the body is left to the front server
+altogether: 'x-accel-redirect' points nginx at the file under its internal
+IMAGE_SENDFILE_PREFIX location, 'x-sendfile' hands Apache/lighttpd the path.
+
+Validators come from the file's stat, as nginx computes them, so the ETag
+changes whenever a file is rewritten. Callers pick the caching policy: long
+and immutable for content that never changes under its URL, a shorter
+max-age followed by revalidation for anything else.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """
+    Inclusive (start, end) for a single-range Range header.
+
+    None means send the whole file (no header, a malformed one, or several
+    ranges, which servers may ignore); False means it cannot be satisfied.
+    """
+    match = _RANGE.match(header.replace(' ', ''))
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        return (max(size - length, 0), size - 1) if length and size else False
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def if_range_matches(request, etag, last_modified):
+    """False if If-Range names an older version, in which case the whole file is sent"""
+    value = request.META.get('HTTP_IF_RANGE')
+    if not value:
+        return True
+    if value.startswith('"'):
+        return value == etag
+    if value.startswith('W/'):
+        return False
+    return parse_http_date_safe(value) == last_modified
+
+
+def stream_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def offload_response(path, content_type):
+    mode = getattr(settings, 'IMAGE_SENDFILE', '')
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-accel-redirect':
+        name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = getattr(settings, 'IMAGE_SENDFILE_PREFIX', '/protected-assets/') + quote(name)
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def body_response(request, path, stat, content_type, etag):
+    if getattr(settings, 'IMAGE_SENDFILE', ''):
+        # The front server handles Range itself
+        return offload_response(path, content_type)
+
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and if_range_matches(request, etag, int(stat.st_mtime)):
+        byte_range = parse_range(request.META['HTTP_RANGE'], stat.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(stream_range(path, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(end - start + 1)
+        return response
+
+    response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response.block_size = CHUNK_SIZE
+    return response
+
+
+def file_response(request, path, content_type, immutable=False, max_age=None):
+    """
+    Response for the file at `path`: 304/412 from its validators, else the (partial) body.
+
+    Cached for IMAGE_CACHE_MAX_AGE if `immutable`, else for `max_age`
+    seconds, else revalidated on every use.
+    """
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = body_response(request, path, stat, content_type, etag)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    if immutable:
+        patch_cache_control(
+            response, public=True, max_age=getattr(settings, 'IMAGE_CACHE_MAX_AGE', 31536000), immutable=True
+        )
+    elif max_age:
+        patch_cache_control(response, public=True, max_age=max_age)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
@@ -0,0 +1,104 @@
+"""
+Negotiated response compression.
+
+Like django.middleware.gzip.GZipMiddleware, but prefers brotli when the
+client accepts it and the `brotli` package is installed, only compresses
+textual content types, and skips bodies under COMPRESSION_MIN_SIZE bytes
+where the encoding overhead is not worth it.
+"""
+import re
+import secrets
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+
+def compress_brotli(content, quality, max_random_bytes):
+    """
+    brotli.compress() with a metadata block of random length up front.
+
+    The BREACH mitigation GZipMiddleware gets from a random gzip filename:
+    decoders skip metadata blocks (RFC 7932, 9.2), so only the length of
+    the response varies. The leading flush byte-aligns the stream for it.
+    """
+    compressor = brotli.Compressor(quality=quality)
+    padding = secrets.randbelow(max_random_bytes) + 1
+    # ISLAST=0, MNIBBLES=0 (metadata), MSKIPBYTES=1, then MSKIPLEN-1, little-endian
+    header = (0b010110 | (padding - 1) << 6).to_bytes(2, 'little')
+    return (
+        compressor.process(b'') + compressor.flush()
+        + header + secrets.token_bytes(padding)
+        + compressor.process(content) + compressor.finish()
+    )
+
+
+def choose_encoding(accept_encoding, allow_brotli=True):
+    """Pick 'br', 'gzip' or None from an Accept-Encoding header, honouring q=0"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        try:
+            accepted[name.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    wildcard = accepted.get('*', 0)
+    for encoding in ('br', 'gzip') if brotli and allow_brotli else ('gzip',):
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    # Random filename padding in the gzip header, as in GZipMiddleware, and a random
+    # metadata block in brotli (BREACH mitigation)
+    max_random_bytes = 100
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or request.method == 'HEAD' or getattr(response, 'is_async', False):
+            return response
+        if not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return response
+        if not response.streaming and len(response.content) < getattr(settings, 'COMPRESSION_MIN_SIZE', 1024):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        # Streams are gzipped chunk by chunk; brotli is only used for whole bodies
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), allow_brotli=not response.streaming)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_sequence(
+                response.streaming_content, max_random_bytes=self.max_random_bytes
+            )
+            del response.headers['Content-Length']
+        else:
+            if encoding == 'br':
+                quality = getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 5)
+                compressed = compress_brotli(response.content, quality, self.max_random_bytes)
+            else:
+                compressed = compress_string(response.content, max_random_bytes=self.max_random_bytes)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The representation differs from the uncompressed one, so the ETag becomes weak
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:45
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_of(queryset, field):
+    counts = queryset.filter(**{field: OuterRef('pk')}).values(field).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts), Value(0))
+
+
+def populate_counters(apps, schema_editor):
+    Post = apps.get_model('api', 'Post')
+    Comment = apps.get_model('api', 'Comment')
+    Post.objects.update(
+        like_count=count_of(Post.likes.through.objects.all(), 'post'),
+        comment_count=count_of(Comment.objects.all(), 'post'),
+    )
+    Comment.objects.update(like_count=count_of(Comment.likes.through.objects.all(), 'comment'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_timelineentry_post_fanned_out'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
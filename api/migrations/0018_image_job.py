@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_moderation_verdict'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user', 'Profile picture'), ('post', 'Post picture'), ('message', 'Message image')], max_length=10)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('staged_name', models.CharField(max_length=255)),
+                ('original_name', models.CharField(max_length=255)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
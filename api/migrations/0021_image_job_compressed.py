@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_image_job_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagejob',
+            name='compressed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
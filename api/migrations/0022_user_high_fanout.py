@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-17 08:54
+
+from django.db import migrations, models
+
+
+def flag_pulled_authors(apps, schema_editor):
+    User = apps.get_model('api', 'User')
+    Post = apps.get_model('api', 'Post')
+    User.objects.filter(id__in=Post.objects.filter(fanned_out=False).values('user_id')).update(high_fanout=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_image_job_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='high_fanout',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(flag_pulled_authors, migrations.RunPython.noop),
+    ]
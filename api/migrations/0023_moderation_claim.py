@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_user_high_fanout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='moderation_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='moderation_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
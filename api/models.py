@@ -1,5 +1,10 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.conf import settings
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
 from PIL import Image
 from io import BytesIO
 from django.core.files.base import ContentFile
@@ -67,6 +72,128 @@ def compress_image(image_field, quality=85, max_width=1200, max_height=1200):
         print(f"Image compression failed: {e}")
         return image_field
 
+# Target size and JPEG quality of each kind of uploaded image
+IMAGE_SPECS = {
+    'user': {'quality': 85, 'max_width': 800, 'max_height': 800},
+    'post': {'quality': 80, 'max_width': 1200, 'max_height': 1200},
+    'message': {'quality': 80, 'max_width': 1200, 'max_height': 1200},
+}
+STAGING_DIR = 'staging'
+
+def prepare_upload(instance, field_name, kind):
+    """
+    Handle a newly assigned upload before the row is saved.
+
+    Inline, the image is compressed in place. With IMAGE_ASYNC the raw file
+    is stored under staging/ as-is. Returns None if there is no new upload,
+    else (staged name or None, original name) for finish_upload.
+    """
+    field_file = getattr(instance, field_name)
+    if not field_file or field_file._committed:
+        return None
+    if not getattr(settings, 'IMAGE_ASYNC', False):
+        print(f"Compressing {kind} image...")
+        compressed_image = compress_image(field_file, **IMAGE_SPECS[kind])
+        if compressed_image:
+            setattr(instance, field_name, compressed_image)
+        return None, os.path.basename(field_file.name)
+
+    original_name = os.path.basename(field_file.name)
+    upload_name = field_file.field.generate_filename(instance, original_name)
+    staged_name = field_file.storage.save(f'{STAGING_DIR}/{upload_name}', field_file.file)
+    setattr(instance, field_name, staged_name)
+    return staged_name, original_name
+
+def finish_upload(instance, field_name, kind, upload):
+    """
+    After the row is saved: queue the upload for the image workers.
+
+    A staged upload is compressed there; an inline-compressed one only gets
+    its variants and modern-format siblings built, which would otherwise
+    take several resizes and encodes on the request thread.
+    """
+    if upload is None:
+        return
+    staged_name, original_name = upload
+    if staged_name:
+        enqueue_image(instance, kind, staged_name, original_name)
+    else:
+        enqueue_image(instance, kind, getattr(instance, field_name).name, original_name, compressed=True)
+
+def enqueue_image(instance, kind, staged_name, original_name, compressed=False):
+    """Queue an upload for the image workers, starting one as soon as the row is committed"""
+    from . import images
+
+    job = ImageJob.objects.create(
+        kind=kind, object_id=instance.pk, staged_name=staged_name, original_name=original_name, compressed=compressed
+    )
+    transaction.on_commit(lambda: images.submit(job.id))
+
+# Columns that only ever move through F() updates (or the moderation worker); a
+# plain save() of a loaded instance must not write back its stale copy of them.
+CONCURRENT_FIELDS = ('like_count', 'comment_count', 'cache_version', 'fanned_out', 'moderation_status')
+
+def saveable_fields(instance):
+    """Concrete fields a save() of an existing row should write"""
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in CONCURRENT_FIELDS
+    ]
+
+def touch_post(post_id):
+    """Bump a post's cache_version so cached renderings of it are no longer used"""
+    Post.objects.filter(pk=post_id).update(cache_version=F('cache_version') + 1)
+
+def bump_counter(instance, field, delta):
+    """Atomically add `delta` to a stored counter and refresh it on the instance"""
+    rows = type(instance).objects.filter(pk=instance.pk)
+    if delta < 0:
+        # Never drive a drifted counter below zero
+        rows = rows.filter(**{f'{field}__gte': -delta})
+    updates = {field: F(field) + delta}
+    if isinstance(instance, Post):
+        updates['cache_version'] = F('cache_version') + 1
+    if rows.update(**updates) and isinstance(instance, Comment):
+        touch_post(instance.post_id)
+    instance.refresh_from_db(fields=list(updates))
+    return getattr(instance, field)
+
+def set_like(instance, user, liked):
+    """
+    Idempotently like or unlike a Post/Comment for `user`.
+
+    Works directly on the M2M through table: an indexed delete or an insert
+    guarded by its (object, user) unique constraint, so concurrent requests
+    can't double count. Returns True if the like state actually changed.
+    """
+    manager = instance.likes
+    lookup = {
+        f'{manager.source_field_name}_id': instance.pk,
+        f'{manager.target_field_name}_id': user.pk,
+    }
+    through = manager.through.objects
+
+    with transaction.atomic():
+        if liked:
+            try:
+                with transaction.atomic():
+                    through.create(**lookup)
+            except IntegrityError:
+                return False  # Already liked, possibly by a concurrent request
+            bump_counter(instance, 'like_count', 1)
+            return True
+
+        deleted, _ = through.filter(**lookup).delete()
+        if deleted:
+            bump_counter(instance, 'like_count', -1)
+        return bool(deleted)
+
+def toggle_like(instance, user):
+    """Flip the like state; returns (liked, changed)"""
+    if set_like(instance, user, False):
+        return False, True
+    return True, set_like(instance, user, True)
+
 def user_profile_path(instance, filename):
     # Save in public/assets like Express backend
     return f'{instance.username}_{filename}'
@@ -82,67 +209,178 @@ def message_image_path(instance, filename):
 class User(AbstractUser):
     picture = models.ImageField(upload_to=user_profile_path, blank=True, null=True)
     picture_path = models.CharField(max_length=255, blank=True, default="")  # Keep for compatibility
+    picture_variants = models.JSONField(default=dict, blank=True)  # {max side: storage name}
     friends = models.ManyToManyField("self", blank=True)
     viewed_profile = models.IntegerField(default=0)
     impressions = models.IntegerField(default=0)
     google_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     auth0_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
+    # Also bumped when the friend list changes (see touch_friends); used as a validator by api.conditional
+    updated_at = models.DateTimeField(auto_now=True)
+    # Set once a post of theirs was not fanned out; api.timeline pulls these authors at read time
+    high_fanout = models.BooleanField(default=False)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(fields=['email'], name='user_email_idx'),  # LoginView email logins
+        ]
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
 
     def save(self, *args, **kwargs):
-        # Compress profile picture before saving
-        if self.picture and hasattr(self.picture, 'file'):
-            # Check if this is a new upload
-            if not self.pk or (self.pk and self._state.adding):
-                print("Compressing profile picture...")
-                compressed_image = compress_image(self.picture, quality=85, max_width=800, max_height=800)
-                if compressed_image:
-                    self.picture = compressed_image
+        # Compress (or stage) a newly uploaded profile picture before saving
+        upload = prepare_upload(self, 'picture', 'user')
         
         # Update picture_path when picture is uploaded
         if self.picture:
             self.picture_path = self.picture.url
         super().save(*args, **kwargs)
+        finish_upload(self, 'picture', 'user', upload)
+
+@receiver(m2m_changed, sender=User.friends.through)
+def touch_friends(sender, instance, action, pk_set, **kwargs):
+    """Friend list changes alter both users' representations"""
+    if action in ('post_add', 'post_remove'):
+        user_ids = {instance.pk} | set(pk_set or ())
+    elif action == 'pre_clear':
+        user_ids = {instance.pk} | set(instance.friends.values_list('id', flat=True))
+    else:
+        return
+    User.objects.filter(pk__in=user_ids).update(updated_at=timezone.now())
+
+class ModeratedContent(models.Model):
+    """
+    Posts and comments are published immediately, or with MODERATION_ASYNC
+    saved as pending until the moderation worker publishes or rejects them.
+    The last verdict the models gave, and their version, are kept so that
+    `manage.py remoderate_content` can re-check rows after a model update.
+    """
+    PENDING = 'pending'
+    PUBLISHED = 'published'
+    REJECTED = 'rejected'
+
+    MODERATION_STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PUBLISHED, 'Published'),
+        (REJECTED, 'Rejected'),
+    ]
+
+    moderation_status = models.CharField(max_length=10, choices=MODERATION_STATUS_CHOICES, default=PUBLISHED)
+    moderation_verdict = models.JSONField(null=True, blank=True)
+    moderation_version = models.CharField(max_length=64, blank=True, default='')
+    # When a moderation worker took the pending row (see api.moderation.publishing.claim)
+    moderation_claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
 
-class Post(models.Model):
+    @staticmethod
+    def verdict_fields(verdict, version):
+        """Field values recording a (should_block, reason, details) verdict"""
+        should_block, reason, details = verdict
+        return {
+            'moderation_verdict': {'block': bool(should_block), 'reason': reason, 'confidence': details.get('confidence')},
+            'moderation_version': version,
+        }
+
+    @classmethod
+    def visible_to(cls, user):
+        """Q for the rows `user` may see: published ones plus their own pending/rejected ones"""
+        published = Q(moderation_status=cls.PUBLISHED)
+        if user is not None and user.is_authenticated:
+            return published | Q(user=user)
+        return published
+
+class Post(ModeratedContent):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     description = models.TextField(blank=True)
     picture = models.ImageField(upload_to=post_image_path, blank=True, null=True)
     picture_path = models.CharField(max_length=255, blank=True, default="")  # Keep for compatibility
+    picture_variants = models.JSONField(default=dict, blank=True)  # {max side: storage name}
     likes = models.ManyToManyField(User, related_name='liked_posts', blank=True)
+    # Denormalized counters, kept in step with F() updates (see repair_counters)
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    # False when the author had too many friends to push this post into their timelines
+    fanned_out = models.BooleanField(default=True)
+    # Bumped on every change that alters the post's serialized form (see api.fragment_cache)
+    cache_version = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the global feed and of profile pages
+            models.Index(fields=['-created_at', '-id'], name='post_created_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='post_user_created_idx'),
+            # Authors pulled at read time by api.timeline
+            models.Index(fields=['user'], condition=models.Q(fanned_out=False), name='post_pulled_author_idx'),
+            # Moderation worker queue
+            models.Index(fields=['id'], condition=models.Q(moderation_status='pending'), name='post_pending_idx'),
+        ]
+
     def __str__(self):
         return f"Post by {self.user.username} at {self.created_at}"
 
     def save(self, *args, **kwargs):
-        # Compress post picture before saving
-        if self.picture and hasattr(self.picture, 'file'):
-            # Check if this is a new upload
-            if not self.pk or (self.pk and self._state.adding):
-                print("Compressing post picture...")
-                compressed_image = compress_image(self.picture, quality=80, max_width=1200, max_height=1200)
-                if compressed_image:
-                    self.picture = compressed_image
+        # Compress (or stage) a newly uploaded post picture before saving
+        upload = prepare_upload(self, 'picture', 'post')
         
         # Update picture_path when picture is uploaded
         if self.picture:
             self.picture_path = self.picture.url
-        super().save(*args, **kwargs)
 
-class Comment(models.Model):
+        if self._state.adding or kwargs.get('update_fields') is not None:
+            super().save(*args, **kwargs)
+        else:
+            kwargs['update_fields'] = saveable_fields(self)
+            super().save(*args, **kwargs)
+            touch_post(self.pk)
+            self.refresh_from_db(fields=['cache_version'])
+        finish_upload(self, 'picture', 'post', upload)
+
+class Comment(ModeratedContent):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
     comment = models.TextField()
     likes = models.ManyToManyField(User, related_name='liked_comments', blank=True)
+    like_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['post', '-created_at', '-id'], name='comment_post_created_idx'),
+            models.Index(fields=['id'], condition=models.Q(moderation_status='pending'), name='comment_pending_idx'),
+        ]
+
     def __str__(self):
         return f"Comment by {self.user.username} on {self.post}"
 
+    def save(self, *args, **kwargs):
+        if self._state.adding or kwargs.get('update_fields') is not None:
+            super().save(*args, **kwargs)
+            return
+        # Edits must not clobber like_count; they do change the post's rendering
+        kwargs['update_fields'] = saveable_fields(self)
+        super().save(*args, **kwargs)
+        touch_post(self.post_id)
+
+class TimelineEntry(models.Model):
+    """A post materialized into one user's home timeline (fan-out on write)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    created_at = models.DateTimeField()  # Copy of post.created_at so reads stay on one index
+
+    class Meta:
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-post'], name='timeline_user_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Post {self.post_id} in {self.user_id}'s timeline"
+
 class FriendRequest(models.Model):
     PENDING = 'pending'
     ACCEPTED = 'accepted'
@@ -162,6 +400,10 @@ class FriendRequest(models.Model):
     
     class Meta:
         unique_together = ('sender', 'receiver')
+        indexes = [
+            models.Index(fields=['receiver', 'status'], name='friendrequest_receiver_idx'),
+            models.Index(fields=['sender', 'status'], name='friendrequest_sender_idx'),
+        ]
     
     def __str__(self):
         return f"Friend request from {self.sender.username} to {self.receiver.username} - {self.status}"
@@ -171,12 +413,14 @@ class Notification(models.Model):
     FRIEND_ACCEPTED = 'friend_accepted'
     POST_LIKE = 'post_like'
     POST_COMMENT = 'post_comment'
+    MODERATION_RESULT = 'moderation_result'
     
     TYPE_CHOICES = [
         (FRIEND_REQUEST, 'Friend Request'),
         (FRIEND_ACCEPTED, 'Friend Accepted'),
         (POST_LIKE, 'Post Like'),
         (POST_COMMENT, 'Post Comment'),
+        (MODERATION_RESULT, 'Moderation Result'),
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
@@ -192,6 +436,11 @@ class Notification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='notification_user_created_idx'),
+            # Unread badge counts only touch unread rows
+            models.Index(fields=['user', 'created_at'], condition=models.Q(is_read=False), name='notification_unread_idx'),
+        ]
     
     def __str__(self):
         return f"Notification for {self.user.username}: {self.message}"
@@ -217,6 +466,7 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField(blank=True)  # Text content, can be empty if image-only
     image = models.ImageField(upload_to=message_image_path, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)  # {max side: storage name}
     is_edited = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -224,24 +474,24 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Partial rather than (conversation, is_deleted, created_at): the ORM emits `NOT is_deleted`,
+            # which planners only match against an index predicate, never an index column
+            models.Index(fields=['conversation', 'created_at'], condition=models.Q(is_deleted=False), name='message_live_idx'),
+        ]
     
     def __str__(self):
         content_preview = self.content[:50] if self.content else "[Image]" if self.image else "[Deleted]"
         return f"Message from {self.sender.username}: {content_preview}"
     
     def save(self, *args, **kwargs):
-        # Compress message image before saving
-        if self.image and hasattr(self.image, 'file'):
-            # Check if this is a new upload
-            if not self.pk or (self.pk and self._state.adding):
-                print("Compressing message image...")
-                compressed_image = compress_image(self.image, quality=80, max_width=1200, max_height=1200)
-                if compressed_image:
-                    self.image = compressed_image
+        # Compress (or stage) a newly uploaded message image before saving
+        upload = prepare_upload(self, 'image', 'message')
         
         # Update conversation's updated_at when message is saved
         super().save(*args, **kwargs)
         self.conversation.save()  # This will update the conversation's updated_at field
+        finish_upload(self, 'image', 'message', upload)
 
 class MessageReadStatus(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_statuses')
@@ -253,3 +503,32 @@ class MessageReadStatus(models.Model):
     
     def __str__(self):
         return f"{self.user.username} read message {self.message.id} at {self.read_at}"
+
+
+class ImageJob(models.Model):
+    """
+    An upload waiting for an image worker: a raw file under staging/
+    (IMAGE_ASYNC), or an image compressed inline (`compressed`) that still
+    needs its variants and modern-format siblings.
+    """
+    KIND_CHOICES = [
+        ('user', 'Profile picture'),
+        ('post', 'Post picture'),
+        ('message', 'Message image'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    staged_name = models.CharField(max_length=255)
+    original_name = models.CharField(max_length=255)
+    compressed = models.BooleanField(default=False)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Set while a worker processes the job; claims older than IMAGE_JOB_TIMEOUT are taken over
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}: {self.staged_name}"
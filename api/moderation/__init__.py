@@ -0,0 +1,60 @@
+"""
+Content moderation (toxicity and sentiment) for posts and comments.
+
+check_content(text) returns infer.should_block_content's
+(should_block, reason, details) triple. With MODERATION_BACKEND='local' the
+combined_model transformers run inside this process; with 'server' the call
+goes to `manage.py run_moderation_server`, which keeps a single copy of the
+models per host, and request threads only wait up to MODERATION_TIMEOUT.
+Either way, model verdicts for already-seen text come from
+api.moderation.cache, and with MODERATION_PREFILTER the cheap tiers in
+api.moderation.prefilter settle plainly benign or abusive text before the
+models (or their cache) are asked.
+
+With MODERATION_ASYNC, create requests skip moderation entirely: content is
+saved as pending and `manage.py moderation_worker` scores it afterwards
+(api.moderation.publishing).
+"""
+import logging
+
+from django.conf import settings
+
+from . import cache, prefilter
+from .client import ModerationUnavailable, get_client
+
+
+def _check_models(text):
+    if getattr(settings, 'MODERATION_BACKEND', 'local') == 'server':
+        return get_client().check(text)
+    from . import local
+    return local.should_block_content(text)
+
+
+def _check_cached(text):
+    return cache.cached(_check_models, text)
+
+
+def check_content(text):
+    if getattr(settings, 'MODERATION_PREFILTER', False):
+        # Only model verdicts are cached: the cheap tiers are re-run so list and
+        # model changes apply to text already seen, and repeats count toward the skip cap
+        return prefilter.cascade(text, _check_cached)
+    return _check_cached(text)
+
+
+def check_content_fail_open(text, log_suffix=''):
+    """check_content(), or None (logged) when the models or the server are unavailable"""
+    try:
+        return check_content(text)
+    except ImportError as e:
+        logging.warning(f"Toxicity detection model not available{log_suffix}: {str(e)}")
+    except Exception as e:
+        logging.error(f"Error in toxicity detection{log_suffix}: {str(e)}")
+    return None
+
+
+def is_async():
+    return getattr(settings, 'MODERATION_ASYNC', False)
+
+
+__all__ = ['ModerationUnavailable', 'check_content', 'check_content_fail_open', 'is_async']
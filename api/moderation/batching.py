@@ -0,0 +1,92 @@
+"""
+Dynamic micro-batching of moderation calls.
+
+Concurrent callers each submit one text; a single worker thread waits up to
+`max_wait` seconds after the first arrival for more, then runs them through
+the engine as one batch of at most `max_batch_size` and hands every caller
+its own result. Callers stop waiting after `timeout` seconds; items whose
+callers gave up before their batch started are dropped from it.
+"""
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.005, timeout=None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.batch_sizes = collections.deque(maxlen=1000)  # Recent batch sizes, for benchmarks and tests
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='moderation-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """Queue one item; returns a Future resolving to its result"""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        future = self.submit(item)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            future.cancel()  # Skipped if its batch has not started yet
+            raise
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [(item, future) for item, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            if len(results) != len(batch):
+                error = RuntimeError(f'Batch of {len(batch)} items returned {len(results)} results')
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class BatchingEngine:
+    """
+    Wrap an engine so concurrent should_block_content() calls are batched.
+
+    Engines with a should_block_content_batch(texts) method get real batched
+    forward passes; others (such as infer.py) are called once per item.
+    """
+    thread_safe = True
+
+    def __init__(self, engine, max_batch_size=16, max_wait=0.005, timeout=None):
+        self.engine = engine
+        process = getattr(engine, 'should_block_content_batch', None) or self._one_by_one
+        self.batcher = MicroBatcher(process, max_batch_size=max_batch_size, max_wait=max_wait, timeout=timeout)
+
+    def _one_by_one(self, texts):
+        return [self.engine.should_block_content(text) for text in texts]
+
+    def should_block_content(self, text):
+        return self.batcher(text)
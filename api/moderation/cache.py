@@ -0,0 +1,138 @@
+"""
+Verdict cache for moderation.
+
+Verdicts are keyed by a hash of the normalized text plus the model version,
+a signature of the files under combined_model/ (path, size, mtime), the
+engine, its mode and the thresholds, so replacing the models or changing how
+they are scored makes every old entry unreachable. There are two tiers:
+an in-process LRU of MODERATION_CACHE_SIZE entries, and optionally the
+Django cache named by MODERATION_CACHE_ALIAS (e.g. Redis), shared between
+workers and surviving restarts.
+"""
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .local import MODEL_DIR
+
+_WHITESPACE = re.compile(r'\s+')
+
+_lru = collections.OrderedDict()
+_lru_lock = threading.Lock()
+_stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0}
+_version = {'value': None, 'checked_at': 0.0}
+
+
+def normalize_text(text):
+    """Canonical form for keying: NFKC, whitespace runs collapsed, ends trimmed"""
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+def compute_model_version(model_dir=MODEL_DIR):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(model_dir):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(f'{os.path.relpath(path, model_dir)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+def get_model_version():
+    """
+    Signature of everything a verdict depends on: the model files (re-read
+    from disk at most every MODERATION_CACHE_VERSION_TTL seconds), the
+    engine and its mode, and the blocking thresholds.
+    """
+    now = time.monotonic()
+    if _version['value'] is None or now - _version['checked_at'] >= getattr(settings, 'MODERATION_CACHE_VERSION_TTL', 10):
+        _version['value'] = compute_model_version()
+        _version['checked_at'] = now
+    # The engines and the int8 models give slightly different scores, so their verdicts are kept apart
+    return '-'.join((
+        _version['value'],
+        getattr(settings, 'MODERATION_ENGINE', 'infer'),
+        getattr(settings, 'MODERATION_MODEL_MODE', 'fp32'),
+        f"t{getattr(settings, 'MODERATION_TOXIC_THRESHOLD', 0.5)}",
+        f"n{getattr(settings, 'MODERATION_NEGATIVE_THRESHOLD', 0.98)}",
+    ))
+
+
+def verdict_key(text):
+    text_hash = hashlib.sha256(normalize_text(text).encode()).hexdigest()
+    return f'moderation:{get_model_version()}:{text_hash}'
+
+
+def _shared_cache():
+    alias = getattr(settings, 'MODERATION_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+def get(key):
+    with _lru_lock:
+        if key in _lru:
+            _lru.move_to_end(key)
+            _stats['memory_hits'] += 1
+            return _lru[key]
+    shared = _shared_cache()
+    verdict = shared.get(key) if shared is not None else None
+    if verdict is not None:
+        verdict = tuple(verdict)
+        _remember(key, verdict)
+        _count('shared_hits')
+        return verdict
+    _count('misses')
+    return None
+
+
+def _count(name):
+    with _lru_lock:
+        _stats[name] += 1
+
+
+def _remember(key, verdict):
+    with _lru_lock:
+        _lru[key] = verdict
+        _lru.move_to_end(key)
+        while len(_lru) > getattr(settings, 'MODERATION_CACHE_SIZE', 10000):
+            _lru.popitem(last=False)
+
+
+def put(key, verdict):
+    verdict = tuple(verdict)
+    _remember(key, verdict)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(key, verdict, timeout=getattr(settings, 'MODERATION_CACHE_TIMEOUT', None))
+
+
+def cached(check, text):
+    """Return check(text), served from the cache when this text was already scored by these models"""
+    if getattr(settings, 'MODERATION_CACHE_SIZE', 10000) <= 0:
+        return check(text)
+    key = verdict_key(text)
+    verdict = get(key)
+    if verdict is None:
+        verdict = tuple(check(text))
+        put(key, verdict)
+    return verdict
+
+
+def get_stats():
+    return dict(_stats)
+
+
+def clear():
+    with _lru_lock:
+        _lru.clear()
+    for name in _stats:
+        _stats[name] = 0
+    _version['value'] = None
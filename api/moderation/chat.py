@@ -0,0 +1,118 @@
+"""
+Chat message moderation off the event loop.
+
+MessageConsumer broadcasts a message as soon as it is saved and asks
+`moderate` about it in the background. The check runs on a small thread
+pool, never on the daphne event loop: MODERATION_CHAT_WORKERS threads with
+the moderation server, a single one with the in-process models. At most
+MODERATION_CHAT_MAX_PENDING checks may be queued or running; beyond that, and
+for any check that misses the MODERATION_CHAT_BUDGET_MS budget, the message
+stays up (fail open, logged), like the other moderation paths when the
+models are unavailable.
+
+Messages sent or edited over REST go through `schedule_moderation`, which
+checks them on the same pool (sharing the pending limit) and retracts them
+with `retract` if flagged.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import check_content_fail_open
+
+_executor = {'pool': None, 'workers': None}
+_pending = {'count': 0}
+_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'MODERATION_CHAT', False)
+
+
+def get_workers():
+    if getattr(settings, 'MODERATION_BACKEND', 'local') != 'server':
+        return 1  # In-process models are not shared between threads
+    return getattr(settings, 'MODERATION_CHAT_WORKERS', 4)
+
+
+def get_executor():
+    workers = get_workers()
+    with _lock:
+        if _executor['pool'] is None or _executor['workers'] != workers:
+            if _executor['pool'] is not None:
+                _executor['pool'].shutdown(wait=False)
+            _executor['pool'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-moderation')
+            _executor['workers'] = workers
+        return _executor['pool']
+
+
+def _reserve():
+    with _lock:
+        if _pending['count'] >= getattr(settings, 'MODERATION_CHAT_MAX_PENDING', 64):
+            return False
+        _pending['count'] += 1
+        return True
+
+
+def _release(_future=None):
+    with _lock:
+        _pending['count'] -= 1
+
+
+async def moderate(text):
+    """Verdict for a chat message, or None if it could not be checked in time"""
+    if not _reserve():
+        logging.warning("Chat moderation queue is full; message not checked")
+        return None
+    future = get_executor().submit(check_content_fail_open, text, ' for chat message')
+    # The slot is freed when the check finishes, even if we stop waiting for it
+    future.add_done_callback(_release)
+    try:
+        return await asyncio.wait_for(
+            asyncio.wrap_future(future), getattr(settings, 'MODERATION_CHAT_BUDGET_MS', 2000) / 1000
+        )
+    except asyncio.TimeoutError:
+        logging.warning("Chat moderation exceeded its latency budget; message not checked")
+        return None
+
+
+def retract(message_id, reason):
+    """Delete a flagged message and tell its conversation; False if it was already deleted"""
+    from ..models import Message
+
+    conversation_id = Message.objects.filter(id=message_id).values_list('conversation_id', flat=True).first()
+    retracted = Message.objects.filter(id=message_id, is_deleted=False).update(is_deleted=True, updated_at=timezone.now())
+    if not retracted:
+        return False
+    async_to_sync(get_channel_layer().group_send)(
+        f'conversation_{conversation_id}',
+        {'type': 'message_deleted', 'message_id': message_id, 'reason': reason},
+    )
+    logging.info(f"Chat message {message_id} retracted by moderation: {reason}")
+    return True
+
+
+def _check_saved(message_id, text):
+    try:
+        verdict = check_content_fail_open(text, ' for chat message')
+        if verdict is not None and verdict[0]:
+            retract(message_id, verdict[1])
+    finally:
+        connection.close()  # Pool threads outlive requests, so nothing else closes it
+
+
+def schedule_moderation(message_id, text):
+    """Check a saved message in the background; returns its Future, or None if the queue is full"""
+    if not _reserve():
+        logging.warning("Chat moderation queue is full; message not checked")
+        return None
+    future = get_executor().submit(_check_saved, message_id, text)
+    future.add_done_callback(_release)
+    return future
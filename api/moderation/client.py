@@ -0,0 +1,83 @@
+"""Client for the moderation server (see api.moderation.server for the protocol)"""
+import json
+import socket
+import threading
+
+from django.conf import settings
+
+
+class ModerationUnavailable(Exception):
+    """The moderation server could not be reached or did not answer in time"""
+
+
+def parse_address(address):
+    """'unix:/path/to.sock' -> (AF_UNIX, path); 'host:port' -> (AF_INET, (host, port))"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+class ModerationClient:
+    """One persistent connection per thread; newline-delimited JSON requests"""
+
+    def __init__(self, address, timeout):
+        self.address_spec = address
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        return sock
+
+    def close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            self._local.reader.close()
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, payload):
+        sock = getattr(self._local, 'sock', None) or self._connect()
+        sock.sendall(json.dumps(payload).encode() + b'\n')
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError('moderation server closed the connection')
+        return json.loads(line)
+
+    def check(self, text):
+        """Return (should_block, reason, details) or raise ModerationUnavailable"""
+        payload = {'text': text}
+        try:
+            try:
+                response = self._request(payload)
+            except ConnectionError:
+                # Stale keep-alive connection (server restarted); retry once on a fresh one
+                self.close()
+                response = self._request(payload)
+        except (OSError, ValueError) as e:
+            self.close()
+            raise ModerationUnavailable(str(e)) from e
+
+        if 'error' in response:
+            raise ModerationUnavailable(response['error'])
+        return response['should_block'], response['reason'], response['details']
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    address = getattr(settings, 'MODERATION_ADDRESS', '127.0.0.1:8765')
+    timeout = getattr(settings, 'MODERATION_TIMEOUT', 2.0)
+    with _client_lock:
+        if _client is None or (_client.address_spec, _client.timeout) != (address, timeout):
+            _client = ModerationClient(address, timeout)
+        return _client
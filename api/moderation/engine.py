@@ -0,0 +1,190 @@
+"""
+Batched moderation engine over combined_model/sentiment and combined_model/toxic.
+
+infer.py scores one text per call. This engine loads the same two models
+with transformers and scores a whole batch per forward pass, grouping texts
+of similar length so short posts are not padded out to the longest one.
+Results have the same (should_block, reason, details) shape as
+infer.should_block_content.
+
+When the two models ship the same tokenizer, each text is tokenized once
+and the encoding feeds both heads; otherwise each tokenizer keeps an LRU of
+recent encodings. Batches are padded to their longest member only, and
+MODERATION_TORCH_THREADS sets torch's intra-op thread count.
+"""
+import collections
+import os
+import threading
+
+from django.conf import settings
+
+from . import quantization
+from .local import MODEL_DIR
+
+
+def length_buckets(texts, max_bucket_size):
+    """
+    Split range(len(texts)) into groups of similar length, shortest first.
+
+    Each group has at most max_bucket_size items and no item is more than
+    twice as long as the shortest one in its group.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    buckets, current = [], []
+    for i in order:
+        if current and (len(current) >= max_bucket_size or len(texts[i]) > 2 * max(len(texts[current[0]]), 16)):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def find_label(id2label, keywords, default):
+    """Index of the first label containing one of `keywords` (and not negated), else `default`"""
+    for index, label in sorted(id2label.items()):
+        label = str(label).lower()
+        if any(word in label for word in keywords) and not label.startswith(('non', 'not')):
+            return int(index)
+    return default
+
+
+def same_tokenizer(a, b):
+    """True if a and b turn any text into the same ids"""
+    if type(a) is not type(b) or a.model_max_length != b.model_max_length:
+        return False
+    if getattr(a, 'is_fast', False) and getattr(b, 'is_fast', False):
+        # The serialized pipeline covers normalization and pre-tokenization as well as the vocab
+        return a.backend_tokenizer.to_str() == b.backend_tokenizer.to_str()
+    return a.get_vocab() == b.get_vocab() and a.init_kwargs == b.init_kwargs
+
+
+class CachingTokenizer:
+    """Per-text encodings (unpadded ids) from one tokenizer, with an LRU of recent texts"""
+
+    def __init__(self, tokenizer, max_length, cache_size=4096):
+        self.tokenizer = tokenizer
+        self.max_length = min(max_length, tokenizer.model_max_length)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, texts):
+        encodings, missing = {}, []
+        with self.lock:
+            for text in texts:
+                if text in self.cache:
+                    self.cache.move_to_end(text)
+                    encodings[text] = self.cache[text]
+                elif text not in encodings:
+                    encodings[text] = None
+                    missing.append(text)
+        if missing:
+            batch = self.tokenizer(missing, truncation=True, max_length=self.max_length)
+            with self.lock:
+                for i, text in enumerate(missing):
+                    encodings[text] = {key: values[i] for key, values in batch.items()}
+                    if self.cache_size > 0:
+                        self.cache[text] = encodings[text]
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return [encodings[text] for text in texts]
+
+    def batch(self, texts):
+        """Tensors for texts, padded to the longest of them"""
+        return self.tokenizer.pad(self.encode(texts), padding='longest', return_tensors='pt')
+
+
+class TransformersEngine:
+    max_length = 512
+
+    def __init__(self, model_dir=MODEL_DIR, bucket_size=16, mode='fp32', quantized_dir=None, threads=None):
+        import torch
+        from transformers import AutoTokenizer
+
+        self.torch = torch
+        threads = getattr(settings, 'MODERATION_TORCH_THREADS', 0) if threads is None else threads
+        if threads:
+            torch.set_num_threads(threads)
+        self.bucket_size = bucket_size
+        self.mode = mode
+        self.models = {}
+        self.tokenizers = {}
+        cache_size = getattr(settings, 'MODERATION_TOKEN_CACHE_SIZE', 4096)
+        for name in ('sentiment', 'toxic'):
+            tokenizer = AutoTokenizer.from_pretrained(os.path.join(model_dir, name))
+            shared = next((t for t in self.tokenizers.values() if same_tokenizer(t.tokenizer, tokenizer)), None)
+            self.tokenizers[name] = shared or CachingTokenizer(tokenizer, self.max_length, cache_size)
+            model = quantization.load_model(name, mode, model_dir=model_dir, out_dir=quantized_dir)
+            self.models[name] = (self.tokenizers[name].tokenizer, model)
+        self.shared_tokenizer = self.tokenizers['sentiment'] is self.tokenizers['toxic']
+
+        sentiment_labels = self.models['sentiment'][1].config.id2label
+        self.negative_index = find_label(sentiment_labels, ('neg',), 0)
+        self.positive_index = find_label(sentiment_labels, ('pos',), len(sentiment_labels) - 1)
+        self.toxic_index = find_label(self.models['toxic'][1].config.id2label, ('toxic', 'offensive', 'hate'), 1)
+
+    def probabilities(self, name, inputs):
+        with self.torch.inference_mode():
+            logits = self.models[name][1](**inputs).logits
+            return logits.softmax(dim=-1).tolist()
+
+    def should_block_content_batch(self, texts):
+        results = [None] * len(texts)
+        for bucket in length_buckets(texts, self.bucket_size):
+            batch = [texts[i] for i in bucket]
+            inputs = self.tokenizers['sentiment'].batch(batch)
+            sentiment = self.probabilities('sentiment', inputs)
+            if not self.shared_tokenizer:
+                inputs = self.tokenizers['toxic'].batch(batch)
+            toxic = self.probabilities('toxic', inputs)
+            for i, sentiment_probs, toxic_probs in zip(bucket, sentiment, toxic):
+                results[i] = self.verdict(sentiment_probs, toxic_probs)
+        return results
+
+    def should_block_content(self, text):
+        return self.should_block_content_batch([text])[0]
+
+    def verdict(self, sentiment_probs, toxic_probs):
+        negative = sentiment_probs[self.negative_index]
+        positive = sentiment_probs[self.positive_index]
+        toxic = toxic_probs[self.toxic_index]
+        details = {
+            'sentiment': {'negative': negative, 'positive': positive},
+            'toxicity': toxic,
+            'primary_issue': None,
+            'confidence': max(toxic, negative),
+        }
+        if toxic >= getattr(settings, 'MODERATION_TOXIC_THRESHOLD', 0.5):
+            details.update(primary_issue='toxic', confidence=toxic)
+            return True, 'Content flagged as toxic or offensive.', details
+        if negative >= getattr(settings, 'MODERATION_NEGATIVE_THRESHOLD', 0.98):
+            details.update(primary_issue='negative_sentiment', confidence=negative)
+            return True, 'Content flagged as extremely negative.', details
+        return False, 'Content is appropriate.', details
+
+
+def load_engine(batched=True):
+    """Build the engine named by MODERATION_ENGINE, batched per the MODERATION_MAX_* settings"""
+    from . import local
+    from .batching import BatchingEngine
+
+    if getattr(settings, 'MODERATION_ENGINE', 'infer') == 'transformers':
+        engine = TransformersEngine(
+            bucket_size=getattr(settings, 'MODERATION_MAX_BATCH_SIZE', 16),
+            mode=getattr(settings, 'MODERATION_MODEL_MODE', 'fp32'),
+        )
+    else:
+        engine = local.load_infer()
+
+    max_batch_size = getattr(settings, 'MODERATION_MAX_BATCH_SIZE', 16)
+    if not batched or max_batch_size <= 1:
+        return engine
+    return BatchingEngine(
+        engine,
+        max_batch_size=max_batch_size,
+        max_wait=getattr(settings, 'MODERATION_MAX_WAIT_MS', 5) / 1000,
+        # The client fails open by then, so its server thread need not wait longer
+        timeout=getattr(settings, 'MODERATION_TIMEOUT', 2.0),
+    )
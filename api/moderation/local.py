@@ -0,0 +1,50 @@
+"""
+In-process moderation (MODERATION_BACKEND='local').
+
+Checks go to this process's engine.load_engine(batched=False): infer.py from
+combined_model/combined_model, or the transformers engine with
+MODERATION_MODEL_MODE, per MODERATION_ENGINE, exactly as the moderation
+server, moderation_worker and remoderate_content score. The engine is built
+on first use and rebuilt when those settings change.
+"""
+import os
+import sys
+import threading
+
+from django.conf import settings
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'combined_model', 'combined_model')
+
+_engine = {'key': None, 'engine': None}
+_lock = threading.Lock()
+
+
+def load_infer():
+    """Import infer.py (which loads both transformer models on first import)"""
+    if MODEL_DIR not in sys.path:
+        sys.path.append(MODEL_DIR)
+    import infer
+    return infer
+
+
+def _engine_key():
+    return (
+        getattr(settings, 'MODERATION_ENGINE', 'infer'),
+        getattr(settings, 'MODERATION_MODEL_MODE', 'fp32'),
+        getattr(settings, 'MODERATION_MAX_BATCH_SIZE', 16),
+    )
+
+
+def get_engine():
+    from .engine import load_engine
+
+    key = _engine_key()
+    with _lock:
+        if _engine['key'] != key:
+            _engine['engine'] = load_engine(batched=False)
+            _engine['key'] = key
+        return _engine['engine']
+
+
+def should_block_content(text):
+    return get_engine().should_block_content(text)
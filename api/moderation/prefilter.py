@@ -0,0 +1,209 @@
+"""
+Cheap tiers in front of the transformer models (MODERATION_PREFILTER).
+
+The cascade tries, in order:
+
+1. lexical: a compiled blocklist regex (any match blocks) and an allowlist
+   vocabulary (text made only of allowlisted words is allowed);
+2. linear: logistic regression over hashed word 1-2 grams, trained by
+   `manage.py train_moderation_prefilter`, which decides only when its
+   probability is below MODERATION_PREFILTER_ALLOW_BELOW or above
+   MODERATION_PREFILTER_BLOCK_ABOVE;
+3. model: the full check (infer or the moderation server).
+
+The cheap tiers run on every check, repeats included; only the models'
+verdicts are cached, so editing the word lists or retraining the linear
+model applies to text already seen.
+
+At most MODERATION_PREFILTER_MAX_SKIP of the last MODERATION_PREFILTER_WINDOW
+texts may skip the models. Past that, texts a cheap tier decided go to the
+models too, and the two verdicts are compared for the per-tier agreement
+in get_stats().
+"""
+import collections
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+from django.conf import settings
+
+from .cache import normalize_text
+
+TIERS = ('lexical', 'linear', 'model')
+BLOCKED_REASON = 'Content flagged as toxic or offensive.'
+ALLOWED_REASON = 'Content is appropriate.'
+DEFAULT_DIMENSIONS = 2 ** 18
+
+_WORD = re.compile(r"[\w']+")
+_lock = threading.Lock()
+_loaded = {'key': None, 'tiers': None}
+_window = collections.deque()
+_stats = {}
+
+
+def tokens(text):
+    return _WORD.findall(normalize_text(text).lower())
+
+
+def features(words, dimensions):
+    """Hashed word unigram and bigram indexes; crc32 so they match across processes"""
+    grams = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+    return [zlib.crc32(gram.encode()) % dimensions for gram in grams]
+
+
+def read_terms(path):
+    """Non-empty, non-comment lines of a word list; missing files are empty"""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [line.strip().lower() for line in f if line.strip() and not line.startswith('#')]
+
+
+def compile_blocklist(terms):
+    if not terms:
+        return None
+    alternatives = '|'.join(sorted((re.escape(term) for term in terms), key=len, reverse=True))
+    return re.compile(rf"(?<![\w']){alternatives}(?![\w'])")
+
+
+class LinearModel:
+    def __init__(self, weights=None, bias=0.0, dimensions=DEFAULT_DIMENSIONS):
+        self.weights = weights if weights is not None else {}
+        self.bias = bias
+        self.dimensions = dimensions
+
+    def probability(self, words):
+        score = self.bias + sum(self.weights.get(i, 0.0) for i in features(words, self.dimensions))
+        return 1 / (1 + math.exp(-max(-30.0, min(30.0, score))))
+
+    def fit(self, samples, epochs=20, learning_rate=0.5, l2=1e-4):
+        """Plain SGD on the log loss; samples are (words, blocked) pairs"""
+        indexed = [(features(words, self.dimensions), float(blocked)) for words, blocked in samples]
+        for _ in range(epochs):
+            for indexes, label in indexed:
+                score = self.bias + sum(self.weights.get(i, 0.0) for i in indexes)
+                gradient = 1 / (1 + math.exp(-max(-30.0, min(30.0, score)))) - label
+                self.bias -= learning_rate * gradient
+                for i in indexes:
+                    weight = self.weights.get(i, 0.0)
+                    self.weights[i] = weight - learning_rate * (gradient + l2 * weight)
+        return self
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'dimensions': self.dimensions,
+                'bias': self.bias,
+                'weights': {str(i): round(w, 6) for i, w in self.weights.items() if abs(w) > 1e-6},
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls({int(i): w for i, w in data['weights'].items()}, data['bias'], data['dimensions'])
+
+
+def _settings_key():
+    return (
+        getattr(settings, 'MODERATION_BLOCKLIST', None),
+        getattr(settings, 'MODERATION_ALLOWLIST', None),
+        getattr(settings, 'MODERATION_PREFILTER_MODEL', None),
+    )
+
+
+def load_tiers():
+    """(blocklist regex, allowlist set, LinearModel or None), reloaded when the paths change"""
+    key = _settings_key()
+    with _lock:
+        if _loaded['key'] != key:
+            blocklist_path, allowlist_path, model_path = key
+            model = LinearModel.load(model_path) if model_path and os.path.exists(model_path) else None
+            _loaded['tiers'] = (compile_blocklist(read_terms(blocklist_path)), set(read_terms(allowlist_path)), model)
+            _loaded['key'] = key
+        return _loaded['tiers']
+
+
+def _details(tier, confidence, blocked):
+    return {
+        'sentiment': {'negative': None, 'positive': None},
+        'primary_issue': tier if blocked else None,
+        'confidence': confidence,
+        'tier': tier,
+    }
+
+
+def classify(text, tiers=None):
+    """(tier, verdict) from the cheap tiers, or (None, None) when they are unsure"""
+    blocklist, allowlist, model = tiers or load_tiers()
+    normalized = normalize_text(text).lower()
+    if blocklist is not None and blocklist.search(normalized):
+        return 'lexical', (True, BLOCKED_REASON, _details('lexical', 1.0, True))
+    words = _WORD.findall(normalized)
+    if words and allowlist and all(word in allowlist for word in words):
+        return 'lexical', (False, ALLOWED_REASON, _details('lexical', 1.0, False))
+    if model is not None:
+        probability = model.probability(words)
+        if probability <= getattr(settings, 'MODERATION_PREFILTER_ALLOW_BELOW', 0.02):
+            return 'linear', (False, ALLOWED_REASON, _details('linear', 1 - probability, False))
+        if probability >= getattr(settings, 'MODERATION_PREFILTER_BLOCK_ABOVE', 0.98):
+            return 'linear', (True, BLOCKED_REASON, _details('linear', probability, True))
+    return None, None
+
+
+def _may_skip(decided):
+    """Record one text in the window; True if a cheap tier decided it and the skip cap allows that"""
+    size = getattr(settings, 'MODERATION_PREFILTER_WINDOW', 1000)
+    cap = getattr(settings, 'MODERATION_PREFILTER_MAX_SKIP', 0.8)
+    with _lock:
+        # Share of skips including this text, over the window including this text
+        skip = decided and sum(_window) + 1 <= cap * (len(_window) + 1)
+        _window.append(skip)
+        while len(_window) > size:
+            _window.popleft()
+        return skip
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] = _stats.get(name, 0) + amount
+
+
+def cascade(text, check):
+    """Verdict from the first confident tier, else from check(text)"""
+    tier, verdict = classify(text)
+    _count('texts')
+    if _may_skip(tier is not None):
+        _count(f'{tier}_hits')
+        return verdict
+
+    full = tuple(check(text))
+    _count('model_hits')
+    if tier is not None:
+        # Capped: the cheap verdict is audited against the models instead
+        _count(f'{tier}_audited')
+        _count(f'{tier}_agreed', int(full[0] == verdict[0]))
+    return full
+
+
+def get_stats():
+    """Counters plus per-tier hit rate and agreement with the models on audited texts"""
+    with _lock:
+        stats = dict(_stats)
+    texts = stats.get('texts', 0)
+    for tier in TIERS:
+        stats[f'{tier}_hit_rate'] = stats.get(f'{tier}_hits', 0) / texts if texts else 0.0
+        audited = stats.get(f'{tier}_audited', 0)
+        if tier != 'model':
+            stats[f'{tier}_agreement'] = stats.get(f'{tier}_agreed', 0) / audited if audited else None
+    return stats
+
+
+def clear():
+    with _lock:
+        _stats.clear()
+        _window.clear()
+        _loaded['key'] = None
@@ -0,0 +1,172 @@
+"""
+Publication of moderated content, and the asynchronous moderation queue.
+
+Side effects that make content visible to others (timeline fan-out, comment
+counters, the post owner's comment notification) happen in post_published /
+comment_published: right after creation normally, or once the moderation
+worker has scored pending content with MODERATION_ASYNC.
+
+The worker claims pending rows with a conditional UPDATE, scores them
+outside any transaction, and applies each verdict in a short transaction
+of its own, so no row lock is held while the models run.
+"""
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .. import timeline
+from ..models import Post, Comment, Notification, bump_counter
+from ..websocket_utils import send_notification_websocket
+from . import cache, check_content_fail_open, is_async
+
+
+def initial_status():
+    return Post.PENDING if is_async() else Post.PUBLISHED
+
+
+def notify(user, message, post, notification_type=Notification.MODERATION_RESULT, from_user=None):
+    notification = Notification.objects.create(
+        user=user, type=notification_type, message=message, post=post, from_user=from_user
+    )
+    # Only push once the status change is committed and visible to the client's refetch
+    transaction.on_commit(lambda: send_notification_websocket(user.id, notification))
+
+
+def post_published(post):
+    timeline.fan_out_post(post)
+
+
+def comment_published(comment, notify_owner=True):
+    post = comment.post
+    bump_counter(post, 'comment_count', 1)
+    if notify_owner and post.user_id != comment.user_id:
+        notify(
+            post.user,
+            f"{comment.user.first_name} {comment.user.last_name} commented on your post",
+            post,
+            notification_type=Notification.POST_COMMENT,
+            from_user=comment.user,
+        )
+
+
+def set_status(instance, status):
+    instance.moderation_status = status
+    type(instance).objects.filter(pk=instance.pk).update(moderation_status=status)
+    post_id = instance.pk if isinstance(instance, Post) else instance.post_id
+    Post.objects.filter(pk=post_id).update(cache_version=F('cache_version') + 1)
+
+
+def apply_verdict(instance, verdict):
+    """Publish or reject one pending post/comment and tell its author"""
+    kind = 'post' if isinstance(instance, Post) else 'comment'
+    post = instance if isinstance(instance, Post) else instance.post
+    if verdict is not None:
+        type(instance).objects.filter(pk=instance.pk).update(**Post.verdict_fields(verdict, cache.get_model_version()))
+    if verdict is not None and verdict[0]:
+        set_status(instance, Post.REJECTED)
+        notify(instance.user, f"Your {kind} was not published: {verdict[1]}", post)
+        return False
+
+    set_status(instance, Post.PUBLISHED)
+    if kind == 'post':
+        post_published(instance)
+    else:
+        comment_published(instance)
+    notify(instance.user, f"Your {kind} has been published", post)
+    return True
+
+
+def retract(instance, reason):
+    """Take down published content that a newer model blocks"""
+    kind = 'post' if isinstance(instance, Post) else 'comment'
+    post = instance if isinstance(instance, Post) else instance.post
+    set_status(instance, Post.REJECTED)
+    if kind == 'post':
+        timeline.remove_post(instance)
+    else:
+        bump_counter(post, 'comment_count', -1)
+    notify(instance.user, f"Your {kind} was removed: {reason}", post)
+
+
+def text_edited(instance):
+    """
+    Send an edited post/comment back through moderation.
+
+    The stored verdict was for the old text, so it is dropped for
+    remoderate_content to redo. With MODERATION_ASYNC the row is pending
+    (hidden from others) until the worker has scored the new text; otherwise
+    the serializer has already checked it inline.
+    """
+    type(instance).objects.filter(pk=instance.pk).update(
+        moderation_verdict=None, moderation_version='', moderation_claimed_at=None
+    )
+    if not is_async():
+        return
+    was_published = instance.moderation_status == Post.PUBLISHED
+    set_status(instance, Post.PENDING)
+    if was_published and isinstance(instance, Comment):
+        # Counted again if the worker publishes it
+        bump_counter(instance.post, 'comment_count', -1)
+
+
+def text_of(instance):
+    return (instance.description if isinstance(instance, Post) else instance.comment).strip()
+
+
+def score(texts, threads=1):
+    """
+    Fail-open verdicts for texts; empty text (picture-only posts) is not scored.
+
+    Several threads let a batching moderation server coalesce the requests.
+    """
+    def check(text):
+        return check_content_fail_open(text, ' in moderation worker') if text else None
+
+    if getattr(settings, 'MODERATION_BACKEND', 'local') != 'server':
+        threads = 1  # In-process models are not shared between threads
+    if threads <= 1:
+        return [check(text) for text in texts]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(check, texts))
+
+
+def unclaimed():
+    """Q for pending rows no worker holds: never claimed, or claimed longer than MODERATION_CLAIM_TIMEOUT ago"""
+    stale = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'MODERATION_CLAIM_TIMEOUT', 300))
+    return Q(moderation_status=Post.PENDING) & (Q(moderation_claimed_at__isnull=True) | Q(moderation_claimed_at__lt=stale))
+
+
+def claim(model, limit):
+    """Take up to `limit` pending rows for this worker, oldest first"""
+    ids = list(model.objects.filter(unclaimed()).order_by('id').values_list('id', flat=True)[:limit])
+    now = timezone.now()
+    # One conditional UPDATE per row, so several workers can share the queue without locks
+    claimed = [pk for pk in ids if model.objects.filter(unclaimed(), pk=pk).update(moderation_claimed_at=now)]
+    return list(model.objects.filter(id__in=claimed).select_related('user').order_by('id'))
+
+
+def process_pending(limit=50, threads=1):
+    """Moderate up to `limit` pending posts and `limit` pending comments; returns (published, rejected)"""
+    published = rejected = 0
+    for model in (Post, Comment):
+        rows = claim(model, limit)
+        texts = [text_of(row) for row in rows]
+        for row, text, verdict in zip(rows, texts, score(texts, threads)):
+            with transaction.atomic():
+                current = (
+                    model.objects.select_for_update().select_related('user')
+                    .filter(pk=row.pk, moderation_status=model.PENDING).first()
+                )
+                if current is None or text_of(current) != text:
+                    # Deleted, or edited while it was scored: the new text is scored next time
+                    model.objects.filter(pk=row.pk).update(moderation_claimed_at=None)
+                    continue
+                if apply_verdict(current, verdict):
+                    published += 1
+                else:
+                    rejected += 1
+    return published, rejected
@@ -0,0 +1,68 @@
+"""
+int8 dynamic quantization of the moderation models (MODERATION_MODEL_MODE='int8').
+
+`manage.py quantize_moderation_models` quantizes the Linear layers of each
+combined_model/ model and saves the state dict under
+MODERATION_QUANTIZED_DIR, tagged with the source model version. Loading then
+builds the architecture from config.json, quantizes the empty model and loads
+the saved int8 weights, so the fp32 weights are never read. A missing or
+stale file falls back to quantizing the fp32 model at load time.
+"""
+import logging
+import os
+
+from django.conf import settings
+
+from .cache import compute_model_version
+from .local import MODEL_DIR
+
+MODES = ('fp32', 'int8')
+
+
+def quantize(model):
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(name, out_dir=None):
+    out_dir = out_dir or getattr(settings, 'MODERATION_QUANTIZED_DIR', None)
+    return os.path.join(out_dir, f'{name}.int8.pt')
+
+
+def save_quantized(name, model_dir=MODEL_DIR, out_dir=None):
+    """Quantize combined_model/<name> and write it to disk; returns the path"""
+    import torch
+    from transformers import AutoModelForSequenceClassification
+
+    model = AutoModelForSequenceClassification.from_pretrained(os.path.join(model_dir, name))
+    model.eval()
+    path = quantized_path(name, out_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save({'source_version': compute_model_version(model_dir), 'state_dict': quantize(model).state_dict()}, path)
+    return path
+
+
+def load_model(name, mode='fp32', model_dir=MODEL_DIR, out_dir=None):
+    """Return combined_model/<name> in eval mode, fp32 or int8"""
+    import torch
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+
+    if mode not in MODES:
+        raise ValueError(f'Unknown moderation model mode {mode!r}; expected one of {MODES}')
+    source = os.path.join(model_dir, name)
+    if mode == 'fp32':
+        return AutoModelForSequenceClassification.from_pretrained(source).eval()
+
+    path = quantized_path(name, out_dir)
+    if os.path.exists(path):
+        # Our own file (packed int8 params are not plain tensors), so a full unpickle is fine
+        saved = torch.load(path, weights_only=False)
+        if saved['source_version'] == compute_model_version(model_dir):
+            model = AutoModelForSequenceClassification.from_config(AutoConfig.from_pretrained(source)).eval()
+            model = quantize(model)
+            model.load_state_dict(saved['state_dict'])
+            return model
+        logging.warning(f"Quantized {name} model at {path} is stale; run manage.py quantize_moderation_models")
+    else:
+        logging.warning(f"No quantized {name} model at {path}; quantizing at load time")
+    return quantize(AutoModelForSequenceClassification.from_pretrained(source).eval())
@@ -0,0 +1,65 @@
+"""
+Moderation inference server.
+
+Protocol: the client sends one JSON object per line, {"text": "..."}, and
+gets one line back per request: {"should_block": bool, "reason": str,
+"details": {...}} or {"error": "..."}. Connections are kept open and reused.
+
+Each connection gets a thread. Engines that are not thread_safe are called
+under a lock; a BatchingEngine instead coalesces the concurrent requests
+into batched forward passes.
+"""
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from .client import parse_address
+
+
+class ModerationHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                text = json.loads(line)['text']
+                with self.server.engine_lock:
+                    should_block, reason, details = self.server.engine.should_block_content(text)
+                response = {'should_block': bool(should_block), 'reason': reason, 'details': details}
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            try:
+                self.wfile.write(json.dumps(response, default=float).encode() + b'\n')
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up (timeout) and closed its end
+                return
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, engine):
+    """Bind a server for `address` ('unix:/path' or 'host:port') that answers with `engine`"""
+    family, bind_address = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(bind_address):
+            os.unlink(bind_address)
+        server = ThreadingUnixServer(bind_address, ModerationHandler)
+    else:
+        server = ThreadingTCPServer(bind_address, ModerationHandler)
+    server.engine = engine
+    server.engine_lock = contextlib.nullcontext() if getattr(engine, 'thread_safe', False) else threading.Lock()
+    return server
@@ -1,5 +1,47 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(created_at, pk, reverse=False):
+    """Pack a (created_at, id) position into an opaque URL-safe token"""
+    payload = {'c': created_at.isoformat(), 'i': pk}
+    if reverse:
+        payload['r'] = 1
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (created_at, id, reverse) for a token made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        created_at = parse_datetime(payload['c'])
+        pk = int(payload['i'])
+    except (TypeError, ValueError, KeyError):
+        raise NotFound('Invalid cursor')
+    if created_at is None:
+        raise NotFound('Invalid cursor')
+    return created_at, pk, bool(payload.get('r'))
+
+
+def keyset_filter(queryset, created_at, pk, reverse=False, pk_field='id'):
+    """Rows strictly after (created_at, pk) in newest-first order, or before it when reverse"""
+    if reverse:
+        return queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, **{f'{pk_field}__gt': pk})
+        ).order_by('created_at', pk_field)
+    return queryset.filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, **{f'{pk_field}__lt': pk})
+    ).order_by('-created_at', f'-{pk_field}')
 
 
 class StandardResultsSetPagination(PageNumberPagination):
@@ -41,3 +83,124 @@ class PostsPagination(StandardResultsSetPagination):
                 'limit': self.get_page_size(self.request),
             }
         })
+
+
+class PostsCursorPagination(BasePagination):
+    """
+    Keyset pagination over (created_at, id), newest first.
+
+    Every page is an index range scan of `limit + 1` rows, so scrolling deep
+    costs the same as the first page and no COUNT(*) is issued.
+    """
+    page_size = 10
+    page_size_query_param = 'limit'
+    max_page_size = 50
+    cursor_query_param = 'cursor'
+    results_key = 'posts'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_page_size(request)
+        token = request.query_params.get(self.cursor_query_param)
+        reverse = False
+
+        if token:
+            created_at, pk, reverse = decode_cursor(token)
+            queryset = keyset_filter(queryset, created_at, pk, reverse=reverse)
+        else:
+            queryset = queryset.order_by('-created_at', '-id')
+
+        results = list(queryset[:self.limit + 1])
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+
+        if reverse:
+            results.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = bool(token), has_more
+
+        self.page = results
+        return results
+
+    def get_next_cursor(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        return encode_cursor(last.created_at, last.pk)
+
+    def get_previous_cursor(self):
+        if not self.has_previous or not self.page:
+            return None
+        first = self.page[0]
+        return encode_cursor(first.created_at, first.pk, reverse=True)
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        next_cursor = self.get_next_cursor()
+        previous_cursor = self.get_previous_cursor()
+        return Response({
+            self.results_key: data,
+            'pagination': {
+                'hasNextPage': self.has_next,
+                'hasPrevPage': self.has_previous,
+                'limit': self.limit,
+                'nextCursor': next_cursor,
+                'prevCursor': previous_cursor,
+                'next': self._link(next_cursor),
+                'previous': self._link(previous_cursor),
+            }
+        })
+
+
+class CommentsCursorPagination(PostsCursorPagination):
+    """Keyset pagination for a post's comment thread, newest first"""
+    page_size = 20
+    max_page_size = 100
+    results_key = 'comments'
+
+
+def use_page_numbers(request):
+    """Older clients send ?page= or ask for the numbered shape with ?pagination=pages"""
+    mode = request.query_params.get('pagination', getattr(settings, 'POSTS_PAGINATION_MODE', 'cursor'))
+    return mode == 'pages' or 'page' in request.query_params
+
+
+def get_posts_paginator(request, page_size=None):
+    """Pick the cursor or page-number paginator for a posts listing"""
+    paginator = PostsPagination() if use_page_numbers(request) else PostsCursorPagination()
+    if page_size is not None:
+        paginator.page_size = page_size
+    return paginator
+
+
+class LikersPagination(CursorPagination):
+    """Newest likers first, paged over a likes through table"""
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    ordering = '-id'
+
+    def get_paginated_response(self, data):
+        return Response({
+            'likers': data,
+            'pagination': {
+                'hasNextPage': self.has_next,
+                'hasPrevPage': self.has_previous,
+                'limit': self.page_size,
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link(),
+            }
+        })
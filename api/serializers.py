@@ -1,10 +1,45 @@
 from rest_framework import serializers
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Exists, OuterRef, Prefetch, prefetch_related_objects
+from django.db.models.manager import BaseManager
+from . import fragment_cache, moderation
 from .models import User, Post, Comment, FriendRequest, Notification, Conversation, Message, MessageReadStatus, Message, Conversation, MessageReadStatus
-import sys
-import os
-# Add the correct path to your combined_model directory
-combined_model_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'combined_model', 'combined_model')
-sys.path.append(combined_model_path)
+
+def check_toxicity(text, field, log_suffix=''):
+    """
+    Raise a ValidationError on `field` if moderation blocks `text`.
+
+    Fails open: if the models or the moderation server are unavailable the
+    content is allowed and the problem is logged. With MODERATION_ASYNC the
+    check is left to the moderation worker.
+    """
+    if moderation.is_async():
+        return
+    verdict = moderation.check_content_fail_open(text, log_suffix)
+    if verdict is None:
+        return
+
+    should_block, reason, details = verdict
+    if should_block:
+        raise serializers.ValidationError({
+            field: reason,
+            "sentiment_analysis": {
+                "negative": details['sentiment']['negative'],
+                "positive": details['sentiment']['positive']
+            },
+            "toxicity_detected": details['primary_issue'],
+            "confidence": details['confidence']
+        })
+
+def variant_urls(variants, context=None):
+    """{size: url} for a stored {size: name} variant map; absolute when the context has a request"""
+    request = context.get('request') if context else None
+    urls = {}
+    for size, name in (variants or {}).items():
+        url = default_storage.url(name)
+        urls[size] = request.build_absolute_uri(url) if request is not None else url
+    return urls
 
 class SimpleUserSerializer(serializers.ModelSerializer):
     """Simplified user serializer for use in posts/comments to avoid circular dependencies"""
@@ -12,10 +47,100 @@ class SimpleUserSerializer(serializers.ModelSerializer):
     firstName = serializers.CharField(source='first_name', read_only=True)
     lastName = serializers.CharField(source='last_name', read_only=True)
     picturePath = serializers.CharField(source='picture_path', read_only=True)
+    pictureVariants = serializers.SerializerMethodField()
     
     class Meta:
         model = User
-        fields = ["_id", "id", "firstName", "lastName", "picturePath"]
+        fields = ["_id", "id", "firstName", "lastName", "picturePath", "pictureVariants"]
+
+    def get_pictureVariants(self, obj):
+        return variant_urls(obj.picture_variants, self.context)
+
+LIKES_SAMPLE_MAX = 10
+
+def get_likes_options(context):
+    """
+    Read the requested likes representation from the serializer context.
+
+    ?likes=summary swaps the {user_id: true} map for a bounded summary and
+    ?likes_sample=N (capped at LIKES_SAMPLE_MAX) adds up to N liker ids.
+    Returns (mode, sample_size, viewer).
+    """
+    request = context.get('request') if context else None
+    if request is None:
+        return 'full', 0, None
+    params = getattr(request, 'query_params', request.GET)
+    viewer = getattr(request, 'user', None)
+    if viewer is not None and not viewer.is_authenticated:
+        viewer = None
+    if params.get('likes') != 'summary':
+        return 'full', 0, viewer
+    try:
+        sample_size = max(0, min(int(params.get('likes_sample', 0)), LIKES_SAMPLE_MAX))
+    except ValueError:
+        sample_size = 0
+    return 'summary', sample_size, viewer
+
+def likes_lookups(model, context):
+    """Annotation and prefetches needed to render `likes` for `model` rows"""
+    mode, sample_size, viewer = get_likes_options(context)
+    if mode != 'summary':
+        return {}, ['likes']
+
+    annotations = {}
+    if viewer is not None:
+        through = model.likes.through.objects.filter(
+            **{model.likes.field.m2m_field_name(): OuterRef('pk'), 'user': viewer}
+        )
+        annotations['viewer_has_liked'] = Exists(through)
+    prefetches = []
+    if sample_size:
+        sample = User.objects.only('id').order_by('id')[:sample_size]
+        prefetches.append(Prefetch('likes', queryset=sample, to_attr='likes_sample'))
+    return annotations, prefetches
+
+COMMENT_PREVIEW_MAX = 20
+
+def get_comment_preview_size(context):
+    """Newest comments embedded per post: POST_COMMENT_PREVIEW_SIZE or ?comments_preview=N"""
+    size = getattr(settings, 'POST_COMMENT_PREVIEW_SIZE', 3)
+    request = context.get('request') if context else None
+    if request is not None:
+        params = getattr(request, 'query_params', request.GET)
+        try:
+            size = int(params.get('comments_preview', size))
+        except ValueError:
+            pass
+    return max(0, min(size, COMMENT_PREVIEW_MAX))
+
+class LikesRepresentationMixin:
+    """Render `likes` as the legacy {user_id: true} map or as a summary (see get_likes_options)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.likes_mode, self.likes_sample, self.viewer = get_likes_options(self.context)
+        if self.likes_mode == 'summary':
+            # Never load every liker just to drop them again
+            self.fields.pop('likes', None)
+
+    def represent_likes(self, instance):
+        if self.likes_mode != 'summary':
+            return {str(user.id): True for user in instance.likes.all()}
+
+        summary = {'count': instance.like_count, 'viewer_has_liked': self.viewer_has_liked(instance)}
+        if self.likes_sample:
+            sample = getattr(instance, 'likes_sample', None)
+            if sample is None:
+                sample = instance.likes.only('id').order_by('id')[:self.likes_sample]
+            summary['sample'] = [str(user.id) for user in sample]
+        return summary
+
+    def viewer_has_liked(self, instance):
+        # Prefer the Exists() annotation from setup_eager_loading
+        liked = getattr(instance, 'viewer_has_liked', None)
+        if liked is None:
+            liked = self.viewer is not None and instance.likes.filter(pk=self.viewer.pk).exists()
+        return liked
 
 class UserSerializer(serializers.ModelSerializer):
     # Map Django fields to frontend expected fields
@@ -65,7 +190,7 @@ class UserSerializer(serializers.ModelSerializer):
         data['viewedProfile'] = instance.viewed_profile
         return data
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(LikesRepresentationMixin, serializers.ModelSerializer):
     user = SimpleUserSerializer(read_only=True)
     _id = serializers.CharField(source='id', read_only=True)
     createdAt = serializers.DateTimeField(source='created_at', read_only=True)
@@ -73,8 +198,8 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
-        fields = ["_id", "id", "user", "post", "comment", "likes", "likes_count", "createdAt", "created_at"]
-        read_only_fields = ["post"]
+        fields = ["_id", "id", "user", "post", "comment", "likes", "likes_count", "moderation_status", "createdAt", "created_at"]
+        read_only_fields = ["post", "moderation_status"]
 
     def validate(self, data):
         """
@@ -88,57 +213,42 @@ class CommentSerializer(serializers.ModelSerializer):
             })
         
         # Check content toxicity
-        try:
-            # Try to import and use the toxicity detection
-            import infer
-            should_block, reason, details = infer.should_block_content(comment_text)
-            
-            if should_block:
-                # Raise validation error to block the comment
-                raise serializers.ValidationError({
-                    "comment": reason,
-                    "sentiment_analysis": {
-                        "negative": details['sentiment']['negative'],
-                        "positive": details['sentiment']['positive']
-                    },
-                    "toxicity_detected": details['primary_issue'],
-                    "confidence": details['confidence']
-                })
-                
-        except serializers.ValidationError:
-            # Re-raise validation errors (don't catch our own validation errors)
-            raise
-        except ImportError as e:
-            # If model is not available, log warning but don't block
-            import logging
-            logging.warning(f"Toxicity detection model not available for comment: {str(e)}")
-        except Exception as e:
-            # Log error but don't block comment creation for other errors
-            import logging
-            logging.error(f"Error in toxicity detection for comment: {str(e)}")
+        check_toxicity(comment_text, "comment", " for comment")
         
         return data
 
     def get_likes_count(self, obj):
-        return obj.likes.count()
+        return obj.like_count
+
+    @staticmethod
+    def setup_eager_loading(queryset, context=None):
+        """Load the author and likes data that to_representation reads"""
+        annotations, prefetches = likes_lookups(Comment, context)
+        return queryset.select_related('user').annotate(**annotations).prefetch_related(*prefetches)
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
         data['_id'] = str(instance.id)
         data['createdAt'] = instance.created_at
         # Convert likes from ManyToMany to dict format for frontend compatibility
-        likes_dict = {}
-        for like_user in instance.likes.all():
-            likes_dict[str(like_user.id)] = True
-        data['likes'] = likes_dict
+        data['likes'] = self.represent_likes(instance)
         return data
 
-class PostSerializer(serializers.ModelSerializer):
+class PostListSerializer(serializers.ListSerializer):
+    """Render a page of posts through the fragment cache"""
+
+    def to_representation(self, data):
+        posts = list(data.all() if isinstance(data, BaseManager) else data)
+        return self.child.render_many(posts)
+
+class PostSerializer(LikesRepresentationMixin, serializers.ModelSerializer):
     user = SimpleUserSerializer(read_only=True)
 
     class Meta:
         model = Post
-        fields = ["id", "user", "description", "picture", "picture_path", "likes", "created_at", "updated_at"]
+        fields = ["id", "user", "description", "picture", "picture_path", "likes", "moderation_status", "created_at", "updated_at"]
+        read_only_fields = ["moderation_status"]
+        list_serializer_class = PostListSerializer
 
     def validate(self, data):
         """
@@ -154,38 +264,61 @@ class PostSerializer(serializers.ModelSerializer):
         
         # Check content toxicity if description is provided
         if description:
-            try:
-                # Try to import and use the toxicity detection
-                import infer
-                should_block, reason, details = infer.should_block_content(description)
-                
-                if should_block:
-                    # Raise validation error to block the post
-                    raise serializers.ValidationError({
-                        "description": reason,
-                        "sentiment_analysis": {
-                            "negative": details['sentiment']['negative'],
-                            "positive": details['sentiment']['positive']
-                        },
-                        "toxicity_detected": details['primary_issue'],
-                        "confidence": details['confidence']
-                    })
-                    
-            except serializers.ValidationError:
-                # Re-raise validation errors (don't catch our own validation errors)
-                raise
-            except ImportError as e:
-                # If model is not available, log warning but don't block
-                import logging
-                logging.warning(f"Toxicity detection model not available: {str(e)}")
-            except Exception as e:
-                # Log error but don't block post creation for other errors
-                import logging
-                logging.error(f"Error in toxicity detection: {str(e)}")
+            check_toxicity(description, "description")
         
         return data
 
     def to_representation(self, instance):
+        return self.render_many([instance])[0]
+
+    def render_many(self, posts):
+        """
+        Serialize posts, reusing cached renderings where the post's version matches.
+
+        Relations are only prefetched for cache misses; hits just get their
+        viewer-specific flags overlaid.
+        """
+        variant = self.get_cache_variant()
+        rendered = fragment_cache.get_many(posts, variant)
+        hits = [post for post in posts if post.pk in rendered]
+        misses = [post for post in posts if post.pk not in rendered]
+
+        if misses:
+            prefetch_related_objects(misses, *self.get_prefetch_lookups(self.context))
+            fresh = {post.pk: self.render(post) for post in misses}
+            fragment_cache.set_many(misses, variant, fresh)
+            rendered.update(fresh)
+        if hits:
+            self.overlay_viewer(hits, rendered)
+
+        return [rendered[post.pk] for post in posts]
+
+    def get_cache_variant(self):
+        """Everything besides the post itself that changes its rendering"""
+        request = self.context.get('request')
+        # ImageField renders absolute URLs when a request is available
+        base_url = request.build_absolute_uri('/') if request is not None else ''
+        preview = get_comment_preview_size(self.context)
+        return f'{self.likes_mode}{self.likes_sample}:c{preview}:{base_url}'
+
+    def overlay_viewer(self, posts, rendered):
+        """Replace the viewer_has_liked flags stored with another viewer's rendering"""
+        if self.likes_mode != 'summary':
+            return
+        comment_ids = [comment['id'] for post in posts for comment in rendered[post.pk]['comments']]
+        liked_comments = set()
+        if self.viewer is not None and comment_ids:
+            liked_comments = set(Comment.likes.through.objects.filter(
+                comment_id__in=comment_ids, user=self.viewer
+            ).values_list('comment_id', flat=True))
+
+        for post in posts:
+            data = rendered[post.pk]
+            data['likes']['viewer_has_liked'] = self.viewer_has_liked(post)
+            for comment in data['comments']:
+                comment['likes']['viewer_has_liked'] = comment['id'] in liked_comments
+
+    def render(self, instance):
         data = super().to_representation(instance)
         
         # Add frontend-expected fields
@@ -196,24 +329,52 @@ class PostSerializer(serializers.ModelSerializer):
         # Use the actual picture filename from the uploaded file
         data['picturePath'] = instance.picture.name if instance.picture else ""
         data['userPicturePath'] = instance.user.picture.name if instance.user.picture else ""
+        data['pictureVariants'] = variant_urls(instance.picture_variants, self.context)
+        data['userPictureVariants'] = variant_urls(instance.user.picture_variants, self.context)
         data['createdAt'] = instance.created_at.isoformat()
         data['updatedAt'] = instance.updated_at.isoformat()
+        data['likes_count'] = instance.like_count
+        data['comments_count'] = instance.comment_count
         
         # Convert likes to the format expected by frontend
-        likes_dict = {}
-        for user in instance.likes.all():
-            likes_dict[str(user.id)] = True
-        data['likes'] = likes_dict
+        data['likes'] = self.represent_likes(instance)
         
-        # Get comments using CommentSerializer (newest first)
-        comments_data = []
-        for comment in instance.comments.all().order_by('-created_at'):
-            comment_serializer = CommentSerializer(comment)
-            comments_data.append(comment_serializer.data)
-        data['comments'] = comments_data
+        # Newest comments only; the full thread is paginated by post_comments
+        data['comments'] = CommentSerializer(self._get_comments(instance), many=True, context=self.context).data
         
         return data
 
+    def _get_comments(self, instance):
+        # The feed prefetch already holds the ordered preview; only query when it wasn't used
+        preview = getattr(instance, 'comment_preview', None)
+        if preview is not None:
+            return preview
+        comments = CommentSerializer.setup_eager_loading(
+            instance.comments.filter(moderation_status=Comment.PUBLISHED).order_by('-created_at', '-id'), self.context
+        )
+        return comments[:get_comment_preview_size(self.context)]
+
+    @staticmethod
+    def get_prefetch_lookups(context=None):
+        """Prefetch plan covering likers, the newest published comments, their authors and their likers"""
+        # Renderings are shared between viewers, so previews only ever show published comments
+        comments = CommentSerializer.setup_eager_loading(
+            Comment.objects.filter(moderation_status=Comment.PUBLISHED).order_by('-created_at', '-id'), context
+        )[:get_comment_preview_size(context)]
+        _, likes = likes_lookups(Post, context)
+        return likes + [Prefetch('comments', queryset=comments, to_attr='comment_preview')]
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, context=None):
+        """
+        Serialize a page of posts in a constant number of queries.
+
+        Only row-level data is loaded here; render_many prefetches the
+        get_prefetch_lookups() relations for posts missing from the cache.
+        """
+        annotations, _ = likes_lookups(Post, context)
+        return queryset.select_related('user').annotate(**annotations)
+
 class FriendRequestSerializer(serializers.ModelSerializer):
     sender = SimpleUserSerializer(read_only=True)
     receiver = SimpleUserSerializer(read_only=True)
@@ -237,13 +398,14 @@ class NotificationSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     sender = SimpleUserSerializer(read_only=True)
     image_url = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
     read_by = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
         fields = [
             'id', 'conversation', 'sender', 'content', 'image', 
-            'image_url', 'is_edited', 'is_deleted', 'created_at', 
+            'image_url', 'image_variants', 'is_edited', 'is_deleted', 'created_at', 
             'updated_at', 'read_by'
         ]
         read_only_fields = ['id', 'conversation', 'sender', 'created_at', 'updated_at', 'is_edited', 'is_deleted']
@@ -255,6 +417,9 @@ class MessageSerializer(serializers.ModelSerializer):
                 return request.build_absolute_uri(obj.image.url)
             return obj.image.url
         return None
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image_variants, self.context)
     
     def get_read_by(self, obj):
         """Get list of users who have read this message"""
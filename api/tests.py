@@ -1,3 +1,1749 @@
-from django.test import TestCase
+import datetime
+import decimal
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import SkipTest, mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .models import User, Post, Comment, TimelineEntry, Notification, FriendRequest, Conversation, Message, ImageJob, set_like
+from .serializers import NotificationSerializer, PostSerializer, UserSerializer
+from . import middleware
+from .middleware import choose_encoding
+from .moderation import ModerationUnavailable
+from .moderation import cache as moderation_cache
+from .moderation.batching import BatchingEngine, MicroBatcher
+from .moderation.client import ModerationClient
+from .moderation.engine import TransformersEngine, length_buckets
+from .moderation import prefilter, publishing, quantization
+from .moderation.server import make_server
+from .renderers import FastJSONParser, FastJSONRenderer
+from . import fragment_cache, images, timeline
+
+
+def make_user(username, **extra):
+    # No password: hashing dominates test time and tests authenticate with force_authenticate
+    return User.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        first_name=username.title(),
+        last_name='Tester',
+        **extra
+    )
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        # Primary keys are reused between tests, so cached renderings would leak across them
+        fragment_cache.clear()
+        fragment_cache.reset_stats()
+        moderation_cache.clear()
+        self.client = APIClient()
+
+
+@override_settings(POST_FRAGMENT_CACHE_ENABLED=False)
+class PostFeedQueryTests(APITestCase):
+    """The feed must cost the same number of queries however busy each post is"""
+
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.fans = [make_user(f'fan{i}') for i in range(4)]
+
+    def add_posts(self, count, comments_per_post):
+        for i in range(count):
+            post = Post.objects.create(user=self.author, description=f'post {i}')
+            post.likes.set(self.fans)
+            for j in range(comments_per_post):
+                fan = self.fans[j % len(self.fans)]
+                comment = Comment.objects.create(user=fan, post=post, comment=f'comment {j}')
+                comment.likes.set(self.fans[:2])
+        call_command('repair_counters', stdout=StringIO())
+
+    def test_feed_query_count_is_constant(self):
+        self.add_posts(2, 1)
+        # posts + authors, post likers, comments + authors, comment likers
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/posts/')
+        self.assertEqual(response.status_code, 200)
+
+        self.add_posts(8, 6)
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/posts/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['posts']), 10)
+
+    def test_comments_are_newest_first_with_likes(self):
+        self.add_posts(1, 3)
+        response = self.client.get('/api/posts/')
+        comments = response.data['posts'][0]['comments']
+        self.assertEqual([c['comment'] for c in comments], ['comment 2', 'comment 1', 'comment 0'])
+        self.assertEqual(comments[0]['likes_count'], 2)
+        self.assertEqual(set(comments[0]['likes']), {str(f.id) for f in self.fans[:2]})
+
+
+@override_settings(POST_FRAGMENT_CACHE_ENABLED=False)
+class PostCursorPaginationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        for i in range(7):
+            Post.objects.create(user=self.author, description=f'post {i}')
+        # Force timestamp ties so the id tiebreaker is exercised
+        Post.objects.filter(description__in=['post 2', 'post 3', 'post 4']).update(
+            created_at=Post.objects.get(description='post 3').created_at
+        )
+
+    def walk(self, limit):
+        seen, cursor = [], None
+        while True:
+            params = {'limit': limit}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/posts/', params)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(p['id'] for p in response.data['posts'])
+            cursor = response.data['pagination']['nextCursor']
+            if not cursor:
+                return seen, response
+
+    def test_cursor_walk_visits_every_post_once_in_order(self):
+        expected = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        seen, last = self.walk(limit=2)
+        self.assertEqual(seen, expected)
+        self.assertNotIn('totalPages', last.data['pagination'])
+        self.assertFalse(last.data['pagination']['hasNextPage'])
+
+    def test_previous_cursor_returns_preceding_page(self):
+        first = self.client.get('/api/posts/', {'limit': 3}).data
+        second = self.client.get('/api/posts/', {'limit': 3, 'cursor': first['pagination']['nextCursor']}).data
+        back = self.client.get('/api/posts/', {'limit': 3, 'cursor': second['pagination']['prevCursor']}).data
+        self.assertEqual([p['id'] for p in back['posts']], [p['id'] for p in first['posts']])
+
+    def test_deep_page_costs_the_same_as_first_page(self):
+        first = self.client.get('/api/posts/', {'limit': 2}).data
+        cursor = first['pagination']['nextCursor']
+        # posts + authors, post likers, comments + authors; no COUNT(*) and no OFFSET
+        with self.assertNumQueries(3):
+            self.client.get('/api/posts/', {'limit': 2})
+        with self.assertNumQueries(3):
+            self.client.get('/api/posts/', {'limit': 2, 'cursor': cursor})
+
+    def test_page_numbers_remain_available(self):
+        response = self.client.get('/api/posts/', {'page': 2, 'limit': 3})
+        pagination = response.data['pagination']
+        self.assertEqual(pagination['currentPage'], 2)
+        self.assertEqual(pagination['totalPages'], 3)
+        self.assertEqual(pagination['totalPosts'], 7)
+
+    def test_invalid_cursor_is_404(self):
+        response = self.client.get('/api/posts/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class HomeTimelineTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.reader = make_user('reader')
+        self.friend = make_user('friend')
+        self.stranger = make_user('stranger')
+        self.reader.friends.add(self.friend)
+        self.client.force_authenticate(self.reader)
+
+    def publish(self, user, description):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/api/posts/', {'description': description}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Post.objects.get(id=response.data['id'])
+
+    def feed_descriptions(self, **params):
+        response = self.client.get('/api/feed/home/', params)
+        self.assertEqual(response.status_code, 200)
+        return [p['description'] for p in response.data['posts']], response.data['pagination']
+
+    def test_posts_fan_out_to_friends_only(self):
+        self.publish(self.friend, 'from friend')
+        self.publish(self.stranger, 'from stranger')
+        self.publish(self.reader, 'my own')
+        descriptions, _ = self.feed_descriptions()
+        self.assertEqual(descriptions, ['my own', 'from friend'])
+
+    def test_deleting_a_post_removes_it_from_timelines(self):
+        post = self.publish(self.friend, 'short lived')
+        self.assertTrue(TimelineEntry.objects.filter(user=self.reader, post=post).exists())
+        post.delete()
+        self.assertFalse(TimelineEntry.objects.filter(post_id=post.id).exists())
+
+    def test_timeline_pages_with_cursor(self):
+        for i in range(5):
+            self.publish(self.friend, f'post {i}')
+        first, pagination = self.feed_descriptions(limit=3)
+        rest, last = self.feed_descriptions(limit=3, cursor=pagination['nextCursor'])
+        self.assertEqual(first + rest, [f'post {i}' for i in range(4, -1, -1)])
+        self.assertFalse(last['hasNextPage'])
+
+    @override_settings(TIMELINE_FANOUT_LIMIT=0)
+    def test_high_fanout_authors_are_pulled_at_read_time(self):
+        post = self.publish(self.friend, 'celebrity post')
+        self.assertFalse(post.fanned_out)
+        self.friend.refresh_from_db()
+        self.assertTrue(self.friend.high_fanout)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+        self.publish(self.reader, 'my own')
+        descriptions, _ = self.feed_descriptions()
+        self.assertEqual(descriptions, ['my own', 'celebrity post'])
+
+    def test_rebuild_only_fans_out_published_posts(self):
+        self.publish(self.friend, 'kept')
+        for status in (Post.PENDING, Post.REJECTED):
+            Post.objects.create(user=self.friend, description=status, moderation_status=status)
+        User.objects.filter(id=self.stranger.id).update(high_fanout=True)
+        self.reader.friends.add(self.stranger)
+        self.publish(self.stranger, 'pulled')
+
+        call_command('rebuild_timelines', '--clear', stdout=StringIO())
+        self.assertEqual(self.feed_descriptions()[0], ['pulled', 'kept'])
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader, post__user=self.stranger).exists())
+        self.assertFalse(TimelineEntry.objects.exclude(post__moderation_status=Post.PUBLISHED).exists())
+
+    def test_existing_pulled_authors_are_flagged_by_migration(self):
+        import importlib
+        from django.apps import apps
+
+        migration = importlib.import_module('api.migrations.0022_user_high_fanout')
+        Post.objects.create(user=self.friend, description='pulled', fanned_out=False)
+        self.publish(self.stranger, 'fanned out')
+        migration.flag_pulled_authors(apps, None)
+        self.assertEqual(list(User.objects.filter(high_fanout=True)), [self.friend])
+        self.assertEqual(timeline._pulled_author_ids(self.reader), [self.friend.id])
+
+    def test_friendship_changes_update_timeline(self):
+        self.publish(self.stranger, 'before friendship')
+        self.assertEqual(self.feed_descriptions()[0], [])
+        self.reader.friends.add(self.stranger)
+        timeline.add_friend_posts(self.reader, self.stranger)
+        self.assertEqual(self.feed_descriptions()[0], ['before friendship'])
+        timeline.remove_friend_posts(self.reader, self.stranger)
+        self.assertEqual(self.feed_descriptions()[0], [])
+
+    def test_unpublished_posts_stay_out_of_feeds(self):
+        self.publish(self.stranger, 'kept')
+        for status in (Post.PENDING, Post.REJECTED):
+            Post.objects.create(user=self.stranger, description=status, moderation_status=status)
+        self.reader.friends.add(self.stranger)
+        timeline.add_friend_posts(self.reader, self.stranger)
+        self.assertEqual(self.feed_descriptions()[0], ['kept'])
+
+        # A timeline entry left behind when a post goes back to pending is not served either
+        post = self.publish(self.friend, 'edited')
+        Post.objects.filter(id=post.id).update(moderation_status=Post.PENDING)
+        self.assertEqual(self.feed_descriptions()[0], ['kept'])
+
+        with override_settings(TIMELINE_FANOUT_LIMIT=0):
+            self.publish(self.friend, 'pulled')
+            Post.objects.create(user=self.friend, description='rejected', moderation_status=Post.REJECTED, fanned_out=False)
+            self.assertEqual(self.feed_descriptions()[0], ['pulled', 'kept'])
+
+
+class CounterTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.fan = make_user('fan')
+        self.post = Post.objects.create(user=self.author, description='hello')
+        self.client.force_authenticate(self.fan)
+
+    def test_like_and_comment_counters_follow_actions(self):
+        self.assertEqual(self.client.post(f'/api/posts/{self.post.id}/like/').data['likes_count'], 1)
+        response = self.client.post('/api/comments/', {'post_id': self.post.id, 'comment': 'nice'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        comment_id = response.data['id']
+        self.assertEqual(self.client.post(f'/api/comments/{comment_id}/like/').data['likes_count'], 1)
+
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.comment_count), (1, 1))
+
+        self.assertEqual(self.client.post(f'/api/posts/{self.post.id}/like/').data['likes_count'], 0)
+        self.client.delete(f'/api/comments/{comment_id}/')
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.comment_count), (0, 0))
+
+    def test_feed_reads_stored_counters(self):
+        Post.objects.filter(id=self.post.id).update(like_count=41, comment_count=7)
+        post = self.client.get('/api/posts/').data['posts'][0]
+        self.assertEqual((post['likes_count'], post['comments_count']), (41, 7))
+
+    def test_repair_counters_fixes_drift(self):
+        self.post.likes.add(self.fan)
+        comment = Comment.objects.create(user=self.fan, post=self.post, comment='hi')
+        comment.likes.add(self.author)
+        Post.objects.filter(id=self.post.id).update(like_count=99, comment_count=99)
+
+        call_command('repair_counters', chunk_size=1, stdout=StringIO())
+
+        self.post.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.comment_count, comment.like_count), (1, 1, 1))
+
+
+class LikeToggleTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.fan = make_user('fan')
+        self.post = Post.objects.create(user=self.author, description='hello')
+        self.client.force_authenticate(self.fan)
+        self.url = f'/api/posts/{self.post.id}/like/'
+
+    def test_explicit_verbs_are_idempotent(self):
+        for _ in range(2):
+            response = self.client.put(self.url)
+            self.assertEqual((response.data['liked'], response.data['likes_count']), (True, 1))
+        self.assertEqual(self.post.likes.count(), 1)
+        for _ in range(2):
+            response = self.client.delete(self.url)
+            self.assertEqual((response.data['liked'], response.data['likes_count']), (False, 0))
+        self.assertEqual(self.post.likes.count(), 0)
+
+    def test_repeated_like_does_not_renotify(self):
+        self.client.put(self.url)
+        self.client.put(self.url)
+        self.assertEqual(self.author.notifications.count(), 1)
+
+    def test_toggle_cost_does_not_grow_with_likers(self):
+        for i in range(30):
+            self.post.likes.add(make_user(f'liker{i}'))
+        self.client.post(self.url)
+        # fetch post, savepoint, indexed delete, counter update, counter refresh, release
+        with self.assertNumQueries(6):
+            response = self.client.post(self.url)
+        self.assertFalse(response.data['liked'])
+
+
+class LikesSummaryTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.viewer = make_user('viewer')
+        self.post = Post.objects.create(user=self.author, description='popular')
+        self.likers = [make_user(f'liker{i}') for i in range(25)] + [self.viewer]
+        self.post.likes.set(self.likers)
+        comment = Comment.objects.create(user=self.author, post=self.post, comment='thanks')
+        comment.likes.set(self.likers[:3])
+        call_command('repair_counters', stdout=StringIO())
+        self.client.force_authenticate(self.viewer)
+
+    def test_summary_replaces_full_likes_map(self):
+        post = self.client.get('/api/posts/', {'likes': 'summary', 'likes_sample': 3}).data['posts'][0]
+        self.assertEqual(post['likes']['count'], 26)
+        self.assertTrue(post['likes']['viewer_has_liked'])
+        self.assertEqual(len(post['likes']['sample']), 3)
+        comment = post['comments'][0]
+        self.assertEqual(comment['likes']['count'], 3)
+        self.assertFalse(comment['likes']['viewer_has_liked'])
+
+    def test_full_map_is_still_the_default(self):
+        post = self.client.get('/api/posts/').data['posts'][0]
+        self.assertEqual(len(post['likes']), 26)
+
+    def test_summary_without_sample_skips_liker_queries(self):
+        # posts + authors + viewer_has_liked, comments + authors + viewer_has_liked
+        with self.assertNumQueries(2):
+            self.client.get('/api/posts/', {'likes': 'summary'})
+
+    def test_likers_endpoint_is_paginated(self):
+        seen, url = [], f'/api/posts/{self.post.id}/likers/?limit=10'
+        while url:
+            data = self.client.get(url).data
+            self.assertLessEqual(len(data['likers']), 10)
+            seen.extend(user['id'] for user in data['likers'])
+            url = data['pagination']['next']
+        self.assertEqual(sorted(seen), sorted(user.id for user in self.likers))
+
+    def test_likers_get_absolute_picture_urls(self):
+        User.objects.filter(id=self.viewer.id).update(picture_variants={'64': 'viewer_64w.jpg'})
+        likers = self.client.get(f'/api/posts/{self.post.id}/likers/', {'limit': 100}).data['likers']
+        viewer = next(user for user in likers if user['id'] == self.viewer.id)
+        self.assertEqual(viewer['pictureVariants']['64'], 'http://testserver/assets/viewer_64w.jpg')
+
+
+class CommentThreadTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.post = Post.objects.create(user=self.author, description='busy thread')
+        for i in range(12):
+            Comment.objects.create(user=self.author, post=self.post, comment=f'comment {i}')
+        call_command('repair_counters', stdout=StringIO())
+
+    @override_settings(POST_COMMENT_PREVIEW_SIZE=3)
+    def test_feed_embeds_bounded_preview_and_total(self):
+        post = self.client.get('/api/posts/').data['posts'][0]
+        self.assertEqual([c['comment'] for c in post['comments']], ['comment 11', 'comment 10', 'comment 9'])
+        self.assertEqual(post['comments_count'], 12)
+        post = self.client.get('/api/posts/', {'comments_preview': 1}).data['posts'][0]
+        self.assertEqual(len(post['comments']), 1)
+
+    def test_thread_is_cursor_paginated(self):
+        url = f'/api/posts/{self.post.id}/comments/'
+        seen, params = [], {'limit': 5}
+        while True:
+            data = self.client.get(url, params).data
+            seen.extend(c['comment'] for c in data['comments'])
+            if not data['pagination']['nextCursor']:
+                break
+            params['cursor'] = data['pagination']['nextCursor']
+        self.assertEqual(seen, [f'comment {i}' for i in range(11, -1, -1)])
+
+    def test_thread_is_a_plain_list_unless_paged(self):
+        url = f'/api/posts/{self.post.id}/comments/'
+        data = self.client.get(url).data
+        self.assertEqual([c['comment'] for c in data], [f'comment {i}' for i in range(11, -1, -1)])
+        data = self.client.get(url, {'pagination': 'cursor'}).data
+        self.assertEqual(len(data['comments']), 12)
+        self.assertIsNone(data['pagination']['nextCursor'])
+
+    def test_thread_page_query_count(self):
+        url = f'/api/posts/{self.post.id}/comments/'
+        # post lookup, comments + authors, comment likers
+        with self.assertNumQueries(3):
+            self.client.get(url, {'limit': 5})
+
+
+class FragmentCacheTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.fan = make_user('fan')
+        self.post = Post.objects.create(user=self.author, description='cached')
+        Comment.objects.create(user=self.author, post=self.post, comment='first')
+
+    def test_warm_feed_skips_relation_queries(self):
+        self.client.get('/api/posts/')
+        # Only the page query itself; likes and comments come from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/posts/')
+        self.assertEqual(response.data['posts'][0]['comments'][0]['comment'], 'first')
+        self.assertEqual(fragment_cache.get_stats()['hits'], 1)
+
+    def test_benchmark_leaves_the_configured_cache_alone(self):
+        from django.core.cache import caches
+
+        live = caches['post_fragments']
+        with mock.patch.object(live, 'clear') as clear, mock.patch.object(live, 'set_many') as set_many:
+            call_command('benchmark_feed', '--posts=3', '--likers=2', '--comments=1', '--iterations=2', stdout=StringIO())
+        clear.assert_not_called()
+        set_many.assert_not_called()
+
+    def test_like_comment_and_edit_invalidate(self):
+        self.client.force_authenticate(self.fan)
+        self.client.get('/api/posts/')
+        self.client.put(f'/api/posts/{self.post.id}/like/')
+        self.client.post('/api/comments/', {'post_id': self.post.id, 'comment': 'second'}, format='json')
+        post = self.client.get('/api/posts/').data['posts'][0]
+        self.assertEqual(post['likes'], {str(self.fan.id): True})
+        self.assertEqual(post['comments'][0]['comment'], 'second')
+
+        self.client.force_authenticate(self.author)
+        self.client.patch(f'/api/posts/{self.post.id}/update_post/', {'description': 'edited'}, format='json')
+        self.assertEqual(self.client.get('/api/posts/').data['posts'][0]['description'], 'edited')
+
+    def test_author_changes_invalidate(self):
+        self.client.get('/api/posts/')
+        self.author.first_name = 'Renamed'
+        self.author.picture_variants = {'64': 'author_64w.jpg'}
+        self.author.save()
+        post = self.client.get('/api/posts/').data['posts'][0]
+        self.assertEqual((post['firstName'], post['user']['firstName']), ('Renamed', 'Renamed'))
+        self.assertEqual(post['userPictureVariants'], {'64': 'http://testserver/assets/author_64w.jpg'})
+
+    def test_viewer_flags_are_overlaid_on_cached_renderings(self):
+        set_like(self.post, self.fan, True)
+        self.client.force_authenticate(self.fan)
+        self.assertTrue(self.client.get('/api/posts/', {'likes': 'summary'}).data['posts'][0]['likes']['viewer_has_liked'])
+        self.client.force_authenticate(self.author)
+        post = self.client.get('/api/posts/', {'likes': 'summary'}).data['posts'][0]
+        self.assertFalse(post['likes']['viewer_has_liked'])
+        self.assertEqual(fragment_cache.get_stats()['hits'], 1)
+
+    def test_saving_a_post_keeps_concurrent_counter_updates(self):
+        stale = Post.objects.get(id=self.post.id)
+        set_like(self.post, self.fan, True)
+        stale.description = 'edited'
+        stale.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.description, self.post.like_count), ('edited', 1))
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.friend = make_user('friend')
+        self.author.friends.add(self.friend)
+        self.post = Post.objects.create(user=self.author, description='etag')
+        Notification.objects.create(user=self.author, from_user=self.friend, type=Notification.POST_LIKE, message='liked')
+        self.client.force_authenticate(self.author)
+
+    def revalidate(self, url, serializer):
+        """Fetch url, then replay it with If-None-Match; returns the second response"""
+        etag = self.client.get(url)['ETag']
+        with mock.patch.object(serializer, 'to_representation') as render:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertFalse(render.called)
+        return response
+
+    def test_unchanged_resources_skip_serializers(self):
+        for url, serializer in [
+            ('/api/posts/', PostSerializer),
+            (f'/api/posts/{self.post.id}/', PostSerializer),
+            (f'/api/users/{self.author.id}/', UserSerializer),
+            ('/api/notifications/', NotificationSerializer),
+        ]:
+            self.assertEqual(self.revalidate(url, serializer).status_code, 304, url)
+
+        url = f'/api/users/{self.author.id}/friends/'
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_changes_produce_a_new_representation(self):
+        feed_etag = self.client.get('/api/posts/')['ETag']
+        set_like(self.post, self.friend, True)
+        response = self.client.get('/api/posts/', HTTP_IF_NONE_MATCH=feed_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['posts'][0]['likes_count'], 1)
+
+        user_etag = self.client.get(f'/api/users/{self.author.id}/')['ETag']
+        self.author.friends.remove(self.friend)
+        response = self.client.get(f'/api/users/{self.author.id}/', HTTP_IF_NONE_MATCH=user_etag)
+        self.assertEqual(response.data['friends'], [])
+
+        notifications_etag = self.client.get('/api/notifications/')['ETag']
+        self.client.post(f'/api/notifications/{Notification.objects.get().id}/read/')
+        response = self.client.get('/api/notifications/', HTTP_IF_NONE_MATCH=notifications_etag)
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_etags_are_per_viewer(self):
+        etag = self.client.get('/api/posts/')['ETag']
+        self.client.force_authenticate(self.friend)
+        self.assertEqual(self.client.get('/api/posts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class QueryPlanTests(TestCase):
+    """Hot-path queries must be served by an index, not a full table scan"""
+
+    def setUp(self):
+        self.user = make_user('planner')
+        self.post = Post.objects.create(user=self.user, description='plan')
+        self.conversation = Conversation.objects.create()
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would always be scanned; make the planner show its index choice
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assertUsesIndex(self, queryset, ordered=False):
+        plan = self.explain(queryset)
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan)
+            if ordered:
+                self.assertNotIn('Sort', plan)
+        elif connection.vendor == 'sqlite':
+            for line in plan.splitlines():
+                if 'SCAN' in line and 'USING' not in line and 'CONSTANT ROW' not in line:
+                    self.fail(f'Full scan in plan:\n{plan}')
+            if ordered:
+                self.assertNotIn('TEMP B-TREE FOR ORDER BY', plan)
+
+    def test_feed_and_profile_pages(self):
+        self.assertUsesIndex(Post.objects.order_by('-created_at', '-id')[:11], ordered=True)
+        self.assertUsesIndex(Post.objects.filter(user=self.user).order_by('-created_at', '-id')[:11], ordered=True)
+        self.assertUsesIndex(self.user.friends.filter(high_fanout=True).values_list('id', flat=True))
+
+    def test_comment_threads(self):
+        self.assertUsesIndex(Comment.objects.filter(post=self.post).order_by('-created_at', '-id')[:21], ordered=True)
+
+    def test_notifications(self):
+        self.assertUsesIndex(Notification.objects.filter(user=self.user), ordered=True)
+        self.assertUsesIndex(Notification.objects.filter(user=self.user, is_read=False).values('id'))
+
+    def test_messages(self):
+        self.assertUsesIndex(Message.objects.filter(conversation=self.conversation, is_deleted=False), ordered=True)
+
+    def test_friend_requests(self):
+        self.assertUsesIndex(FriendRequest.objects.filter(receiver=self.user, status=FriendRequest.PENDING))
+        self.assertUsesIndex(FriendRequest.objects.filter(sender=self.user, status=FriendRequest.PENDING))
+
+    def test_login_by_email(self):
+        self.assertUsesIndex(User.objects.filter(email='planner@example.com'))
+
+
+class FastJSONTests(TestCase):
+    def test_output_matches_drf_renderer(self):
+        data = {
+            'created_at': timezone.now(),
+            'day': datetime.date(2024, 1, 2),
+            'price': decimal.Decimal('1.50'),
+            'label': gettext_lazy('Post Like'),
+            'text': 'caf\u00e9 \u2028 line',
+            'likes': {1: True},
+            'nested': [{'none': None, 'float': 0.5}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_parser_round_trip(self):
+        body = FastJSONRenderer().render({'comment': 'hi \u00e9', 'post_id': 3})
+        self.assertEqual(FastJSONParser().parse(BytesIO(body)), {'comment': 'hi \u00e9', 'post_id': 3})
+
+
+@override_settings(COMPRESSION_MIN_SIZE=200)
+class CompressionTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        author = make_user('author')
+        for i in range(10):
+            Post.objects.create(user=author, description=f'a reasonably long post description number {i}')
+
+    def test_large_json_is_gzipped(self):
+        plain = self.client.get('/api/posts/')
+        response = self.client.get('/api/posts/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertLess(len(response.content), len(plain.content))
+        # Weakened ETag still revalidates
+        self.assertTrue(response['ETag'].startswith('W/'))
+        response = self.client.get('/api/posts/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_small_or_refused_responses_are_left_alone(self):
+        with self.settings(COMPRESSION_MIN_SIZE=10 ** 6):
+            self.assertNotIn('Content-Encoding', self.client.get('/api/posts/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertNotIn('Content-Encoding', self.client.get('/api/posts/', HTTP_ACCEPT_ENCODING='gzip;q=0'))
+
+    def test_encoding_negotiation(self):
+        self.assertEqual(choose_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(choose_encoding('identity'))
+        self.assertIsNone(choose_encoding('gzip;q=0, *;q=0'))
+        with mock.patch('api.middleware.brotli', None):
+            self.assertEqual(choose_encoding('*'), 'gzip')
+            self.assertEqual(choose_encoding('br, gzip'), 'gzip')
+        with mock.patch('api.middleware.brotli', mock.Mock()):
+            self.assertEqual(choose_encoding('*'), 'br')
+            self.assertEqual(choose_encoding('br;q=0, gzip'), 'gzip')
+            self.assertEqual(choose_encoding('br, gzip', allow_brotli=False), 'gzip')
+
+    @skipUnless(middleware.brotli, 'brotli is not installed')
+    def test_large_json_is_brotli_compressed_with_random_padding(self):
+        plain = self.client.get('/api/posts/')
+        sizes = set()
+        for _ in range(5):
+            response = self.client.get('/api/posts/', HTTP_ACCEPT_ENCODING='br, gzip')
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(middleware.brotli.decompress(response.content), plain.content)
+            sizes.add(len(response.content))
+        # The length varies between identical responses (BREACH mitigation)
+        self.assertGreater(len(sizes), 1)
+
+
+class KeywordEngine:
+    """Stands in for infer.py: blocks text containing 'awful'"""
+    delay = 0
+
+    def should_block_content(self, text):
+        time.sleep(self.delay)
+        blocked = 'awful' in text
+        details = {
+            'sentiment': {'negative': 0.9 if blocked else 0.1, 'positive': 0.1 if blocked else 0.9},
+            'primary_issue': 'toxic' if blocked else None,
+            'confidence': 0.95,
+        }
+        return blocked, 'Content flagged as toxic' if blocked else 'Content is appropriate', details
+
+
+class ModerationServerTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.address = 'unix:' + os.path.join(self.tmpdir.name, 'moderation.sock')
+        self.engine = KeywordEngine()
+        self.server = make_server(self.address, self.engine)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client.force_authenticate(make_user('author'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_serializers_use_the_server(self):
+        with self.settings(MODERATION_BACKEND='server', MODERATION_ADDRESS=self.address):
+            response = self.client.post('/api/posts/', {'description': 'an awful post'}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['toxicity_detected'][0], 'toxic')
+
+            response = self.client.post('/api/posts/', {'description': 'a nice post'}, format='json')
+            self.assertEqual(response.status_code, 201)
+            comment = {'post_id': response.data['id'], 'comment': 'awful'}
+            self.assertEqual(self.client.post('/api/comments/', comment, format='json').status_code, 400)
+
+    def test_client_reuses_its_connection(self):
+        client = ModerationClient(self.address, timeout=1)
+        self.assertFalse(client.check('fine')[0])
+        sock = client._local.sock
+        self.assertTrue(client.check('awful')[0])
+        self.assertIs(client._local.sock, sock)
+        client.close()
+
+    def test_timeouts_and_outages_fail_open(self):
+        self.engine.delay = 0.5
+        started = time.monotonic()
+        with self.assertRaises(ModerationUnavailable):
+            ModerationClient(self.address, timeout=0.1).check('awful')
+        self.assertLess(time.monotonic() - started, 0.4)
+
+        missing = 'unix:' + os.path.join(self.tmpdir.name, 'missing.sock')
+        with self.settings(MODERATION_BACKEND='server', MODERATION_ADDRESS=missing):
+            response = self.client.post('/api/posts/', {'description': 'an awful post'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+
+class MicroBatchingTests(TestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        batches = []
+
+        def process(items):
+            batches.append(list(items))
+            time.sleep(0.01)
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait=0.05)
+        futures = [batcher.submit(i) for i in range(10)]
+        self.assertEqual([future.result(1) for future in futures], [i * 2 for i in range(10)])
+        self.assertLess(len(batches), 10)
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+
+    def test_errors_reach_every_caller_in_the_batch(self):
+        def process(items):
+            raise RuntimeError('model crashed')
+
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait=0.01)
+        futures = [batcher.submit(i) for i in range(3)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(1)
+
+    def test_wrong_result_count_fails_every_caller(self):
+        batcher = MicroBatcher(lambda items: items[:1], max_batch_size=4, max_wait=0.05)
+        futures = [batcher.submit(i) for i in range(3)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(1)
+
+    def test_callers_give_up_after_the_timeout(self):
+        started, release = threading.Event(), threading.Event()
+        batches = []
+
+        def process(items):
+            batches.append(list(items))
+            started.set()
+            release.wait(1)
+            return items
+
+        batcher = MicroBatcher(process, max_batch_size=1, max_wait=0, timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            batcher('slow')
+        started.wait(1)
+        with self.assertRaises(TimeoutError):
+            batcher('abandoned')  # Queued behind the slow batch
+        release.set()
+        self.assertEqual(batcher('next', timeout=1), 'next')
+        self.assertEqual(batches, [['slow'], ['next']])
+
+    def test_engines_without_batch_support_are_called_per_item(self):
+        engine = BatchingEngine(KeywordEngine(), max_batch_size=8, max_wait=0.01)
+        self.assertTrue(engine.should_block_content('awful')[0])
+        self.assertFalse(engine.should_block_content('fine')[0])
+
+    def test_length_buckets_group_similar_lengths(self):
+        texts = ['a' * 10, 'b' * 500, 'c' * 12, 'd' * 480, 'e' * 11]
+        buckets = length_buckets(texts, max_bucket_size=2)
+        self.assertEqual(sorted(i for bucket in buckets for i in bucket), list(range(5)))
+        self.assertTrue(all(len(bucket) <= 2 for bucket in buckets))
+        for bucket in buckets:
+            lengths = [len(texts[i]) for i in bucket]
+            self.assertLessEqual(max(lengths), 2 * max(min(lengths), 16))
+
+
+class InferParityTests(TestCase):
+    """TransformersEngine against infer.py on the parity corpus, where the real models are present"""
+
+    @classmethod
+    def setUpClass(cls):
+        from .moderation import local
+
+        # Before TestCase's class-wide transaction, which a skip here would leave open
+        try:
+            cls.infer = local.load_infer()
+            cls.engine = TransformersEngine()
+        except Exception as e:  # e.g. Git LFS pointers instead of the models
+            raise SkipTest(f'combined_model unavailable: {e}')
+        super().setUpClass()
+
+    def test_batched_verdicts_match_infer(self):
+        from .management.commands.moderation_parity import DEFAULT_CORPUS
+
+        with open(DEFAULT_CORPUS) as f:
+            texts = [json.loads(line)['text'] for line in f if line.strip()]
+        batched = self.engine.should_block_content_batch(texts)
+        for text, verdict in zip(texts, batched):
+            expected = self.infer.should_block_content(text)
+            self.assertEqual(verdict[:2], tuple(expected[:2]), text)
+            self.assertAlmostEqual(verdict[2]['toxicity'], expected[2]['toxicity'], places=4, msg=text)
+            self.assertAlmostEqual(
+                verdict[2]['sentiment']['negative'], expected[2]['sentiment']['negative'], places=4, msg=text
+            )
+
+
+class VerdictCacheTests(TestCase):
+    def setUp(self):
+        moderation_cache.clear()
+        self.calls = []
+
+    def tearDown(self):
+        moderation_cache.clear()
+
+    def check(self, text):
+        self.calls.append(text)
+        return KeywordEngine().should_block_content(text)
+
+    def test_resubmitted_text_is_scored_once(self):
+        first = moderation_cache.cached(self.check, 'an awful  post')
+        second = moderation_cache.cached(self.check, '  an awful post\n')
+        self.assertEqual(first, second)
+        self.assertTrue(first[0])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(moderation_cache.get_stats()['memory_hits'], 1)
+
+    @override_settings(MODERATION_CACHE_VERSION_TTL=0)
+    def test_model_change_invalidates(self):
+        with mock.patch.object(moderation_cache, 'compute_model_version', side_effect=['v1', 'v1', 'v2']):
+            for _ in range(3):
+                moderation_cache.cached(self.check, 'hello')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_scoring_settings_invalidate(self):
+        moderation_cache.cached(self.check, 'hello')
+        for overrides in (
+            {'MODERATION_ENGINE': 'transformers'},
+            {'MODERATION_TOXIC_THRESHOLD': 0.7},
+            {'MODERATION_NEGATIVE_THRESHOLD': 0.9},
+        ):
+            with self.settings(**overrides):
+                moderation_cache.cached(self.check, 'hello')
+        moderation_cache.cached(self.check, 'hello')
+        self.assertEqual(len(self.calls), 4)
+
+    def test_model_version_tracks_files(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            path = os.path.join(model_dir, 'config.json')
+            with open(path, 'w') as f:
+                f.write('{}')
+            before = moderation_cache.compute_model_version(model_dir)
+            with open(path, 'w') as f:
+                f.write('{"changed": true}')
+            self.assertNotEqual(moderation_cache.compute_model_version(model_dir), before)
+
+    @override_settings(MODERATION_CACHE_ALIAS='default')
+    def test_shared_tier_survives_process_cache_loss(self):
+        moderation_cache.cached(self.check, 'shared text')
+        moderation_cache.clear()
+        verdict = moderation_cache.cached(self.check, 'shared text')
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(verdict[1], 'Content is appropriate')
+        self.assertEqual(moderation_cache.get_stats()['shared_hits'], 1)
+
+
+
+class PrefilterTests(TestCase):
+    def setUp(self):
+        prefilter.clear()
+        self.calls = []
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(prefilter.clear)
+        self.model_path = os.path.join(self.tmp.name, 'prefilter.json')
+        samples = [('lovely sunny walk', False), ('see the new puppy', False), ('you are trash', True), ('utter trash person', True)]
+        prefilter.LinearModel().fit([(prefilter.tokens(text), label) for text, label in samples * 5]).save(self.model_path)
+
+    def check(self, text):
+        self.calls.append(text)
+        return KeywordEngine().should_block_content(text)
+
+    def cascade(self, *texts, **overrides):
+        options = dict(
+            MODERATION_PREFILTER_MODEL=self.model_path, MODERATION_PREFILTER_MAX_SKIP=1.0,
+            MODERATION_PREFILTER_ALLOW_BELOW=0.1, MODERATION_PREFILTER_BLOCK_ABOVE=0.8,
+        )
+        options.update(overrides)
+        with override_settings(**options):
+            return [prefilter.cascade(text, self.check) for text in texts]
+
+    def test_cheap_tiers_skip_the_models(self):
+        verdicts = self.cascade('Just KYS already', 'Happy birthday my friend!', 'total trash', 'lovely sunny puppy', 'an awful zebra')
+        self.assertEqual([v[0] for v in verdicts], [True, False, True, False, True])
+        self.assertEqual([v[2].get('tier') for v in verdicts], ['lexical', 'lexical', 'linear', 'linear', None])
+        self.assertEqual(self.calls, ['an awful zebra'])
+        stats = prefilter.get_stats()
+        self.assertEqual((stats['lexical_hit_rate'], stats['linear_hit_rate'], stats['model_hit_rate']), (0.4, 0.4, 0.2))
+
+    def test_skip_cap_audits_cheap_verdicts(self):
+        # The linear tier allows this, but the models block it
+        verdicts = self.cascade(*['an awful sunny walk'] * 10, MODERATION_PREFILTER_MAX_SKIP=0.5)
+        stats = prefilter.get_stats()
+        self.assertEqual(len(self.calls), 5)
+        self.assertEqual(sum(v[0] for v in verdicts), 5)
+        self.assertEqual((stats['linear_hits'], stats['linear_audited'], stats['linear_agreement']), (5, 5, 0.0))
+
+    @override_settings(MODERATION_PREFILTER=True, MODERATION_PREFILTER_MAX_SKIP=1.0)
+    def test_check_content_uses_the_cascade(self):
+        from . import moderation
+        with mock.patch.object(moderation, '_check_models', side_effect=self.check):
+            self.assertTrue(moderation.check_content('kill yourself')[0])
+            self.assertTrue(moderation.check_content('so awful')[0])
+        self.assertEqual(self.calls, ['so awful'])
+
+    @override_settings(MODERATION_PREFILTER=True, MODERATION_PREFILTER_MAX_SKIP=1.0)
+    def test_list_changes_apply_to_cached_text(self):
+        from . import moderation
+
+        moderation_cache.clear()
+        self.addCleanup(moderation_cache.clear)
+        blocklist = os.path.join(self.tmp.name, 'blocklist.txt')
+        with open(blocklist, 'w') as f:
+            f.write('zebra\n')
+        with mock.patch.object(moderation, '_check_models', side_effect=self.check):
+            self.assertFalse(moderation.check_content('a zebra crossing')[0])
+            with self.settings(MODERATION_BLOCKLIST=blocklist):
+                self.assertTrue(moderation.check_content('a zebra crossing')[0])
+            # Back to the models, whose verdict was cached
+            self.assertFalse(moderation.check_content('a zebra crossing')[0])
+        self.assertEqual(self.calls, ['a zebra crossing'])
+
+def build_tiny_models(root):
+    """Write randomly initialised, BERT-shaped sentiment/toxic models under root"""
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + 'a nice awful post day great hate'.split()
+    for name, labels in (('sentiment', {0: 'NEGATIVE', 1: 'POSITIVE'}), ('toxic', {0: 'non-toxic', 1: 'toxic'})):
+        path = os.path.join(root, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+            f.write('\n'.join(vocab))
+        BertTokenizerFast(os.path.join(path, 'vocab.txt')).save_pretrained(path)
+        config = BertConfig(
+            vocab_size=len(vocab), hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+            intermediate_size=32, max_position_embeddings=64,
+            id2label=labels, label2id={label: i for i, label in labels.items()},
+        )
+        BertForSequenceClassification(config).save_pretrained(path)
+
+
+class QuantizedModeTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.model_dir = os.path.join(cls.tmpdir.name, 'models')
+        cls.out_dir = os.path.join(cls.tmpdir.name, 'int8')
+        build_tiny_models(cls.model_dir)
+        for name in ('sentiment', 'toxic'):
+            quantization.save_quantized(name, model_dir=cls.model_dir, out_dir=cls.out_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def test_int8_engine_tracks_fp32_scores(self):
+        fp32 = TransformersEngine(self.model_dir)
+        int8 = TransformersEngine(self.model_dir, mode='int8', quantized_dir=self.out_dir)
+        texts = ['a nice day', 'awful hate post ' * 5]
+        for a, b in zip(fp32.should_block_content_batch(texts), int8.should_block_content_batch(texts)):
+            self.assertAlmostEqual(a[2]['toxicity'], b[2]['toxicity'], places=2)
+            self.assertAlmostEqual(a[2]['sentiment']['negative'], b[2]['sentiment']['negative'], places=2)
+
+    def test_stale_quantized_files_are_not_used(self):
+        with mock.patch.object(quantization, 'compute_model_version', return_value='other'):
+            with self.assertLogs(level='WARNING') as logs:
+                quantization.load_model('toxic', 'int8', model_dir=self.model_dir, out_dir=self.out_dir)
+        self.assertIn('stale', logs.output[0])
+
+    @override_settings(MODERATION_BACKEND='local', MODERATION_CACHE_SIZE=0)
+    def test_local_backend_scores_with_the_configured_engine(self):
+        from .moderation import check_content, local
+
+        loads = []
+
+        def load_engine(batched=True):
+            loads.append((settings.MODERATION_ENGINE, settings.MODERATION_MODEL_MODE, batched))
+            return KeywordEngine()
+
+        self.addCleanup(local._engine.update, key=None, engine=None)
+        with mock.patch('api.moderation.engine.load_engine', side_effect=load_engine):
+            with self.settings(MODERATION_ENGINE='transformers', MODERATION_MODEL_MODE='int8'):
+                self.assertTrue(check_content('awful')[0])
+                self.assertFalse(check_content('fine')[0])
+            with self.settings(MODERATION_ENGINE='infer', MODERATION_MODEL_MODE='fp32'):
+                check_content('fine')
+        # One engine per configuration, unbatched as in the other in-process scorers
+        self.assertEqual(loads, [('transformers', 'int8', False), ('infer', 'fp32', False)])
+
+
+
+class JointTokenizationTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.model_dir = os.path.join(cls.tmpdir.name, 'models')
+        build_tiny_models(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def test_shared_tokenizer_encodes_once_and_matches_unbatched_scores(self):
+        import torch
+
+        engine = TransformersEngine(self.model_dir)
+        self.assertTrue(engine.shared_tokenizer)
+        texts = ['a nice day', 'an awful hate post', 'great']
+        with mock.patch.object(engine.tokenizers['sentiment'], 'tokenizer', wraps=engine.tokenizers['sentiment'].tokenizer) as tokenizer:
+            verdicts = engine.should_block_content_batch(texts)
+        self.assertEqual(tokenizer.call_count, 1)  # One bucket, one tokenizer call for both heads
+
+        _, toxic = engine.models['toxic']
+        for text, verdict in zip(texts, verdicts):
+            inputs = engine.models['toxic'][0](text, return_tensors='pt')
+            with torch.no_grad():
+                expected = toxic(**inputs).logits.softmax(dim=-1)[0, engine.toxic_index].item()
+            self.assertAlmostEqual(verdict[2]['toxicity'], expected, places=5)
+
+    def test_distinct_tokenizers_cache_encodings(self):
+        import torch
+        from transformers import BertTokenizerFast
+
+        self.addCleanup(torch.set_num_threads, torch.get_num_threads())
+        with tempfile.TemporaryDirectory() as root:
+            build_tiny_models(root)
+            toxic_dir = os.path.join(root, 'toxic')
+            BertTokenizerFast(os.path.join(toxic_dir, 'vocab.txt'), do_lower_case=False).save_pretrained(toxic_dir)
+            engine = TransformersEngine(root, threads=1)
+        self.assertFalse(engine.shared_tokenizer)
+        self.assertEqual(torch.get_num_threads(), 1)
+
+        toxic = engine.tokenizers['toxic']
+        with mock.patch.object(toxic, 'tokenizer', wraps=toxic.tokenizer) as tokenizer:
+            engine.should_block_content('a nice day')
+            engine.should_block_content('a nice day')
+            engine.should_block_content_batch(['a nice day', 'great post'])
+        self.assertEqual([call.args[0] for call in tokenizer.call_args_list], [['a nice day'], ['great post']])
+
+    @override_settings(MODERATION_CACHE_ALIAS='default')
+    def test_benchmark_suite_writes_comparable_json(self):
+        import functools
+        import torch
+        from django.core.cache import caches
+
+        self.addCleanup(moderation_cache.clear)
+        out = os.path.join(self.tmpdir.name, 'bench.json')
+        engine = functools.partial(TransformersEngine, self.model_dir)
+        with mock.patch('api.management.commands.benchmark_moderation_suite.TransformersEngine', engine), \
+                mock.patch.object(caches['default'], 'set') as shared_set:
+            call_command(
+                'benchmark_moderation_suite', '--modes=fp32,cached', '--lengths=4', '--batch-sizes=1,4',
+                f'--threads={torch.get_num_threads()}', '--texts=8', '--repeat=1', f'--json={out}', stdout=StringIO(),
+            )
+        with open(out) as f:
+            report = json.load(f)
+        self.assertEqual(set(report['loads']), {'fp32', 'cached'})
+        shared_set.assert_not_called()
+        # 2 modes x 2 corpora (synthetic, recorded) x 2 batch sizes
+        self.assertEqual(len(report['results']), 8)
+        self.assertTrue(all(row['p50_ms'] <= row['p99_ms'] and row['items_per_s'] > 0 for row in report['results']))
+
+@override_settings(MODERATION_ASYNC=True, MODERATION_BACKEND='server')
+class AsyncModerationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.friend = make_user('friend')
+        self.author.friends.add(self.friend)
+        self.post = Post.objects.create(user=self.friend, description='published')
+        self.client.force_authenticate(self.author)
+
+    def moderate(self):
+        with mock.patch('api.moderation.publishing.check_content_fail_open', side_effect=lambda text, _: KeywordEngine().should_block_content(text)):
+            with self.captureOnCommitCallbacks(execute=True):
+                return publishing.process_pending()
+
+    def test_create_returns_pending_without_scoring(self):
+        with mock.patch('api.moderation.check_content') as check:
+            response = self.client.post('/api/posts/', {'description': 'an awful post'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['moderation_status'], 'pending')
+        self.assertFalse(check.called)
+
+    def test_pending_content_is_hidden_from_other_viewers(self):
+        post_id = self.client.post('/api/posts/', {'description': 'nice'}, format='json').data['id']
+        self.client.post('/api/comments/', {'post_id': self.post.id, 'comment': 'nice too'}, format='json')
+        self.assertEqual(len(self.client.get('/api/posts/').data['posts']), 2)
+
+        self.client.force_authenticate(self.friend)
+        self.assertEqual([p['id'] for p in self.client.get('/api/posts/').data['posts']], [self.post.id])
+        self.assertEqual(self.client.get(f'/api/posts/{post_id}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/posts/{self.post.id}/comments/').data, [])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+
+    def test_worker_publishes_and_rejects(self):
+        nice = self.client.post('/api/posts/', {'description': 'nice'}, format='json').data['id']
+        awful = self.client.post('/api/posts/', {'description': 'awful'}, format='json').data['id']
+        self.client.post('/api/comments/', {'post_id': self.post.id, 'comment': 'lovely'}, format='json')
+
+        with mock.patch('api.moderation.publishing.send_notification_websocket') as push:
+            self.assertEqual(self.moderate(), (2, 1))
+        self.assertEqual(Post.objects.get(id=nice).moderation_status, Post.PUBLISHED)
+        self.assertEqual(Post.objects.get(id=awful).moderation_status, Post.REJECTED)
+        # Author hears every outcome; the commented post's owner gets the usual comment notification
+        pushed_to = sorted(call.args[0] for call in push.call_args_list)
+        self.assertEqual(pushed_to, sorted([self.author.id] * 3 + [self.friend.id]))
+        self.assertTrue(TimelineEntry.objects.filter(user=self.friend, post_id=nice).exists())
+        self.assertFalse(TimelineEntry.objects.filter(post_id=awful).exists())
+
+        self.client.force_authenticate(self.friend)
+        ids = [p['id'] for p in self.client.get('/api/posts/').data['posts']]
+        self.assertEqual(sorted(ids), sorted([nice, self.post.id]))
+        post = next(p for p in self.client.get('/api/posts/').data['posts'] if p['id'] == self.post.id)
+        self.assertEqual((post['comments_count'], post['comments'][0]['comment']), (1, 'lovely'))
+
+    def test_comments_need_a_visible_post(self):
+        hidden = Post.objects.create(user=self.friend, description='pending', moderation_status=Post.PENDING)
+        for post_id, status in ((hidden.id, 404), (999999, 404), ('abc', 400), (None, 400)):
+            data = {'comment': 'hi'} if post_id is None else {'post_id': post_id, 'comment': 'hi'}
+            self.assertEqual(self.client.post('/api/comments/', data, format='json').status_code, status)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_edits_go_back_through_moderation(self):
+        post = Post.objects.create(user=self.author, description='clean')
+        comment = Comment.objects.create(user=self.author, post=self.post, comment='clean')
+        Post.objects.filter(id=self.post.id).update(comment_count=1)
+
+        response = self.client.patch(f'/api/posts/{post.id}/', {'description': 'awful'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.patch(f'/api/comments/{comment.id}/', {'comment': 'awful'}, format='json')
+        self.client.patch(f'/api/posts/{post.id}/update_post/', {'description': 'awful again'}, format='json')
+        post.refresh_from_db()
+        self.assertEqual(post.moderation_status, Post.PENDING)
+        self.assertEqual(Comment.objects.get(id=comment.id).moderation_status, Comment.PENDING)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 0)
+
+        others = Comment.objects.create(user=self.friend, post=self.post, comment='theirs')
+        self.assertEqual(self.client.patch(f'/api/comments/{others.id}/', {'comment': 'mine'}, format='json').status_code, 403)
+        self.client.force_authenticate(self.friend)
+        self.assertEqual(self.client.get(f'/api/posts/{post.id}/').status_code, 404)
+
+        with mock.patch('api.moderation.publishing.send_notification_websocket'):
+            self.assertEqual(self.moderate(), (0, 2))
+        self.assertEqual(Post.objects.get(id=post.id).moderation_status, Post.REJECTED)
+
+    def test_workers_warn_when_their_events_cannot_leave_the_process(self):
+        for command in ('moderation_worker', 'image_worker'):
+            err = StringIO()
+            call_command(command, '--once', stdout=StringIO(), stderr=err)
+            self.assertIn('in-memory layer', err.getvalue())
+            with mock.patch(f'api.management.commands.{command}.channel_layer_is_shared', return_value=True):
+                err = StringIO()
+                call_command(command, '--once', stdout=StringIO(), stderr=err)
+                self.assertEqual(err.getvalue(), '')
+
+    def test_worker_scores_outside_transactions_and_skips_rows_edited_meanwhile(self):
+        post = Post.objects.create(user=self.author, description='nice', moderation_status=Post.PENDING)
+        held = Post.objects.create(user=self.author, description='nice', moderation_status=Post.PENDING)
+        Post.objects.filter(id=held.id).update(moderation_claimed_at=timezone.now())  # Another worker's
+
+        depth = len(connection.atomic_blocks)  # The test case's own transactions
+
+        def check(text, _):
+            self.assertEqual(len(connection.atomic_blocks), depth)
+            # The author edits while the models run
+            Post.objects.filter(id=post.id).update(description='awful')
+            publishing.text_edited(Post.objects.get(id=post.id))
+            return KeywordEngine().should_block_content(text)
+
+        with mock.patch('api.moderation.publishing.check_content_fail_open', side_effect=check):
+            self.assertEqual(publishing.process_pending(), (0, 0))
+        post.refresh_from_db()
+        self.assertEqual((post.moderation_status, post.moderation_claimed_at), (Post.PENDING, None))
+        self.assertEqual(Post.objects.get(id=held.id).moderation_status, Post.PENDING)
+
+        with mock.patch('api.moderation.publishing.send_notification_websocket'):
+            self.assertEqual(self.moderate(), (0, 1))
+        self.assertEqual(Post.objects.get(id=post.id).moderation_status, Post.REJECTED)
+        with override_settings(MODERATION_CLAIM_TIMEOUT=0):
+            self.assertEqual(publishing.claim(Post, 10), [held])
+
+
+class RemoderationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = make_user('author')
+        self.posts = [Post.objects.create(user=self.author, description=text) for text in ('nice', 'awful', 'fine', 'awful too')]
+        self.comment = Comment.objects.create(user=self.author, post=self.posts[0], comment='awful comment')
+        Post.objects.filter(id=self.posts[0].id).update(comment_count=1)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.checkpoint = os.path.join(self.tmp.name, 'checkpoint.json')
+        self.engine = KeywordEngine()
+        patcher = mock.patch('api.management.commands.remoderate_content.load_engine', return_value=self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def remoderate(self, *args):
+        call_command('remoderate_content', '--workers=0', '--batch-size=2', f'--checkpoint={self.checkpoint}', *args, stdout=StringIO())
+
+    def test_records_verdicts_and_resumes_from_checkpoint(self):
+        calls = []
+        original = self.engine.should_block_content
+
+        def flaky(text):
+            calls.append(text)
+            if len(calls) == 3:
+                raise RuntimeError('worker died')
+            return original(text)
+
+        with mock.patch.object(self.engine, 'should_block_content', side_effect=flaky):
+            with self.assertRaises(RuntimeError):
+                self.remoderate()
+            self.remoderate()
+        # The first batch was checkpointed, so only the rest was scored again
+        self.assertEqual(calls, ['nice', 'awful', 'fine', 'fine', 'awful too', 'awful comment'])
+
+        version = moderation_cache.get_model_version()
+        verdicts = dict(Post.objects.values_list('description', 'moderation_verdict'))
+        self.assertEqual([verdicts[t]['block'] for t in ('nice', 'awful', 'fine', 'awful too')], [False, True, False, True])
+        self.assertEqual(set(Post.objects.values_list('moderation_version', flat=True)), {version})
+        self.assertTrue(Comment.objects.get().moderation_verdict['block'])
+        # Verdicts only: nothing is taken down without --reject
+        self.assertEqual(Post.objects.filter(moderation_status=Post.PUBLISHED).count(), 4)
+
+        with mock.patch.object(self.engine, 'should_block_content') as check:
+            self.remoderate('--restart')
+        self.assertFalse(check.called)
+
+    def test_reject_takes_down_blocked_content(self):
+        with self.captureOnCommitCallbacks(execute=True), mock.patch('api.moderation.publishing.send_notification_websocket'):
+            self.remoderate('--reject')
+        self.assertEqual(
+            sorted(Post.objects.filter(moderation_status=Post.REJECTED).values_list('description', flat=True)),
+            ['awful', 'awful too'],
+        )
+        self.assertEqual(Comment.objects.get().moderation_status, Comment.REJECTED)
+        self.assertEqual(Post.objects.get(id=self.posts[0].id).comment_count, 0)
+        self.assertEqual(Notification.objects.filter(user=self.author, type=Notification.MODERATION_RESULT).count(), 3)
+
+    def test_taken_down_posts_leave_home_feeds(self):
+        reader = make_user('reader')
+        self.author.friends.add(reader)
+        for post in self.posts:
+            timeline.fan_out_post(post)
+        with self.captureOnCommitCallbacks(execute=True), mock.patch('api.moderation.publishing.send_notification_websocket'):
+            self.remoderate('--reject')
+        self.assertFalse(TimelineEntry.objects.filter(post__description__startswith='awful').exists())
+
+        self.client.force_authenticate(reader)
+        descriptions = [p['description'] for p in self.client.get('/api/feed/home/').data['posts']]
+        self.assertEqual(sorted(descriptions), ['fine', 'nice'])
+
+
+@override_settings(MODERATION_CHAT=True, MODERATION_BACKEND='server', MODERATION_CHAT_WORKERS=4, MODERATION_CHAT_BUDGET_MS=2000)
+class ChatModerationTests(TransactionTestCase):
+    """Chat moderation load test: the event loop keeps ticking while slow checks run"""
+    max_loop_lag = 0.05  # Target, in seconds; every check below blocks its thread for this long
+    messages = 24
+
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.alice, self.bob)
+        self.token = str(AccessToken.for_user(self.alice))
+        self.checked = []
+
+    def slow_check(self, text, log_suffix=''):
+        time.sleep(self.max_loop_lag)  # What an inline forward pass would do to the loop
+        self.checked.append(text)
+        return KeywordEngine().should_block_content(text)
+
+    async def converse(self):
+        import asyncio
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+        from .routing import websocket_urlpatterns
+
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/conversations/{self.conversation.id}/?token={self.token}'
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # connection_established
+
+        lags, done = [], asyncio.Event()
+
+        async def monitor():
+            loop = asyncio.get_running_loop()
+            while not done.is_set():
+                expected = loop.time() + 0.005
+                await asyncio.sleep(0.005)
+                lags.append(loop.time() - expected)
+
+        ticker = asyncio.ensure_future(monitor())
+        for i in range(self.messages):
+            text = f'awful {i}' if i % 3 == 0 else f'hello {i}'
+            await communicator.send_json_to({'type': 'message', 'message': {'content': text}})
+        events = []
+        while sum(e['type'] == 'message_deleted' for e in events) < self.messages // 3:
+            events.append(await communicator.receive_json_from(timeout=10))
+        done.set()
+        await ticker
+        await communicator.disconnect()
+        return events, lags
+
+    def test_flagged_messages_are_broadcast_then_retracted_without_loop_lag(self):
+        from asgiref.sync import async_to_sync
+
+        with mock.patch('api.moderation.chat.check_content_fail_open', side_effect=self.slow_check):
+            events, lags = async_to_sync(self.converse)()
+
+        sent = [e['message']['id'] for e in events if e['type'] == 'message']
+        retracted = [e['message_id'] for e in events if e['type'] == 'message_deleted']
+        self.assertEqual(len(sent), self.messages)
+        self.assertTrue(set(retracted) <= set(sent))
+        self.assertEqual(
+            set(Message.objects.filter(is_deleted=True).values_list('content', flat=True)),
+            {f'awful {i}' for i in range(0, self.messages, 3)},
+        )
+        self.assertTrue(all(e['reason'] for e in events if e['type'] == 'message_deleted'))
+        # Sequential checks would have blocked the loop for messages * max_loop_lag in total
+        self.assertLess(max(lags), self.max_loop_lag, f'event loop lagged {max(lags) * 1000:.0f}ms')
+
+    def test_messages_sent_and_edited_over_rest_are_checked(self):
+        from .moderation import chat
+
+        futures = []
+        schedule = chat.schedule_moderation
+
+        def tracked(*args):
+            futures.append(schedule(*args))
+            return futures[-1]
+
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        url = f'/api/conversations/{self.conversation.id}/messages/'
+        self.alice.friends.add(self.bob)
+        with mock.patch('api.moderation.chat.check_content_fail_open', side_effect=self.slow_check), \
+                mock.patch.object(chat, 'schedule_moderation', side_effect=tracked):
+            flagged = client.post(url, {'content': 'awful'}, format='json').data['id']
+            edited = client.post(url, {'content': 'hello'}, format='json').data['id']
+            for future in futures:
+                future.result(5)
+            self.assertFalse(Message.objects.get(id=edited).is_deleted)
+            self.assertEqual(client.patch(f'{url}{edited}/', {'content': 'awful now'}, format='json').status_code, 200)
+            futures[-1].result(5)
+        self.assertEqual(self.checked, ['awful', 'hello', 'awful now'])
+        self.assertEqual(set(Message.objects.filter(is_deleted=True).values_list('id', flat=True)), {flagged, edited})
+
+    @override_settings(MODERATION_CHAT_BUDGET_MS=1)
+    def test_checks_over_budget_fail_open(self):
+        from asgiref.sync import async_to_sync
+        from .moderation import chat
+
+        with mock.patch('api.moderation.chat.check_content_fail_open', side_effect=self.slow_check):
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertIsNone(async_to_sync(chat.moderate)('awful'))
+        self.assertIn('latency budget', logs.output[0])
+
+    def test_in_process_models_get_one_thread(self):
+        from .moderation import chat
+
+        self.assertEqual(chat.get_executor()._max_workers, 4)
+        with self.settings(MODERATION_BACKEND='local'):
+            self.assertEqual(chat.get_executor()._max_workers, 1)
+
+
+def jpeg_upload(name='photo.jpg', size=(2400, 1800)):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, format='JPEG', quality=95)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+def run_image_jobs():
+    call_command('image_worker', '--once', '--threads=1', stdout=StringIO(), stderr=StringIO())
+
+
+class ImagePipelineTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=self.media.name, IMAGE_ASYNC=True, IMAGE_WORKERS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = make_user('alice')
+        self.client.force_authenticate(self.user)
+
+    def drain(self):
+        with mock.patch.object(images, 'send_image_ready') as event, self.captureOnCommitCallbacks(execute=True):
+            call_command('image_worker', '--once', '--threads=1', stdout=StringIO(), stderr=StringIO())
+        return event
+
+    def test_upload_is_staged_raw_then_compressed_by_the_worker(self):
+        from PIL import Image
+        from . import models
+
+        with mock.patch('api.models.compress_image', wraps=models.compress_image) as compress:
+            response = self.client.post('/api/posts/', {'description': 'view', 'picture': jpeg_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(compress.called)
+        post = Post.objects.get()
+        staged = post.picture.name
+        self.assertTrue(staged.startswith('staging/'))
+        self.assertEqual(ImageJob.objects.get().staged_name, staged)
+        version = post.cache_version
+
+        event = self.drain()
+        post.refresh_from_db()
+        self.assertFalse(post.picture.name.startswith('staging/'))
+        self.assertEqual(post.picture_path, post.picture.url)
+        self.assertGreater(post.cache_version, version)
+        self.assertEqual(Image.open(post.picture.path).size, (1200, 900))
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, staged)))
+        self.assertFalse(ImageJob.objects.exists())
+        event.assert_called_once_with(f'notifications_{self.user.id}', 'post', post.id, post.picture.url)
+
+    def test_newer_upload_is_not_overwritten(self):
+        post = Post.objects.create(user=self.user, description='x', picture=jpeg_upload('first.jpg'))
+        first = post.picture.name
+        post.picture = jpeg_upload('second.jpg')
+        post.save()
+        self.drain()
+        post.refresh_from_db()
+        self.assertIn('second', post.picture.name)
+        self.assertFalse(post.picture.name.startswith('staging/'))
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, first)))
+
+    def test_message_images_are_announced_to_the_conversation(self):
+        conversation = Conversation.objects.create()
+        message = Message.objects.create(conversation=conversation, sender=self.user, image=jpeg_upload())
+        event = self.drain()
+        message.refresh_from_db()
+        self.assertFalse(message.image.name.startswith('staging/'))
+        event.assert_called_once_with(f'conversation_{conversation.id}', 'message', message.id, message.image.url)
+
+    def test_worker_records_variants(self):
+        from PIL import Image
+
+        Post.objects.create(user=self.user, description='x', picture=jpeg_upload())
+        self.drain()
+        post = Post.objects.get()
+        self.assertEqual(list(post.picture_variants), ['64', '160', '480', '1200'])
+        self.assertEqual(post.picture_variants['1200'], post.picture.name)
+        self.assertEqual(Image.open(os.path.join(self.media.name, post.picture_variants['160'])).size, (160, 120))
+
+    def test_failing_jobs_are_retried_then_left_staged(self):
+        Post.objects.create(user=self.user, description='x', picture=jpeg_upload())
+        with override_settings(IMAGE_MAX_ATTEMPTS=2), mock.patch.object(images, 'compress_image', side_effect=OSError('bad')):
+            with self.assertLogs(level='ERROR'), mock.patch('time.sleep'):
+                self.drain()
+        self.assertEqual(ImageJob.objects.get().attempts, 2)
+        self.assertTrue(Post.objects.get().picture.name.startswith('staging/'))
+
+    def test_failed_jobs_leave_no_files_behind(self):
+        Post.objects.create(user=self.user, description='x', picture=jpeg_upload())
+        staged = set(os.listdir(os.path.join(self.media.name, 'staging')))
+        # Fails after some variants and siblings are written
+        with override_settings(IMAGE_MAX_ATTEMPTS=2), mock.patch.object(images, 'encode_modern', side_effect=[{}, OSError('disk full')] * 2):
+            with self.assertLogs(level='ERROR'), mock.patch('time.sleep'):
+                self.drain()
+        self.assertEqual(os.listdir(self.media.name), ['staging'])
+        self.assertEqual(set(os.listdir(os.path.join(self.media.name, 'staging'))), staged)
+
+    def test_claimed_jobs_are_left_to_their_worker_until_stale(self):
+        Post.objects.create(user=self.user, description='x', picture=jpeg_upload())
+        job = ImageJob.objects.get()
+        self.assertTrue(images.claim(job.id))
+        self.assertFalse(images.claim(job.id))
+        self.assertEqual(images.pending_jobs(10), [])
+        ImageJob.objects.filter(id=job.id).update(claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(images.pending_jobs(10), [job.id])
+        self.drain()
+        self.assertFalse(Post.objects.get().picture.name.startswith('staging/'))
+
+    def test_lost_swap_deletes_its_output(self):
+        post = Post.objects.create(user=self.user, description='x', picture=jpeg_upload())
+        staged = post.picture.name
+        update = Post.objects.filter
+
+        def newer_upload_lands(*args, **kwargs):
+            # Another upload replaces the picture while the job encodes
+            if kwargs.get('picture') == staged:
+                Post.objects.filter(pk=post.pk).update(picture='other.jpg')
+            return update(*args, **kwargs)
+
+        with mock.patch.object(Post.objects, 'filter', side_effect=newer_upload_lands):
+            self.drain()
+        self.assertEqual(os.listdir(self.media.name), ['staging'])
+        self.assertEqual(os.listdir(os.path.join(self.media.name, 'staging')), [])
+        self.assertEqual(Post.objects.get().picture.name, 'other.jpg')
+
+
+class ImageVariantTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=self.media.name, IMAGE_VARIANT_SIZES=[64, 160, 480, 1200])
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = make_user('alice')
+        self.client.force_authenticate(self.user)
+
+    def size_of(self, name):
+        from PIL import Image
+        return Image.open(os.path.join(self.media.name, name)).size
+
+    def test_inline_upload_records_variants_exposed_by_serializers(self):
+        self.user.picture = jpeg_upload('me.jpg', size=(1000, 1000))
+        with mock.patch.object(images, 'build_variants') as build:
+            self.user.save()
+        # Only the compression runs on the request thread; the variants are an image job
+        self.assertFalse(build.called)
+        self.assertEqual(self.user.picture_variants, {})
+        self.assertTrue(ImageJob.objects.get().compressed)
+        run_image_jobs()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.picture_variants['480'], 'alice_me_480w.jpg')
+        # The 800px profile picture is already the best fit for the larger bounds
+        self.assertEqual(self.user.picture_variants['1200'], self.user.picture.name)
+
+        response = self.client.post('/api/posts/', {'description': 'view', 'picture': jpeg_upload()}, format='multipart')
+        run_image_jobs()
+        post = Post.objects.get(id=response.data['id'])
+        self.assertEqual(self.size_of(post.picture_variants['64']), (64, 48))
+        self.assertEqual(self.size_of(post.picture_variants['480']), (480, 360))
+
+        data = self.client.get(f'/api/posts/{post.id}/').data
+        self.assertEqual(data['pictureVariants']['160'], 'http://testserver/assets/' + post.picture_variants['160'])
+        self.assertEqual(data['userPictureVariants']['64'], 'http://testserver/assets/alice_me_64w.jpg')
+        self.assertEqual(data['user']['pictureVariants']['64'], data['userPictureVariants']['64'])
+
+        conversation = Conversation.objects.create()
+        message = Message.objects.create(conversation=conversation, sender=self.user, image=jpeg_upload('chat.png'))
+        run_image_jobs()
+        message.refresh_from_db()
+        from .serializers import MessageSerializer
+        self.assertEqual(MessageSerializer(message).data['image_variants']['64'], '/assets/' + message.image_variants['64'])
+
+    def test_backfill_builds_missing_variants(self):
+        from django.core.files.storage import default_storage
+        from django.core.files.base import ContentFile
+
+        name = default_storage.save('bob_old.jpg', ContentFile(jpeg_upload(size=(1200, 900)).read()))
+        post = Post.objects.create(user=self.user, description='old')
+        Post.objects.filter(id=post.id).update(picture=name)
+        Post.objects.create(user=self.user, description='gone')
+        Post.objects.filter(description='gone').update(picture='missing.jpg')
+
+        out = StringIO()
+        call_command('backfill_image_variants', stdout=out)
+        post.refresh_from_db()
+        self.assertEqual(self.size_of(post.picture_variants['160']), (160, 120))
+        self.assertIn('Built variants for 1 images (1 files missing', out.getvalue())
+        self.assertIn('160px', out.getvalue())
+
+        call_command('backfill_image_variants', stdout=out)
+        self.assertIn('Built variants for 0 images (1 files missing', out.getvalue())
+
+    def test_backfill_refreshes_authors_and_replaces_forced_variants(self):
+        from django.core.files.storage import default_storage
+        from django.core.files.base import ContentFile
+
+        name = default_storage.save('bob_me.jpg', ContentFile(jpeg_upload(size=(1200, 900)).read()))
+        User.objects.filter(id=self.user.id).update(picture=name, updated_at=timezone.now() - datetime.timedelta(days=1))
+        before = User.objects.get(id=self.user.id).updated_at
+
+        call_command('backfill_image_variants', stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertGreater(self.user.updated_at, before)
+        old = self.user.picture_variants
+        self.assertTrue(old)
+
+        with mock.patch.object(images, 'build_variants', return_value={'64': default_storage.save('bob_new_64w.jpg', ContentFile(b'x'))}):
+            call_command('backfill_image_variants', '--force', stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertTrue(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(self.user.picture_variants['64']))
+        self.assertFalse(any(default_storage.exists(variant) for variant in set(old.values()) - {name}))
+
+
+class ImageFormatTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=self.media.name, IMAGE_MODERN_FORMATS=['webp'], IMAGE_VARIANT_SIZES=[64])
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = make_user('alice')
+
+    def test_upload_gets_webp_siblings_served_by_accept(self):
+        self.user.picture = jpeg_upload('me.jpg', size=(400, 400))
+        self.user.save()
+        run_image_jobs()
+        self.user.refresh_from_db()
+        name = self.user.picture.name
+        for stored in (name, self.user.picture_variants['64']):
+            self.assertTrue(os.path.exists(os.path.join(self.media.name, stored + '.webp')))
+
+        response = self.client.get(f'/api/images/{name}', HTTP_ACCEPT='image/avif,image/webp,*/*;q=0.8')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        # Siblings are re-encoded behind the same URL, so clients revalidate after a day
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+        self.assertEqual(response.getvalue()[8:12], b'WEBP')
+
+        for accept in ('image/*', 'image/webp;q=0', 'text/html,*/*'):
+            response = self.client.get(f'/api/images/{name}', HTTP_ACCEPT=accept)
+            self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/jpeg'))
+
+    def test_png_keeps_its_content_type(self):
+        from django.core.files.storage import default_storage
+        from django.core.files.base import ContentFile
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', (32, 32), (0, 0, 0)).save(buffer, format='PNG')
+        name = default_storage.save('icon.png', ContentFile(buffer.getvalue()))
+        response = self.client.get(f'/api/images/{name}', HTTP_ACCEPT='image/png')
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+    def test_encode_images_backfills_and_reports_savings(self):
+        from django.core.files.storage import default_storage
+        from django.core.files.base import ContentFile
+
+        default_storage.save('old.jpg', ContentFile(jpeg_upload(size=(600, 400)).read()))
+        default_storage.save('staging/raw.jpg', ContentFile(jpeg_upload(size=(600, 400)).read()))
+
+        out = StringIO()
+        call_command('encode_images', '--report-only', stdout=out)
+        self.assertIn('Measured 1 images', out.getvalue())
+        self.assertFalse(default_storage.exists('old.jpg.webp'))
+
+        call_command('encode_images', stdout=out)
+        self.assertTrue(default_storage.exists('old.jpg.webp'))
+        self.assertFalse(default_storage.exists('staging/raw.jpg.webp'))
+        self.assertIn('webp:', out.getvalue())
+        self.assertIn('smaller; sibling kept for 1/1 images', out.getvalue())
+
+        call_command('encode_images', stdout=out)
+        self.assertIn('Encoded 0 images', out.getvalue())
+
+
+class ServeImageTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=self.media.name, IMAGE_MODERN_FORMATS=[])
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.data = bytes(range(256)) * 1024
+        with open(os.path.join(self.media.name, 'big.jpg'), 'wb') as f:
+            f.write(self.data)
+
+    def get(self, path='big.jpg', **headers):
+        response = self.client.get(f'/api/images/{path}', **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def test_streams_with_validators_and_long_caching(self):
+        response = self.get()
+        self.assertTrue(response.streaming)
+        self.assertEqual(response.getvalue(), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(response['ETag'].startswith('"'))
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        os.makedirs(os.path.join(self.media.name, 'staging'))
+        with open(os.path.join(self.media.name, 'staging', 'raw.jpg'), 'wb') as f:
+            f.write(b'raw')
+        self.assertEqual(self.get('staging/raw.jpg')['Cache-Control'], 'no-cache')
+
+    def test_byte_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(response.getvalue(), self.data[100:200])
+
+        self.assertEqual(self.get(HTTP_RANGE='bytes=-10').getvalue(), self.data[-10:])
+        self.assertEqual(len(self.get(HTTP_RANGE='bytes=200000-').getvalue()), len(self.data) - 200000)
+        self.assertEqual(self.get(HTTP_RANGE=f'bytes={len(self.data)}-').status_code, 416)
+        # Multiple ranges, and an If-Range for another version, get the whole file
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1,5-6').status_code, 200)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"').status_code, 200)
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag).status_code, 206)
+
+    def test_rejects_paths_outside_media_root(self):
+        with open(os.path.join(os.path.dirname(self.media.name), 'secret.jpg'), 'wb') as f:
+            f.write(b'secret')
+        self.addCleanup(os.remove, os.path.join(os.path.dirname(self.media.name), 'secret.jpg'))
+        self.assertEqual(self.get('../secret.jpg').status_code, 404)
+        self.assertEqual(self.get('%2e%2e/secret.jpg').status_code, 404)
+        self.assertEqual(self.get(self.media.name.lstrip('/') + '/../secret.jpg').status_code, 404)
+
+    @override_settings(IMAGE_SENDFILE='x-accel-redirect', IMAGE_SENDFILE_PREFIX='/internal/')
+    def test_sendfile_offload(self):
+        response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/big.jpg')
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+        with self.settings(IMAGE_SENDFILE='x-sendfile'):
+            self.assertEqual(self.get()['X-Sendfile'], os.path.join(self.media.name, 'big.jpg'))
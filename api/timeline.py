@@ -0,0 +1,94 @@
+"""
+Materialized home timelines (fan-out on write).
+
+Creating a post pushes one TimelineEntry per friend, so reading a home feed
+is a single index range scan on (user, created_at) instead of a join between
+friends and posts. Authors with more than TIMELINE_FANOUT_LIMIT friends are
+not fanned out; their posts are flagged `fanned_out=False`, the author
+`high_fanout=True` (for good: later posts are not fanned out either), and
+those posts are pulled at read time from the small set of such authors the
+viewer is friends with.
+"""
+from django.conf import settings
+
+from .models import Post, TimelineEntry, User
+from .pagination import keyset_filter
+
+
+def get_fanout_limit():
+    return getattr(settings, 'TIMELINE_FANOUT_LIMIT', 1000)
+
+
+def fan_out_post(post):
+    """Push a new post into its author's and their friends' timelines"""
+    friend_ids = list(post.user.friends.values_list('id', flat=True))
+
+    if post.user.high_fanout or len(friend_ids) > get_fanout_limit():
+        # Hybrid pull: readers fetch this post directly instead
+        Post.objects.filter(pk=post.pk).update(fanned_out=False)
+        post.fanned_out = False
+        if not post.user.high_fanout:
+            # update() leaves updated_at alone, so cached fragments stay valid
+            User.objects.filter(pk=post.user_id).update(high_fanout=True)
+            post.user.high_fanout = True
+        friend_ids = []
+
+    entries = [
+        TimelineEntry(user_id=user_id, post=post, created_at=post.created_at)
+        for user_id in [post.user_id] + friend_ids
+    ]
+    TimelineEntry.objects.bulk_create(entries, batch_size=500, ignore_conflicts=True)
+
+
+def remove_post(post):
+    """Take a post out of every timeline, e.g. when it is taken down"""
+    TimelineEntry.objects.filter(post=post).delete()
+
+
+def add_friend_posts(user, friend):
+    """Backfill a new friend's recent posts into a user's timeline"""
+    backfill = getattr(settings, 'TIMELINE_BACKFILL_SIZE', 50)
+    posts = Post.objects.filter(user=friend, fanned_out=True, moderation_status=Post.PUBLISHED).order_by('-created_at')[:backfill]
+    entries = [
+        TimelineEntry(user=user, post_id=post_id, created_at=created_at)
+        for post_id, created_at in posts.values_list('id', 'created_at')
+    ]
+    TimelineEntry.objects.bulk_create(entries, batch_size=500, ignore_conflicts=True)
+
+
+def remove_friend_posts(user, friend):
+    """Drop a former friend's posts from a user's timeline"""
+    TimelineEntry.objects.filter(user=user, post__user=friend).delete()
+
+
+def _pulled_author_ids(user):
+    """Friends of `user` whose posts were too widely shared to be fanned out"""
+    return list(user.friends.filter(high_fanout=True).values_list('id', flat=True))
+
+
+def read_home_timeline(user, limit, cursor=None):
+    """
+    Return ([(created_at, post_id), ...], has_more) for one page of a home timeline.
+
+    `cursor` is a (created_at, post_id) position from the previous page.
+    """
+    entries = TimelineEntry.objects.filter(user=user)
+    if cursor:
+        entries = keyset_filter(entries, *cursor, pk_field='post_id')
+    else:
+        entries = entries.order_by('-created_at', '-post_id')
+    rows = list(entries.values_list('created_at', 'post_id')[:limit + 1])
+
+    pulled_ids = _pulled_author_ids(user)
+    if pulled_ids:
+        pulled = Post.objects.filter(user_id__in=pulled_ids, fanned_out=False, moderation_status=Post.PUBLISHED)
+        if cursor:
+            pulled = keyset_filter(pulled, *cursor)
+        else:
+            pulled = pulled.order_by('-created_at', '-id')
+        rows = sorted(
+            set(rows) | set(pulled.values_list('created_at', 'id')[:limit + 1]),
+            reverse=True
+        )
+
+    return rows[:limit], len(rows) > limit
@@ -5,7 +5,7 @@ from .views import (
     serve_image, google_oauth_callback, auth0_sync, post_comments,
     send_friend_request, respond_friend_request, remove_friend, cancel_friend_request,
     get_notifications, mark_notification_read, get_friend_requests, get_friend_status,
-    get_user_friends, clear_all_notifications, search_posts, search_users,
+    get_user_friends, clear_all_notifications, search_posts, search_users, home_feed,
     ConversationViewSet, MessageViewSet, mark_messages_as_read,
     debug_conversations, debug_friends, create_test_conversation
 )
@@ -30,6 +30,7 @@ urlpatterns = [
     path('auth/google/callback/', google_oauth_callback, name='google_oauth_callback'),
     path('auth/auth0/sync/', auth0_sync, name='auth0_sync'),
     path('posts/<int:post_id>/comments/', post_comments, name='post_comments'),
+    path('feed/home/', home_feed, name='home_feed'),
     path('images/<path:path>', serve_image, name='serve_image'),
     
     # Friend request endpoints
@@ -5,22 +5,32 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAuthenticatedOrReadOnly
 from django.contrib.auth import get_user_model, authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import Post, Comment, User, FriendRequest, Notification, Conversation, Message, MessageReadStatus
-from .serializers import UserSerializer, PostSerializer, CommentSerializer, FriendRequestSerializer, NotificationSerializer, ConversationSerializer, MessageSerializer
-from .pagination import PostsPagination
+from .models import STAGING_DIR, Post, Comment, User, FriendRequest, Notification, Conversation, Message, MessageReadStatus, bump_counter, set_like, toggle_like
+from .serializers import check_toxicity, get_comment_preview_size, UserSerializer, SimpleUserSerializer, PostSerializer, CommentSerializer, FriendRequestSerializer, NotificationSerializer, ConversationSerializer, MessageSerializer
+from .pagination import PostsPagination, PostsCursorPagination, CommentsCursorPagination, LikersPagination, get_posts_paginator, encode_cursor, decode_cursor
+from . import conditional, images, media, timeline
+from .moderation import chat as chat_moderation, publishing
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from django.http import HttpResponse, Http404
+from django.http import Http404
+from django.utils.cache import patch_vary_headers
+from django.utils._os import safe_join
+from django.core.exceptions import SuspiciousFileOperation
 from django.conf import settings
 import os
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.settings import api_settings
+from .renderers import ImageRenderer
 import requests
 import json
 from django.core.files.base import ContentFile
 from urllib.parse import urlencode
 import secrets
 import string
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q
 from .websocket_utils import send_notification_websocket
 from django.utils import timezone
 
@@ -53,6 +63,27 @@ def invalidate_friend_request_notifications(friend_request_id):
         print(f"Error invalidating friend request notifications: {e}")
 
 
+def apply_like_request(request, instance):
+    """Map the like endpoint's HTTP verb onto set_like/toggle_like; returns (liked, changed)"""
+    if request.method == 'PUT':
+        return True, set_like(instance, request.user, True)
+    if request.method == 'DELETE':
+        return False, set_like(instance, request.user, False)
+    return toggle_like(instance, request.user)
+
+
+def likers_response(request, instance):
+    """Paginated list of the users who liked a Post/Comment"""
+    manager = instance.likes
+    rows = manager.through.objects.filter(
+        **{f'{manager.source_field_name}_id': instance.pk}
+    ).select_related(manager.target_field_name)
+    paginator = LikersPagination()
+    page = paginator.paginate_queryset(rows, request)
+    users = [getattr(row, manager.target_field_name) for row in page]
+    return paginator.get_paginated_response(SimpleUserSerializer(users, many=True, context={'request': request}).data)
+
+
 def are_friends(user1, user2):
     """Check if two users are friends"""
     return user1.friends.filter(id=user2.id).exists()
@@ -120,6 +151,14 @@ class UserViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
+    def retrieve(self, request, *args, **kwargs):
+        user = self.get_object()
+        etag, last_modified = conditional.friends_validators(request, user)
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(self.get_serializer(user).data)
+        return conditional.set_validators(response, etag, last_modified)
+
     @action(detail=True, methods=['patch'])
     def upload_picture(self, request, pk=None):
         user = self.get_object()
@@ -133,8 +172,11 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def comments(self, request, pk=None):
         user = self.get_object()
-        comments = Comment.objects.filter(user=user)
-        serializer = CommentSerializer(comments, many=True)
+        context = self.get_serializer_context()
+        comments = CommentSerializer.setup_eager_loading(
+            Comment.objects.filter(Comment.visible_to(request.user), user=user), context
+        )
+        serializer = CommentSerializer(comments, many=True, context=context)
         return Response(serializer.data)
 
     @action(detail=True, methods=['post'])
@@ -146,6 +188,8 @@ class UserViewSet(viewsets.ModelViewSet):
         friend_id = request.data.get('friend_id')
         friend = User.objects.get(id=friend_id)
         user.friends.add(friend)
+        timeline.add_friend_posts(user, friend)
+        timeline.add_friend_posts(friend, user)
         return Response({'status': 'friend added'})
 
     @action(detail=True, methods=['post'])
@@ -157,6 +201,8 @@ class UserViewSet(viewsets.ModelViewSet):
         friend_id = request.data.get('friend_id')
         friend = User.objects.get(id=friend_id)
         user.friends.remove(friend)
+        timeline.remove_friend_posts(user, friend)
+        timeline.remove_friend_posts(friend, user)
         return Response({'status': 'friend removed'})
 
 class PostListView(generics.ListCreateAPIView):
@@ -185,33 +231,62 @@ class PostViewSet(viewsets.ModelViewSet):
     parser_classes = [JSONParser, MultiPartParser, FormParser]
     pagination_class = PostsPagination
 
+    @property
+    def paginator(self):
+        # Cursor mode by default; page numbers stay available for older clients
+        if not hasattr(self, '_paginator'):
+            self._paginator = get_posts_paginator(self.request)
+        return self._paginator
+
     def get_queryset(self):
-        queryset = Post.objects.all().order_by('-created_at')
+        queryset = Post.objects.filter(Post.visible_to(self.request.user)).order_by('-created_at')
         user_id = self.request.query_params.get('user', None)
         if user_id is not None:
             queryset = queryset.filter(user__id=user_id)
+        if self.action in ('list', 'retrieve'):
+            queryset = PostSerializer.setup_eager_loading(queryset, self.get_serializer_context())
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        # Validate against the page rows before any serializer work
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        page_state = getattr(self.paginator, 'page', None)
+        etag = conditional.post_etag(
+            request, page,
+            getattr(self.paginator, 'has_next', None),
+            page_state.paginator.count if hasattr(page_state, 'paginator') else None,
+        )
+        response = conditional.not_modified(request, etag)
+        if response is None:
+            response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return conditional.set_validators(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        post = self.get_object()
+        etag = conditional.post_etag(request, [post])
+        response = conditional.not_modified(request, etag)
+        if response is None:
+            response = Response(self.get_serializer(post).data)
+        return conditional.set_validators(response, etag)
+
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        post = serializer.save(user=self.request.user, moderation_status=publishing.initial_status())
+        if post.moderation_status == Post.PUBLISHED:
+            publishing.post_published(post)
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post', 'put', 'delete'])
     def like(self, request, pk=None):
+        """POST toggles the like; PUT likes and DELETE unlikes idempotently"""
         if not request.user.is_authenticated:
             return Response({'error': 'Authentication required to like posts'}, status=401)
             
         post = self.get_object()
         user = request.user
+        liked, changed = apply_like_request(request, post)
         
-        if user in post.likes.all():
-            post.likes.remove(user)
-            liked = False
-        else:
-            post.likes.add(user)
-            liked = True
-            
+        if liked and changed:
             # Create notification for post owner (if not liking own post)
-            if post.user != user:
+            if post.user_id != user.id:
                 # Check if there's already a recent like notification from this user for this post
                 from django.utils import timezone
                 from datetime import timedelta
@@ -245,14 +320,21 @@ class PostViewSet(viewsets.ModelViewSet):
             
         return Response({
             'liked': liked,
-            'likes_count': post.likes.count()
+            'likes_count': post.like_count
         })
 
+    @action(detail=True, methods=['get'])
+    def likers(self, request, pk=None):
+        return likers_response(request, self.get_object())
+
     def perform_update(self, serializer):
         # Ensure user can only update their own posts
         if serializer.instance.user != self.request.user:
-            return Response({'error': 'You can only update your own posts'}, status=403)
-        serializer.save()
+            raise PermissionDenied('You can only update your own posts')
+        description = serializer.instance.description
+        post = serializer.save()
+        if post.description != description:
+            publishing.text_edited(post)
 
     def destroy(self, request, *args, **kwargs):
         """Custom destroy method to ensure users can only delete their own posts"""
@@ -289,24 +371,42 @@ class PostViewSet(viewsets.ModelViewSet):
             return Response({'error': 'You can only update your own posts'}, status=403)
             
         # Update description and/or picture
-        if 'description' in request.data:
+        edited = 'description' in request.data and request.data['description'] != post.description
+        if edited:
             post.description = request.data['description']
+            if post.description.strip():
+                check_toxicity(post.description.strip(), "description")
         
         if 'picture' in request.FILES:
             post.picture = request.FILES['picture']
         
         post.save()
+        if edited:
+            publishing.text_edited(post)
         serializer = PostSerializer(post)
         return Response(serializer.data)
 
+def get_commentable_post(user, post_id):
+    """The post a new comment goes on; only posts `user` can see may be commented on"""
+    if post_id in (None, ''):
+        raise serializers.ValidationError({'post_id': 'This field is required.'})
+    try:
+        return Post.objects.filter(Post.visible_to(user)).get(id=post_id)
+    except (ValueError, TypeError):
+        raise serializers.ValidationError({'post_id': 'A valid post id is required.'})
+    except Post.DoesNotExist:
+        raise NotFound('Post not found')
+
 class CommentListView(generics.ListCreateAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
     def perform_create(self, serializer):
-        post = Post.objects.get(id=self.kwargs['post_id'])
-        serializer.save(user=self.request.user, post=post)
+        post = get_commentable_post(self.request.user, self.kwargs['post_id'])
+        comment = serializer.save(user=self.request.user, post=post, moderation_status=publishing.initial_status())
+        if comment.moderation_status == Comment.PUBLISHED:
+            publishing.comment_published(comment, notify_owner=False)
 
 class CommentDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Comment.objects.all()
@@ -319,52 +419,73 @@ class CommentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     parser_classes = [JSONParser, MultiPartParser, FormParser]
 
+    def get_queryset(self):
+        return Comment.objects.filter(Comment.visible_to(self.request.user))
+
     def perform_create(self, serializer):
-        post = Post.objects.get(id=self.request.data.get('post_id'))
-        comment = serializer.save(user=self.request.user, post=post)
-        
-        # Create notification for post owner (if not commenting on own post)
-        if post.user != self.request.user:
-            notification = Notification.objects.create(
-                user=post.user,
-                type=Notification.POST_COMMENT,
-                message=f"{self.request.user.first_name} {self.request.user.last_name} commented on your post",
-                post=post,
-                from_user=self.request.user
-            )
-            
-            # Send real-time notification via WebSocket
-            send_notification_websocket(post.user.id, notification)
+        post = get_commentable_post(self.request.user, self.request.data.get('post_id'))
+        comment = serializer.save(user=self.request.user, post=post, moderation_status=publishing.initial_status())
+        # Pending comments are counted, and the post owner notified, once the worker publishes them
+        if comment.moderation_status == Comment.PUBLISHED:
+            publishing.comment_published(comment)
 
-    @action(detail=True, methods=['post'])
+    def perform_update(self, serializer):
+        if serializer.instance.user != self.request.user:
+            raise PermissionDenied('You can only update your own comments')
+        text = serializer.instance.comment
+        comment = serializer.save()
+        if comment.comment != text:
+            publishing.text_edited(comment)
+
+    def perform_destroy(self, instance):
+        post = instance.post
+        instance.delete()
+        if instance.moderation_status == Comment.PUBLISHED:
+            bump_counter(post, 'comment_count', -1)
+
+    @action(detail=True, methods=['post', 'put', 'delete'])
     def like(self, request, pk=None):
+        """POST toggles the like; PUT likes and DELETE unlikes idempotently"""
         if not request.user.is_authenticated:
             return Response({'error': 'Authentication required to like comments'}, status=401)
             
         comment = self.get_object()
-        user = request.user
-        
-        if user in comment.likes.all():
-            comment.likes.remove(user)
-            liked = False
-        else:
-            comment.likes.add(user)
-            liked = True
+        liked, _ = apply_like_request(request, comment)
             
         return Response({
             'liked': liked,
-            'likes_count': comment.likes.count()
+            'likes_count': comment.like_count
         })
 
+    @action(detail=True, methods=['get'])
+    def likers(self, request, pk=None):
+        return likers_response(request, self.get_object())
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@renderer_classes([*api_settings.DEFAULT_RENDERER_CLASSES, ImageRenderer])
 def serve_image(request, path):
-    file_path = os.path.join(settings.MEDIA_ROOT, path)
-    if not os.path.exists(file_path):
+    try:
+        file_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Image not found")
+    if not os.path.isfile(file_path):
         raise Http404("Image not found")
 
-    with open(file_path, 'rb') as f:
-        return HttpResponse(f.read(), content_type="image/jpeg")
+    # Best encoding the client accepts: an AVIF/WebP sibling, else the file itself
+    file_path, content_type = images.negotiate(file_path, request.META.get('HTTP_ACCEPT', ''))
+    if os.path.relpath(file_path, settings.MEDIA_ROOT).startswith(STAGING_DIR + os.sep):
+        # Deleted once processed, and the name can come back
+        response = media.file_response(request, file_path, content_type)
+    elif images.preferred_formats():
+        # Uploads are never rewritten in place, but AVIF/WebP siblings appear after
+        # the upload and are re-encoded by encode_images, behind the same URL
+        max_age = getattr(settings, 'IMAGE_NEGOTIATED_MAX_AGE', 86400)
+        response = media.file_response(request, file_path, content_type, max_age=max_age)
+    else:
+        response = media.file_response(request, file_path, content_type, immutable=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
 
 
 @api_view(['POST'])
@@ -566,15 +687,24 @@ def post_comments(request, post_id):
     Handle comments for a specific post
     """
     try:
-        post = Post.objects.get(id=post_id)
+        post = Post.objects.filter(Post.visible_to(request.user)).get(id=post_id)
     except Post.DoesNotExist:
         return Response({'error': 'Post not found'}, status=status.HTTP_404_NOT_FOUND)
     
     if request.method == 'GET':
-        # Get all comments for this post
-        comments = Comment.objects.filter(post=post).order_by('-created_at')
-        serializer = CommentSerializer(comments, many=True)
-        return Response(serializer.data)
+        # Newest first: the whole thread as a list, or keyset pages when the
+        # client asks for them with ?limit, ?cursor or ?pagination=cursor
+        context = {'request': request}
+        comments = CommentSerializer.setup_eager_loading(
+            Comment.objects.filter(Comment.visible_to(request.user), post=post).order_by('-created_at', '-id'), context
+        )
+        params = request.query_params
+        if not ('limit' in params or 'cursor' in params or params.get('pagination') == 'cursor'):
+            return Response(CommentSerializer(comments, many=True, context=context).data)
+        paginator = CommentsCursorPagination()
+        page = paginator.paginate_queryset(comments, request)
+        serializer = CommentSerializer(page, many=True, context=context)
+        return paginator.get_paginated_response(serializer.data)
     
     elif request.method == 'POST':
         # Create a new comment for this post
@@ -583,7 +713,9 @@ def post_comments(request, post_id):
         
         serializer = CommentSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save(user=request.user, post=post)
+            comment = serializer.save(user=request.user, post=post, moderation_status=publishing.initial_status())
+            if comment.moderation_status == Comment.PUBLISHED:
+                publishing.comment_published(comment, notify_owner=False)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -681,6 +813,8 @@ def respond_friend_request(request, request_id):
             # Add each other as friends
             friend_request.sender.friends.add(friend_request.receiver)
             friend_request.receiver.friends.add(friend_request.sender)
+            timeline.add_friend_posts(friend_request.sender, friend_request.receiver)
+            timeline.add_friend_posts(friend_request.receiver, friend_request.sender)
             
             # Mark related notification as read
             Notification.objects.filter(
@@ -792,6 +926,8 @@ def remove_friend(request, user_id):
         # Remove friendship (both ways)
         user.friends.remove(friend)
         friend.friends.remove(user)
+        timeline.remove_friend_posts(user, friend)
+        timeline.remove_friend_posts(friend, user)
         
         # Update any existing friend requests to declined
         FriendRequest.objects.filter(
@@ -838,13 +974,19 @@ def get_notifications(request):
     Get all notifications for the current user
     """
     notifications = Notification.objects.filter(user=request.user)
+    etag = conditional.notifications_etag(request, notifications)
+    response = conditional.not_modified(request, etag)
+    if response is not None:
+        return conditional.set_validators(response, etag)
+
     unread_count = notifications.filter(is_read=False).count()
     
     serializer = NotificationSerializer(notifications, many=True)
-    return Response({
+    response = Response({
         'notifications': serializer.data,
         'unread_count': unread_count
     })
+    return conditional.set_validators(response, etag)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -929,6 +1071,10 @@ def get_user_friends(request, user_id):
     """
     try:
         user = User.objects.get(id=user_id)
+        etag, last_modified = conditional.friends_validators(request, user)
+        response = conditional.not_modified(request, etag, last_modified)
+        if response is not None:
+            return conditional.set_validators(response, etag, last_modified)
         
         # For now, allow getting friends list for any user
         # You can add privacy checks here if needed
@@ -952,7 +1098,8 @@ def get_user_friends(request, user_id):
                 'impressions': getattr(friend, 'impressions', 0),
             })
         
-        return Response(friends_data, status=status.HTTP_200_OK)
+        response = Response(friends_data, status=status.HTTP_200_OK)
+        return conditional.set_validators(response, etag, last_modified)
         
     except User.DoesNotExist:
         return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -990,8 +1137,20 @@ def search_posts(request):
     try:
         # Search posts by description
         posts = Post.objects.filter(
-            Q(description__icontains=query)
-        ).select_related('user').order_by('-created_at')[:20]  # Limit to 20 results
+            Q(description__icontains=query), Post.visible_to(request.user)
+        ).select_related('user').prefetch_related(
+            'likes',
+            Prefetch(
+                'comments',
+                queryset=Comment.objects.filter(moderation_status=Comment.PUBLISHED).select_related('user').order_by('-created_at', '-id')[
+                    :get_comment_preview_size({'request': request})
+                ],
+                to_attr='comment_preview'
+            )
+        ).order_by('-created_at')
+        
+        paginator = get_posts_paginator(request, page_size=20)
+        posts = paginator.paginate_queryset(posts, request)
         
         # Serialize the posts
         posts_data = []
@@ -1003,7 +1162,7 @@ def search_posts(request):
             
             # Get comments safely
             comments_list = []
-            for comment in post.comments.all():
+            for comment in post.comment_preview:
                 comments_list.append({
                     'id': comment.id,
                     'userId': comment.user.id,
@@ -1024,15 +1183,51 @@ def search_posts(request):
                 'picturePath': post.picture.url if post.picture else (post.picture_path or ''),
                 'userPicturePath': post.user.picture.url if post.user.picture else (getattr(post.user, 'picture_path', '') or ''),
                 'likes': likes_dict,
+                'likes_count': post.like_count,
                 'comments': comments_list,
+                'comments_count': post.comment_count,
                 'createdAt': post.created_at.isoformat(),
                 'updatedAt': post.updated_at.isoformat()
             })
         
-        return Response({'posts': posts_data}, status=status.HTTP_200_OK)
+        return paginator.get_paginated_response(posts_data)
+    except NotFound as e:
+        return Response({'error': str(e.detail), 'posts': []}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
         return Response({'error': str(e), 'posts': []}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def home_feed(request):
+    """Posts from the current user and their friends, read from the materialized timeline"""
+    paginator = PostsCursorPagination()
+    limit = paginator.get_page_size(request)
+    token = request.query_params.get('cursor')
+    cursor = decode_cursor(token)[:2] if token else None
+
+    rows, has_more = timeline.read_home_timeline(request.user, limit, cursor=cursor)
+    post_ids = [post_id for _, post_id in rows]
+    context = {'request': request}
+    # Entries outlive a post going back to pending (an edit) or being rejected
+    visible = Post.objects.filter(Post.visible_to(request.user), id__in=post_ids)
+    posts = PostSerializer.setup_eager_loading(visible, context).in_bulk()
+    posts = [posts[post_id] for post_id in post_ids if post_id in posts]
+
+    next_cursor = encode_cursor(*rows[-1]) if has_more and rows else None
+    next_link = None
+    if next_cursor:
+        next_link = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+
+    return Response({
+        'posts': PostSerializer(posts, many=True, context=context).data,
+        'pagination': {
+            'hasNextPage': has_more,
+            'limit': limit,
+            'nextCursor': next_cursor,
+            'next': next_link,
+        }
+    })
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def search_users(request):
@@ -1214,6 +1409,10 @@ class MessageViewSet(viewsets.ModelViewSet):
                 )
                 print(f"[API] Message {message.id} broadcasted to WebSocket group conversation_{conversation_id}")
 
+            # Broadcast first, moderate after, as over the WebSocket
+            if message.content and chat_moderation.is_enabled():
+                transaction.on_commit(lambda: chat_moderation.schedule_moderation(message.id, message.content))
+
         except Conversation.DoesNotExist:
             print(f"[API] Error: Conversation {conversation_id} not found or user {self.request.user.id} is not a participant")
             raise serializers.ValidationError("Conversation not found or you are not a participant.")
@@ -1265,6 +1464,10 @@ class MessageViewSet(viewsets.ModelViewSet):
                 }
             )
             print(f"[API] Message {message.id} edit broadcasted to WebSocket group conversation_{conversation_id}")
+
+        # The new text is checked like a new message
+        if chat_moderation.is_enabled():
+            transaction.on_commit(lambda: chat_moderation.schedule_moderation(message.id, content))
         
         return Response(serializer.data)
     
@@ -3,6 +3,11 @@ from asgiref.sync import async_to_sync
 from .models import Notification
 from .serializers import NotificationSerializer
 
+def channel_layer_is_shared():
+    """False for the in-memory layer, whose events never leave this process"""
+    from channels.layers import InMemoryChannelLayer
+    return not isinstance(get_channel_layer(), InMemoryChannelLayer)
+
 def send_notification_websocket(user_id, notification):
     """
     Send a real-time notification via WebSocket
@@ -33,3 +38,18 @@ def send_notification_websocket(user_id, notification):
                 'notification': notification_data
             }
         )
+
+def send_image_ready(group_name, kind, object_id, url):
+    """
+    Tell a notification or conversation group that a processed image replaced its upload
+    """
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        group_name,
+        {
+            'type': 'image_ready',
+            'kind': kind,
+            'id': object_id,
+            'url': url
+        }
+    )
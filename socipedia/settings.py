@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "api.middleware.CompressionMiddleware",
     "oauth2_provider.middleware.OAuth2TokenMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -90,15 +91,47 @@ TEMPLATES = [
 WSGI_APPLICATION = 'socipedia.wsgi.application'
 ASGI_APPLICATION = 'socipedia.asgi.application'
 
+REDIS_URL = os.environ.get('REDIS_URL')
+
 # Channels configuration
-# For development, use in-memory layer to avoid Redis dependency
+# Redis when REDIS_URL is set. The in-memory layer (development) only reaches
+# sockets served by the same process, so the events that `moderation_worker`
+# (MODERATION_ASYNC) and `image_worker` send from their own processes need Redis.
 CHANNEL_LAYERS = {
     'default': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {'hosts': [REDIS_URL]},
+    } if REDIS_URL else {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',
     },
 }
 
 
+# Caches
+# Serialized posts are cached per version in 'post_fragments' (see api/fragment_cache.py):
+# a bounded local-memory LRU by default, Redis when REDIS_URL is set.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'post_fragments': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    } if REDIS_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'post-fragments',
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('POST_FRAGMENT_CACHE_MAX_ENTRIES', 5000)),
+        },
+    },
+}
+
+POST_FRAGMENT_CACHE_ENABLED = os.environ.get('POST_FRAGMENT_CACHE_ENABLED', 'True') == 'True'
+POST_FRAGMENT_CACHE_ALIAS = 'post_fragments'
+POST_FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('POST_FRAGMENT_CACHE_TIMEOUT', 300))
+
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -155,6 +188,34 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 MEDIA_URL = "/assets/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "public/assets")
+# Image jobs (api.images) run in the background on IMAGE_WORKERS threads per
+# process, plus `manage.py image_worker` for leftovers: variants and modern
+# encodings for every upload, and with IMAGE_ASYNC compression too (uploads are
+# stored raw under MEDIA_ROOT/staging). Jobs give up after IMAGE_MAX_ATTEMPTS.
+IMAGE_ASYNC = os.environ.get('IMAGE_ASYNC', 'False') == 'True'
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_MAX_ATTEMPTS = int(os.environ.get('IMAGE_MAX_ATTEMPTS', 3))
+# Seconds after which a job claimed by a worker that died is picked up again
+IMAGE_JOB_TIMEOUT = int(os.environ.get('IMAGE_JOB_TIMEOUT', 300))
+# Bounds (longest side, px) of the downscaled copies kept for every image
+IMAGE_VARIANT_SIZES = [int(size) for size in os.environ.get('IMAGE_VARIANT_SIZES', '64,160,480,1200').split(',')]
+# Alternative encodings written next to every image, in serve_image preference
+# order (AVIF needs Pillow >= 11.3 or pillow-avif-plugin), with their quality
+IMAGE_MODERN_FORMATS = os.environ.get('IMAGE_MODERN_FORMATS', 'avif,webp').split(',')
+IMAGE_MODERN_QUALITY = {
+    'avif': int(os.environ.get('IMAGE_AVIF_QUALITY', 60)),
+    'webp': int(os.environ.get('IMAGE_WEBP_QUALITY', 80)),
+}
+# serve_image: Cache-Control max-age for stored images (never rewritten in
+# place), or with IMAGE_MODERN_FORMATS, whose siblings can appear or change
+# behind the same URL, IMAGE_NEGOTIATED_MAX_AGE before revalidating; and
+# optional body offload to the front server: 'x-accel-redirect'
+# (nginx, with an internal location at IMAGE_SENDFILE_PREFIX aliasing
+# MEDIA_ROOT) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 60 * 60 * 24 * 365))
+IMAGE_NEGOTIATED_MAX_AGE = int(os.environ.get('IMAGE_NEGOTIATED_MAX_AGE', 60 * 60 * 24))
+IMAGE_SENDFILE = os.environ.get('IMAGE_SENDFILE', '')
+IMAGE_SENDFILE_PREFIX = os.environ.get('IMAGE_SENDFILE_PREFIX', '/protected-assets/')
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -176,6 +237,94 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 10
 }
 
+# orjson-backed renderer/parser (api.renderers); same wire format, faster encoding
+FAST_JSON = os.environ.get('FAST_JSON', 'False') == 'True'
+if FAST_JSON:
+    REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"] = [
+        "api.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ]
+    REST_FRAMEWORK["DEFAULT_PARSER_CLASSES"] = [
+        "api.renderers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ]
+
+# Content moderation (api.moderation): 'local' runs the combined_model transformers
+# in every worker; 'server' asks `manage.py run_moderation_server` at
+# MODERATION_ADDRESS ('unix:/path/to.sock' or 'host:port'), failing open after
+# MODERATION_TIMEOUT seconds.
+MODERATION_BACKEND = os.environ.get('MODERATION_BACKEND', 'local')
+MODERATION_ADDRESS = os.environ.get('MODERATION_ADDRESS', '127.0.0.1:8765')
+MODERATION_TIMEOUT = float(os.environ.get('MODERATION_TIMEOUT', 2.0))
+# Moderation engine, in-process and in the server: 'infer' (infer.py, one text
+# per call) or 'transformers' (api.moderation.engine, batched forward passes).
+# Concurrent server requests are coalesced into batches of up to MODERATION_MAX_BATCH_SIZE,
+# waiting at most MODERATION_MAX_WAIT_MS for a batch to fill.
+MODERATION_ENGINE = os.environ.get('MODERATION_ENGINE', 'infer')
+MODERATION_MAX_BATCH_SIZE = int(os.environ.get('MODERATION_MAX_BATCH_SIZE', 16))
+MODERATION_MAX_WAIT_MS = float(os.environ.get('MODERATION_MAX_WAIT_MS', 5))
+# Save new posts/comments as pending and let `manage.py moderation_worker`
+# publish or reject them, so create latency does not depend on the models.
+MODERATION_ASYNC = os.environ.get('MODERATION_ASYNC', 'False') == 'True'
+# Seconds after which a row claimed by a moderation worker that died is picked up again
+MODERATION_CLAIM_TIMEOUT = int(os.environ.get('MODERATION_CLAIM_TIMEOUT', 300))
+# Chat messages are broadcast at once and retracted if moderation flags them;
+# checks run off the event loop, on MODERATION_CHAT_WORKERS threads with the
+# moderation server (one with MODERATION_BACKEND='local'), with at most
+# MODERATION_CHAT_MAX_PENDING queued and MODERATION_CHAT_BUDGET_MS to finish.
+MODERATION_CHAT = os.environ.get('MODERATION_CHAT', 'False') == 'True'
+MODERATION_CHAT_WORKERS = int(os.environ.get('MODERATION_CHAT_WORKERS', 4))
+MODERATION_CHAT_MAX_PENDING = int(os.environ.get('MODERATION_CHAT_MAX_PENDING', 64))
+MODERATION_CHAT_BUDGET_MS = float(os.environ.get('MODERATION_CHAT_BUDGET_MS', 2000))
+# 'fp32' or 'int8' (dynamic int8 Linear layers, built by
+# `manage.py quantize_moderation_models`); only used by the transformers engine.
+MODERATION_MODEL_MODE = os.environ.get('MODERATION_MODEL_MODE', 'fp32')
+MODERATION_QUANTIZED_DIR = os.environ.get('MODERATION_QUANTIZED_DIR', os.path.join(BASE_DIR, 'moderation_int8'))
+MODERATION_TOXIC_THRESHOLD = float(os.environ.get('MODERATION_TOXIC_THRESHOLD', 0.5))
+MODERATION_NEGATIVE_THRESHOLD = float(os.environ.get('MODERATION_NEGATIVE_THRESHOLD', 0.98))
+# Transformers engine: torch intra-op threads (0 keeps torch's default) and
+# cached per-text tokenizations per tokenizer (shared when both models use one).
+MODERATION_TORCH_THREADS = int(os.environ.get('MODERATION_TORCH_THREADS', 0))
+MODERATION_TOKEN_CACHE_SIZE = int(os.environ.get('MODERATION_TOKEN_CACHE_SIZE', 4096))
+# Verdict cache (api.moderation.cache): in-process LRU entries (0 disables the
+# cache), plus an optional shared CACHES alias such as a Redis-backed one.
+MODERATION_CACHE_SIZE = int(os.environ.get('MODERATION_CACHE_SIZE', 10000))
+MODERATION_CACHE_ALIAS = os.environ.get('MODERATION_CACHE_ALIAS') or None
+MODERATION_CACHE_TIMEOUT = None  # Keys embed the model files, engine, mode and thresholds, so entries never go stale
+MODERATION_CACHE_VERSION_TTL = 10  # Seconds between re-reads of the combined_model/ file signature
+# Pre-filter cascade (api.moderation.prefilter): blocklist/allowlist, then the
+# hashed n-gram model from `manage.py train_moderation_prefilter`, deciding
+# outside [ALLOW_BELOW, BLOCK_ABOVE]. At most MAX_SKIP of the last WINDOW texts
+# skip the transformers; the rest audit the cheap tiers.
+MODERATION_PREFILTER = os.environ.get('MODERATION_PREFILTER', 'False') == 'True'
+MODERATION_BLOCKLIST = os.environ.get('MODERATION_BLOCKLIST', os.path.join(BASE_DIR, 'api', 'moderation', 'blocklist.txt'))
+MODERATION_ALLOWLIST = os.environ.get('MODERATION_ALLOWLIST', os.path.join(BASE_DIR, 'api', 'moderation', 'allowlist.txt'))
+MODERATION_PREFILTER_MODEL = os.environ.get('MODERATION_PREFILTER_MODEL', os.path.join(BASE_DIR, 'moderation_prefilter.json'))
+MODERATION_PREFILTER_ALLOW_BELOW = float(os.environ.get('MODERATION_PREFILTER_ALLOW_BELOW', 0.02))
+MODERATION_PREFILTER_BLOCK_ABOVE = float(os.environ.get('MODERATION_PREFILTER_BLOCK_ABOVE', 0.98))
+MODERATION_PREFILTER_MAX_SKIP = float(os.environ.get('MODERATION_PREFILTER_MAX_SKIP', 0.8))
+MODERATION_PREFILTER_WINDOW = int(os.environ.get('MODERATION_PREFILTER_WINDOW', 1000))
+
+# api.middleware.CompressionMiddleware: brotli (if installed) or gzip for textual
+# responses of at least COMPRESSION_MIN_SIZE bytes
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+# Posts feed/search pagination: 'cursor' (keyset, no COUNT) or 'pages' (legacy
+# currentPage/totalPages shape). Clients can also pass ?pagination=pages or ?page=N.
+POSTS_PAGINATION_MODE = os.environ.get('POSTS_PAGINATION_MODE', 'cursor')
+
+# Newest comments embedded in each post of a feed page (clients can ask for up
+# to 20 with ?comments_preview=N); full threads come from posts/<id>/comments/.
+POST_COMMENT_PREVIEW_SIZE = int(os.environ.get('POST_COMMENT_PREVIEW_SIZE', 3))
+
+# Home timeline fan-out: authors with more friends than this are pulled at read
+# time instead of writing one timeline row per friend.
+TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 1000))
+# Number of a new friend's recent posts copied into the other user's timeline
+TIMELINE_BACKFILL_SIZE = int(os.environ.get('TIMELINE_BACKFILL_SIZE', 50))
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),